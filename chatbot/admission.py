@@ -0,0 +1,205 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+
+from .metrics import add_stage
+
+
+class Overloaded(Exception):
+    """the LLM backend is saturated; retry after `retry_after` seconds"""
+
+    def __init__(self, retry_after, reason="queue full"):
+        super().__init__(f"LLM backend overloaded ({reason}), retry after {retry_after}s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class _Waiter:
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+        self.enqueued = time.perf_counter()
+
+
+class AdmissionGate:
+    """
+    Concurrency limit with a bounded FIFO wait queue in front of the LLM.
+    At most `max_concurrent` calls run at once and at most `max_queue` wait.
+    A caller that finds the queue full, or whose deadline passes while
+    waiting, gets Overloaded with a retry hint instead of piling more work
+    onto the model server. Slots are handed directly to the next waiter, so
+    sync threads and async tasks share one queue fairly.
+    """
+
+    def __init__(self, max_concurrent=2, max_queue=16):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._active = 0
+        # running mean of how long a call holds its slot, for retry hints
+        self._mean_hold = 5.0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def retry_after(self):
+        waves = (len(self._queue) + self._active) / self.max_concurrent
+        return max(1, round(waves * self._mean_hold))
+
+    def _enter(self, wake):
+        """take a slot now (returns None) or join the queue (returns the waiter)"""
+        with self._lock:
+            if self._active < self.max_concurrent and not self._queue:
+                self._active += 1
+                self.admitted += 1
+                return None
+            if len(self._queue) >= self.max_queue:
+                self.rejected += 1
+                raise Overloaded(self.retry_after())
+            waiter = _Waiter(wake)
+            self._queue.append(waiter)
+            return waiter
+
+    def _withdraw(self, waiter):
+        """leave the queue; True if the slot was handed over meanwhile"""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._queue.remove(waiter)
+            return False
+
+    def _deadline_passed(self, waiter):
+        if not self._withdraw(waiter):
+            with self._lock:
+                self.timed_out += 1
+                raise Overloaded(self.retry_after(), reason="deadline exceeded")
+
+    def _admitted(self, waiter):
+        wait = time.perf_counter() - waiter.enqueued
+        add_stage("llm_queue", wait)
+        with self._lock:
+            self.admitted += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def release(self, held):
+        with self._lock:
+            self._mean_hold = 0.9 * self._mean_hold + 0.1 * held
+            if self._queue:
+                waiter = self._queue.popleft()
+                waiter.granted = True
+                waiter.wake()
+            else:
+                self._active -= 1
+
+    @contextmanager
+    def slot(self, timeout=None):
+        event = threading.Event()
+        waiter = self._enter(event.set)
+        if waiter is not None:
+            if not event.wait(timeout):
+                self._deadline_passed(waiter)
+            self._admitted(waiter)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def aslot(self, timeout=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enter(wake)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                self._deadline_passed(waiter)
+            except asyncio.CancelledError:
+                # client went away while queued; don't leak a handed-over slot
+                if self._withdraw(waiter):
+                    self.release(0.0)
+                raise
+            self._admitted(waiter)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - started)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_concurrent": self.max_concurrent,
+                "active": self._active,
+                "queued": len(self._queue),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "total_wait_seconds": self.wait_total,
+                "max_wait_seconds": self.wait_max,
+                "mean_hold_seconds": self._mean_hold,
+            }
+
+
+class GatedLLM:
+    """LLM client wrapper that runs every generation inside an AdmissionGate slot"""
+
+    def __init__(self, llm, gate, timeout=None):
+        self.llm = llm
+        self.gate = gate
+        self.timeout = timeout
+
+    def __getattr__(self, name):
+        if name == "llm":
+            raise AttributeError(name)
+        return getattr(self.llm, name)
+
+    def invoke(self, prompt, **kwargs):
+        with self.gate.slot(self.timeout):
+            return self.llm.invoke(prompt, **kwargs)
+
+    def stream(self, prompt, **kwargs):
+        with self.gate.slot(self.timeout):
+            yield from self.llm.stream(prompt, **kwargs)
+
+    async def ainvoke(self, prompt, **kwargs):
+        async with self.gate.aslot(self.timeout):
+            return await self.llm.ainvoke(prompt, **kwargs)
+
+    async def astream(self, prompt, **kwargs):
+        async with self.gate.aslot(self.timeout):
+            async for chunk in self.llm.astream(prompt, **kwargs):
+                yield chunk
+
+
+_gate = None
+_gate_lock = threading.Lock()
+
+
+def get_admission_gate():
+    """return the AdmissionGate guarding this worker's LLM calls"""
+    global _gate
+    if _gate is None:
+        with _gate_lock:
+            if _gate is None:
+                from .runtime import ollama_backends
+
+                # CHATBOT_LLM_MAX_CONCURRENT is per Ollama server
+                _gate = AdmissionGate(
+                    max_concurrent=getattr(settings, "CHATBOT_LLM_MAX_CONCURRENT", 2) * len(ollama_backends()),
+                    max_queue=getattr(settings, "CHATBOT_LLM_MAX_QUEUE", 16),
+                )
+    return _gate
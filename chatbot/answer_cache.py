@@ -0,0 +1,117 @@
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+
+import numpy as np
+from django.conf import settings
+
+
+class SemanticAnswerCache:
+    """
+    Cache of LLM answers looked up by question similarity.
+    A cached answer is reused when the new question's embedding has a cosine
+    similarity of at least `threshold` with a cached question and the
+    retrieval step returned the same source chunks. Entries expire after
+    `ttl` seconds, the least recently used entry is evicted beyond
+    `max_entries`, and everything is dropped when the Chroma index version
+    changes.
+    """
+
+    def __init__(self, threshold=0.95, ttl=86400, max_entries=1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._ids = count()
+        self._matrix = None
+        self._matrix_keys = []
+        self._index_version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _check_version(self, index_version):
+        if index_version != self._index_version:
+            self._entries.clear()
+            self._matrix = None
+            self._index_version = index_version
+
+    def _expire(self, now):
+        expired = [key for key, entry in self._entries.items() if now - entry["created"] > self.ttl]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def _stack(self):
+        if self._matrix is None:
+            self._matrix_keys = list(self._entries)
+            if self._matrix_keys:
+                self._matrix = np.stack([self._entries[key]["vector"] for key in self._matrix_keys])
+            else:
+                self._matrix = np.empty((0, 0), dtype=np.float32)
+        return self._matrix
+
+    def get(self, query_vector, sources, index_version):
+        """return a cached answer for this question and sources, or None"""
+        sources = tuple(sources)
+        with self._lock:
+            self._check_version(index_version)
+            self._expire(time.monotonic())
+            matrix = self._stack()
+            if len(self._matrix_keys):
+                similarities = matrix @ self._unit(query_vector)
+                # best matching question first
+                for position in np.argsort(-similarities):
+                    if similarities[position] < self.threshold:
+                        break
+                    key = self._matrix_keys[position]
+                    entry = self._entries[key]
+                    if entry["sources"] == sources:
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        return entry["answer"]
+            self.misses += 1
+            return None
+
+    def put(self, query_vector, sources, answer, index_version):
+        with self._lock:
+            self._check_version(index_version)
+            self._entries[next(self._ids)] = {
+                "vector": self._unit(query_vector),
+                "sources": tuple(sources),
+                "answer": answer,
+                "created": time.monotonic(),
+            }
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """return the SemanticAnswerCache shared by this worker"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SemanticAnswerCache(
+                    threshold=getattr(settings, "CHATBOT_ANSWER_CACHE_THRESHOLD", 0.95),
+                    ttl=getattr(settings, "CHATBOT_ANSWER_CACHE_TTL", 86400),
+                    max_entries=getattr(settings, "CHATBOT_ANSWER_CACHE_SIZE", 1000),
+                )
+    return _cache
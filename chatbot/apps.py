@@ -1,6 +1,25 @@
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ChatboxConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chatbot'
+
+    def ready(self):
+        from . import checks  # noqa: F401  registers the system checks
+
+        # Build the RAG runtime in the background so the first chat does not
+        # pay for the embedder, Chroma and Ollama client set-up.
+        if getattr(settings, 'CHATBOT_WARMUP_ON_START', False):
+            from .runtime import get_runtime
+            threading.Thread(target=get_runtime().warmup, name='chatbot-warmup', daemon=True).start()
+
+        # Load mistral into Ollama now, and keep it loaded, instead of making
+        # the first chat after a quiet spell wait for the cold load.
+        if getattr(settings, 'CHATBOT_LLM_PRELOAD', False):
+            from .keepalive import get_keepalives
+            for keepalive in get_keepalives():
+                keepalive.start()
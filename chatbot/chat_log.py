@@ -0,0 +1,180 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import ChatMessage, ChatQueryMessage
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class ChatLogWriter:
+    """
+    Writes chat turns to ChatQueryMessage and ChatMessage off the request path.
+    write() only enqueues; a background thread inserts whatever has queued
+    up with one bulk_create per table and one commit, at most
+    `flush_seconds` after a turn or as soon as `batch_size` turns are
+    waiting. When the queue is full the turn is written synchronously
+    instead of being dropped. close() (registered with atexit) drains the
+    queue before the process exits.
+    """
+
+    def __init__(self, batch_size=100, flush_seconds=1.0, max_queue=10000, retries=3):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.retries = retries
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        # session id -> turns queued but not yet committed, for Conversation.history
+        self._pending = {}
+        self._closed = False
+        self.written = 0
+        self.batches = 0
+        self.overflows = 0
+        self.lost = 0
+        self._thread = threading.Thread(target=self._run, name="chatbot-chat-log", daemon=True)
+        self._thread.start()
+
+    def write(self, message, response, session_id=None):
+        turn = (message, response, session_id, timezone.now())
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("chat log writer is closed")
+            self._pending.setdefault(session_id, []).append(turn)
+        try:
+            self._queue.put_nowait(turn)
+        except queue.Full:
+            # back-pressure: pay for the insert in this request rather than lose it
+            with self._lock:
+                self.overflows += 1
+            try:
+                self._insert([turn])
+            finally:
+                self._forget([turn])
+
+    def pending(self, session_id):
+        """turns of a session that are queued but not yet in the database, oldest first"""
+        with self._lock:
+            return [
+                ChatMessage(message=message, response=response, session_id=session, created_at=created_at)
+                for message, response, session, created_at in self._pending.get(session_id, ())
+            ]
+
+    def _forget(self, turns):
+        with self._lock:
+            for turn in turns:
+                session_turns = self._pending.get(turn[2])
+                if session_turns:
+                    session_turns.remove(turn)
+                    if not session_turns:
+                        del self._pending[turn[2]]
+
+    def _insert(self, turns):
+        with transaction.atomic():
+            ChatQueryMessage.objects.bulk_create([
+                ChatQueryMessage(message=message, response=response, session_id=session_id, created_at=created_at)
+                for message, response, session_id, created_at in turns
+            ])
+            ChatMessage.objects.bulk_create([
+                ChatMessage(message=message, response=response, session_id=session_id, created_at=created_at)
+                for message, response, session_id, created_at in turns
+            ])
+
+    def _flush(self, turns):
+        for attempt in range(1, self.retries + 1):
+            try:
+                self._insert(turns)
+                with self._lock:
+                    self.written += len(turns)
+                    self.batches += 1
+                break
+            except Exception:
+                logger.exception("writing %d chat turns failed (attempt %d/%d)", len(turns), attempt, self.retries)
+                # a broken connection is replaced on the next query
+                connection.close()
+                time.sleep(min(2 ** attempt, 10))
+        else:
+            with self._lock:
+                self.lost += len(turns)
+            logger.error("dropped %d chat turns after %d attempts", len(turns), self.retries)
+        self._forget(turns)
+        for _ in turns:
+            self._queue.task_done()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            turns = []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_seconds
+            while True:
+                if item is _STOP:
+                    self._queue.task_done()
+                    stopping = True
+                else:
+                    turns.append(item)
+                if len(turns) >= self.batch_size:
+                    break
+                try:
+                    # after a stop request drain without waiting
+                    timeout = 0 if stopping else max(0.0, deadline - time.monotonic())
+                    item = self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if turns:
+                self._flush(turns)
+        connection.close()
+
+    def flush(self):
+        """block until every turn written so far is committed"""
+        self._queue.join()
+
+    def close(self, timeout=30):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error("chat log writer did not drain within %ss; %d turns unwritten", timeout, self._queue.qsize())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "written": self.written,
+                "batches": self.batches,
+                "mean_batch_size": self.written / self.batches if self.batches else None,
+                "overflows": self.overflows,
+                "lost": self.lost,
+            }
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_chat_log_writer():
+    """return this worker's ChatLogWriter, flushed when the process exits"""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = ChatLogWriter(
+                    batch_size=getattr(settings, "CHATBOT_CHAT_LOG_BATCH_SIZE", 100),
+                    flush_seconds=getattr(settings, "CHATBOT_CHAT_LOG_FLUSH_SECONDS", 1.0),
+                    max_queue=getattr(settings, "CHATBOT_CHAT_LOG_MAX_QUEUE", 10000),
+                )
+                atexit.register(_writer.close)
+    return _writer
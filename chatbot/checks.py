@@ -0,0 +1,30 @@
+import os
+
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+from django.core.exceptions import ImproperlyConfigured
+
+
+@register(Tags.compatibility)
+def check_chroma_embedding_provider(app_configs, **kwargs):
+    """fail start-up when the vector index was built with another embedding provider"""
+    from .get_embedding_function import check_index_provider
+
+    if getattr(settings, 'CHATBOT_VECTOR_STORE', 'chroma') == 'numpy':
+        index_path = getattr(settings, 'CHATBOT_VECTOR_INDEX_PATH', 'vector_index')
+        if not os.path.exists(os.path.join(index_path, 'meta.json')):
+            return []
+        from .vector_index import QuantizedVectorIndex
+        db = QuantizedVectorIndex(index_path)
+    else:
+        chroma_path = getattr(settings, 'CHATBOT_CHROMA_PATH', 'chroma')
+        if not os.path.exists(os.path.join(chroma_path, 'chroma.sqlite3')):
+            return []
+        from langchain_chroma import Chroma
+        db = Chroma(persist_directory=chroma_path)
+
+    try:
+        check_index_provider(db)
+    except ImproperlyConfigured as exc:
+        return [Error(str(exc), id='chatbot.E001')]
+    return []
@@ -0,0 +1,87 @@
+import re
+from collections import namedtuple
+
+from django.conf import settings
+
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+
+# word pieces and punctuation; close enough to mistral's tokenizer for budgeting
+_token = re.compile(r"\w+|[^\w\s]")
+
+Context = namedtuple("Context", ["text", "documents", "tokens", "duplicates", "truncated"])
+
+
+def count_tokens(text):
+    """approximate LLM token count of a piece of text"""
+    return len(_token.findall(text))
+
+
+def shingles(text, size=3):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def is_near_duplicate(candidate, kept, threshold):
+    # overlap relative to the smaller chunk, so a passage repeated inside a
+    # longer chunk also counts as a duplicate
+    for other in kept:
+        smaller = min(len(candidate), len(other)) or 1
+        if len(candidate & other) / smaller >= threshold:
+            return True
+    return False
+
+
+def _truncate(text, max_tokens):
+    # cut at the token boundary, then back off to the last sentence end if any
+    tokens = list(_token.finditer(text))
+    if len(tokens) <= max_tokens:
+        return text
+    cut = text[:tokens[max_tokens - 1].end()]
+    sentence_end = max(cut.rfind(". "), cut.rfind(".\n"))
+    return cut[:sentence_end + 1] if sentence_end > len(cut) // 2 else cut
+
+
+def build_context(results, token_budget=None, duplicate_threshold=None):
+    """
+    join retrieved chunks (best first) into prompt context
+    Near-duplicate chunks are dropped, and chunks are added in rank order
+    until token_budget is used up; the first chunk that does not fit is
+    truncated if a useful amount of budget is left.
+    """
+    if token_budget is None:
+        token_budget = getattr(settings, "CHATBOT_CONTEXT_TOKEN_BUDGET", 1500)
+    if duplicate_threshold is None:
+        duplicate_threshold = getattr(settings, "CHATBOT_CONTEXT_DUPLICATE_THRESHOLD", 0.8)
+    separator_tokens = count_tokens(CONTEXT_SEPARATOR)
+
+    parts = []
+    documents = []
+    kept_shingles = []
+    used = 0
+    duplicates = 0
+    truncated = False
+    for document, _ in results:
+        document_shingles = shingles(document.page_content)
+        if is_near_duplicate(document_shingles, kept_shingles, duplicate_threshold):
+            duplicates += 1
+            continue
+        remaining = token_budget - used - (separator_tokens if parts else 0)
+        tokens = count_tokens(document.page_content)
+        if tokens <= remaining:
+            text = document.page_content
+        elif remaining >= 50:
+            text = _truncate(document.page_content, remaining)
+            tokens = count_tokens(text)
+            truncated = True
+        else:
+            truncated = True
+            break
+        used += tokens + (separator_tokens if parts else 0)
+        parts.append(text)
+        documents.append(document)
+        kept_shingles.append(document_shingles)
+        if truncated:
+            break
+    return Context(CONTEXT_SEPARATOR.join(parts), documents, used, duplicates, truncated)
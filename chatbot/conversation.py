@@ -0,0 +1,142 @@
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from .context import count_tokens
+from .models import ChatMessage, ChatSession
+
+logger = logging.getLogger(__name__)
+
+SESSION_KEY = 'chatbot_session_id'
+# a summariser that has not finished after this long is presumed dead
+SUMMARY_LOCK_TIMEOUT = timedelta(minutes=5)
+
+SUMMARY_PROMPT = """
+Summarise this conversation between a farmer and an agricultural assistant
+in at most {max_words} words. Keep crops, places, quantities and open
+questions; drop greetings.
+
+Summary so far:
+{summary}
+
+New turns:
+{turns}
+"""
+
+
+def _window():
+    return getattr(settings, 'CHATBOT_MEMORY_TURNS', 4)
+
+
+def format_turns(turns):
+    return '\n'.join(f'Farmer: {turn.message}\nAssistant: {turn.response}' for turn in turns)
+
+
+class Conversation:
+    """
+    Bounded memory of one chat session.
+    The prompt sees the rolling summary plus at most CHATBOT_MEMORY_TURNS
+    recent turns. Once twice that many turns are unsummarised the oldest
+    ones are folded into the summary by one LLM call in the background, so
+    prompt size stays flat however long the conversation runs. The summary
+    and the summariser's lock live on the ChatSession row, so every worker
+    process sees the same ones.
+    """
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+
+    @classmethod
+    def for_request(cls, request, create=True):
+        """
+        the conversation of the request's session, started on first use;
+        None when there is none yet and `create` is False
+        """
+        session_id = request.session.get(SESSION_KEY)
+        if session_id is not None and ChatSession.objects.filter(pk=session_id).exists():
+            return cls(session_id)
+        if not create:
+            return None
+        session_id = ChatSession.objects.create().pk
+        request.session[SESSION_KEY] = session_id
+        return cls(session_id)
+
+    def summary(self):
+        """return (summary, id of the last turn it covers)"""
+        return ChatSession.objects.filter(pk=self.session_id).values_list('summary', 'summarized_until').get()
+
+    def _turns_after(self, summarized_until):
+        return ChatMessage.objects.filter(session_id=self.session_id, id__gt=summarized_until)
+
+    def _unsummarized(self, summarized_until, limit):
+        # newest first, at most `limit` rows: the cost does not grow with the conversation
+        return list(self._turns_after(summarized_until).order_by('-id')[:limit])[::-1]
+
+    def history(self):
+        """text for the prompt's history slot; empty for a new conversation"""
+        summary, summarized_until = self.summary()
+        recent = self._unsummarized(summarized_until, _window())
+        if getattr(settings, 'CHATBOT_CHAT_LOG_ASYNC', True):
+            # the previous turn may still be waiting in the chat-log queue
+            from .chat_log import get_chat_log_writer
+            pending = [
+                turn for turn in get_chat_log_writer().pending(self.session_id)
+                if not recent or turn.created_at > recent[-1].created_at
+            ]
+            recent = (recent + pending)[-_window():]
+        if not summary and not recent:
+            return ''
+        parts = ['Conversation so far:']
+        if summary:
+            parts.append(f'Summary: {summary}')
+        if recent:
+            parts.append(format_turns(recent))
+        return '\n'.join(parts) + '\n\n'
+
+    def after_turn(self):
+        """fold the oldest turns into the summary once the window has overflowed"""
+        window = _window()
+        _, summarized_until = self.summary()
+        if self._turns_after(summarized_until).count() <= 2 * window:
+            return
+        # one summariser per session at a time, across worker processes
+        now = timezone.now()
+        claimed = ChatSession.objects.filter(
+            Q(summarizing_since__isnull=True) | Q(summarizing_since__lt=now - SUMMARY_LOCK_TIMEOUT),
+            pk=self.session_id,
+        ).update(summarizing_since=now)
+        if not claimed:
+            return
+        threading.Thread(target=self._summarize, daemon=True).start()
+
+    def _summarize(self):
+        from .runtime import get_runtime
+
+        try:
+            summary, summarized_until = self.summary()
+            # the oldest turns first, so turns left over by a skipped or failed
+            # run are folded in before newer ones; at most 2 * window per call
+            turns = self._turns_after(summarized_until).order_by('id')
+            turns = list(turns[:max(0, min(turns.count() - _window(), 2 * _window()))])
+            if not turns:
+                return
+            max_words = getattr(settings, 'CHATBOT_SUMMARY_MAX_WORDS', 120)
+            prompt = SUMMARY_PROMPT.format(max_words=max_words, summary=summary or '(none)',
+                                           turns=format_turns(turns))
+            summary = get_runtime().components().llm.invoke(prompt).strip()
+            logger.info('session %s summary: %d tokens covering %d new turns',
+                        self.session_id, count_tokens(summary), len(turns))
+            ChatSession.objects.filter(pk=self.session_id, summarized_until=summarized_until).update(
+                summary=summary, summarized_until=turns[-1].pk,
+            )
+        except Exception:
+            logger.exception('summarising chat session %s failed', self.session_id)
+        finally:
+            ChatSession.objects.filter(pk=self.session_id).update(summarizing_since=None)
+            # this thread opened its own DB connection
+            connection.close()
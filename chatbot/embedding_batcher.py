@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher(Embeddings):
+    """
+    Groups embed_query calls from concurrent requests into one
+    embed_documents call.
+    The first query in a batch waits at most `window_ms` for others to join,
+    and a batch never holds more than `max_batch_size` texts. A dispatcher
+    thread is started on demand and exits again after `idle_seconds`
+    without work.
+    """
+
+    def __init__(self, embeddings, window_ms=10, max_batch_size=32, idle_seconds=5.0):
+        self.embeddings = embeddings
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.idle_seconds = idle_seconds
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.queries = 0
+        self.batch_sizes = Counter()
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    # keep model_id/model visible for cache keys and index metadata
+    def __getattr__(self, name):
+        if name == "embeddings":
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    def _submit(self, text):
+        future = Future()
+        self._queue.put((text, time.perf_counter(), future))
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+        return future
+
+    def _next_batch(self):
+        try:
+            first = self._queue.get(timeout=self.idle_seconds)
+        except queue.Empty:
+            return None
+        batch = [first]
+        deadline = first[1] + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                with self._lock:
+                    # only retire while nothing is queued, otherwise a caller
+                    # that just saw this worker alive would never be served
+                    if self._queue.empty():
+                        self._worker = None
+                        return
+                continue
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        started = time.perf_counter()
+        # identical questions in one window are embedded once
+        texts = list(dict.fromkeys(text for text, _, _ in batch))
+        try:
+            vectors = dict(zip(texts, self.embeddings.embed_documents(texts)))
+        except Exception as exc:
+            logger.exception("batched embedding of %d texts failed", len(texts))
+            for _, _, future in batch:
+                future.set_exception(exc)
+            return
+        for text, _, future in batch:
+            future.set_result(vectors[text])
+        with self._stats_lock:
+            self.batches += 1
+            self.queries += len(batch)
+            self.batch_sizes[len(batch)] += 1
+            for _, enqueued, _ in batch:
+                wait = started - enqueued
+                self.queue_wait_total += wait
+                self.queue_wait_max = max(self.queue_wait_max, wait)
+
+    def embed_query(self, text):
+        return self._submit(text).result()
+
+    async def aembed_query(self, text):
+        return await asyncio.wrap_future(self._submit(text))
+
+    def embed_documents(self, texts):
+        # ingestion already sends whole batches
+        return self.embeddings.embed_documents(texts)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "batches": self.batches,
+                "queries": self.queries,
+                "mean_batch_size": self.queries / self.batches if self.batches else 0.0,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "mean_queue_wait_ms": 1000 * self.queue_wait_total / self.queries if self.queries else 0.0,
+                "max_queue_wait_ms": 1000 * self.queue_wait_max,
+                "queued": self._queue.qsize(),
+            }
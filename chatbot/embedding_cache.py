@@ -0,0 +1,236 @@
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from langchain_core.embeddings import Embeddings
+
+from .metrics import event
+
+logger = logging.getLogger(__name__)
+
+_whitespace = re.compile(r"\s+")
+# writes between size checks of the sqlite tier; COUNT(*) scans the table
+DISK_PRUNE_INTERVAL = 1000
+
+
+def normalize_query(text):
+    """
+    normalize a question so trivially different spellings share a cache entry
+    example:
+    "  How do I grow   Rice " -> "how do i grow rice"
+    """
+    return _whitespace.sub(" ", text).strip().lower()
+
+
+def embedding_model_id(embeddings):
+    """return a stable identifier for the model behind an embeddings object"""
+    for attr in ("model_id", "model", "model_name"):
+        value = getattr(embeddings, attr, None)
+        if value:
+            return f"{type(embeddings).__name__}:{value}"
+    return type(embeddings).__name__
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache of query embeddings.
+    Tier 1 is an in-process LRU bounded by max_entries, tier 2 is a sqlite
+    file shared by every worker on the machine, pruned back to
+    max_disk_entries rows, oldest first, every DISK_PRUNE_INTERVAL writes.
+    Keys are sha256(model id + normalized text).
+    """
+
+    def __init__(self, path=None, max_entries=None, max_disk_entries=None):
+        self.path = path
+        self.max_entries = max_entries or 10000
+        self.max_disk_entries = max_disk_entries or 100000
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+        if self.path:
+            conn = self._connection()
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_embedding "
+                "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL DEFAULT 0)"
+            )
+            # files written before rows were timestamped
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(query_embedding)")}
+            if "created_at" not in columns:
+                conn.execute("ALTER TABLE query_embedding ADD COLUMN created_at REAL NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS query_embedding_created_at ON query_embedding (created_at)")
+            conn.commit()
+            self.prune()
+
+    @staticmethod
+    def key(model_id, text):
+        return hashlib.sha256(f"{model_id}\x00{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+    def _connection(self):
+        # sqlite connections cannot be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key, vector):
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        return self.lookup(key)[0]
+
+    def lookup(self, key, disk=True):
+        """
+        return (vector or None, 'memory' | 'disk' | 'miss')
+        With disk=False only the in-process tier is read, without any I/O,
+        and a miss there is not counted.
+        """
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector, "memory"
+        if not disk:
+            return None, "miss"
+        if self.path:
+            try:
+                row = self._connection().execute(
+                    "SELECT vector FROM query_embedding WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error:
+                logger.exception("embedding cache read failed")
+                row = None
+            if row is not None:
+                vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+                self._remember(key, vector)
+                with self._lock:
+                    self.disk_hits += 1
+                return vector, "disk"
+        with self._lock:
+            self.misses += 1
+        return None, "miss"
+
+    def put(self, key, vector):
+        self._remember(key, vector)
+        if self.path:
+            try:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO query_embedding (key, vector, created_at) VALUES (?, ?, ?)",
+                    (key, np.asarray(vector, dtype=np.float32).tobytes(), time.time()),
+                )
+                conn.commit()
+            except sqlite3.Error:
+                logger.exception("embedding cache write failed")
+            with self._lock:
+                self._writes += 1
+                due = self._writes % DISK_PRUNE_INTERVAL == 0
+            if due:
+                self.prune()
+
+    def prune(self):
+        """delete the oldest rows of the sqlite tier beyond max_disk_entries; returns how many"""
+        try:
+            conn = self._connection()
+            (count,) = conn.execute("SELECT COUNT(*) FROM query_embedding").fetchone()
+            excess = count - self.max_disk_entries
+            if excess <= 0:
+                return 0
+            conn.execute(
+                "DELETE FROM query_embedding WHERE key IN "
+                "(SELECT key FROM query_embedding ORDER BY created_at, rowid LIMIT ?)",
+                (excess,),
+            )
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception("embedding cache prune failed")
+            return 0
+        with self._lock:
+            self.disk_evictions += excess
+        return excess
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_evictions": self.disk_evictions,
+            }
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that answers embed_query from an EmbeddingCache.
+    embed_documents (ingestion) is passed straight through.
+    """
+
+    def __init__(self, embeddings, cache, model_id=None):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_id = model_id or embedding_model_id(embeddings)
+
+    def embed_query(self, text):
+        key = self.cache.key(self.model_id, text)
+        vector, tier = self.cache.lookup(key)
+        event(f"embedding_cache_{tier}")
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put(key, vector)
+        return vector
+
+    async def aembed_query(self, text):
+        key = self.cache.key(self.model_id, text)
+        vector, tier = self.cache.lookup(key, disk=False)
+        if vector is None:
+            # sqlite reads and commits can wait up to its 5s busy timeout on
+            # another worker's write; never do that on the event loop
+            vector, tier = await sync_to_async(self.cache.lookup, thread_sensitive=False)(key)
+        event(f"embedding_cache_{tier}")
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            await sync_to_async(self.cache.put, thread_sensitive=False)(key, vector)
+        return vector
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """return the EmbeddingCache shared by this worker"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache(
+                    path=getattr(settings, "CHATBOT_EMBEDDING_CACHE_PATH", None),
+                    max_entries=getattr(settings, "CHATBOT_EMBEDDING_CACHE_SIZE", 10000),
+                    max_disk_entries=getattr(settings, "CHATBOT_EMBEDDING_CACHE_DISK_SIZE", 100000),
+                )
+    return _cache
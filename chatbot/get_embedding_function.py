@@ -1,12 +1,169 @@
-from langchain_community.embeddings.ollama import OllamaEmbeddings
-from langchain_aws.embeddings import BedrockEmbeddings  # Ensure correct import path
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from langchain_core.embeddings import Embeddings
 import logging
+import threading
 
+try:
+    from .embedding_batcher import EmbeddingBatcher
+except ImportError:  # run as a script from chatbot/ (query_data.py)
+    from embedding_batcher import EmbeddingBatcher
 
-def get_embedding_function():
-    embeddings = BedrockEmbeddings(
+logger = logging.getLogger(__name__)
+
+# Collection metadata key that records which provider built a Chroma index
+INDEX_PROVIDER_KEY = "embedding_provider"
+
+
+def _setting(name, default):
+    # also usable from the standalone scripts, where Django is not configured
+    return getattr(settings, name, default) if settings.configured else default
+
+
+#----Provider registry----
+# name -> (factory(model) -> Embeddings, default model)
+EMBEDDING_PROVIDERS = {}
+# providers whose embed_documents embeds a list in one call; Bedrock (Titan)
+# and Ollama loop over the texts, one request each
+BATCHING_PROVIDERS = set()
+
+
+def register_provider(name, default_model, batches=False):
+    def decorator(factory):
+        EMBEDDING_PROVIDERS[name] = (factory, default_model)
+        if batches:
+            BATCHING_PROVIDERS.add(name)
+        return factory
+    return decorator
+
+
+@register_provider("bedrock", "amazon.titan-embed-text-v2:0")
+def bedrock_embeddings(model):
+    from langchain_aws.embeddings import BedrockEmbeddings  # Ensure correct import path
+    return BedrockEmbeddings(
         credentials_profile_name="default",
-        region_name="eu-west-2",
-        model_id="amazon.titan-embed-text-v2:0"  # Correct parameter
+        region_name=_setting("CHATBOT_BEDROCK_REGION", "eu-west-2"),
+        model_id=model  # Correct parameter
+    )
+
+
+@register_provider("ollama", "nomic-embed-text")
+def ollama_embeddings(model):
+    from langchain_community.embeddings.ollama import OllamaEmbeddings
+    base_url = _setting("CHATBOT_EMBEDDING_BASE_URL", None) or _setting(
+        "CHATBOT_OLLAMA_BASE_URL", "http://localhost:11434"
     )
+    return OllamaEmbeddings(model=model, base_url=base_url)
+
+
+@register_provider("local", "sentence-transformers/all-MiniLM-L6-v2", batches=True)
+def local_embeddings(model):
+    return LocalEmbeddings(model)
+
+
+_local_models = {}
+_local_models_lock = threading.Lock()
+
+
+def _load_local_model(model):
+    # weights are loaded once per process and shared by every LocalEmbeddings
+    with _local_models_lock:
+        if model not in _local_models:
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError:
+                raise ImproperlyConfigured(
+                    "The 'local' embedding provider needs the sentence-transformers package"
+                )
+            _local_models[model] = SentenceTransformer(model, device="cpu")
+        return _local_models[model]
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    Embeddings computed on the CPU of this machine with sentence-transformers,
+    so neither questions nor documents leave the box.
+    Inputs are encoded in batches of `batch_size`; a lock serialises access
+    to the shared model.
+    """
+
+    def __init__(self, model, batch_size=64):
+        self.model = model
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        encoder = _load_local_model(self.model)
+        with self._lock:
+            vectors = encoder.encode(
+                list(texts), batch_size=self.batch_size, normalize_embeddings=True, show_progress_bar=False
+            )
+        return vectors.tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def get_embedding_provider_id(provider=None):
+    """
+    return "<provider>:<model>" for the configured embedding provider,
+    the value recorded with the Chroma collection
+    """
+    provider = provider or _setting("CHATBOT_EMBEDDING_PROVIDER", "bedrock")
+    if provider not in EMBEDDING_PROVIDERS:
+        raise ImproperlyConfigured(
+            f"Unknown embedding provider {provider!r}, choose one of {sorted(EMBEDDING_PROVIDERS)}"
+        )
+    _, default_model = EMBEDDING_PROVIDERS[provider]
+    return f"{provider}:{_setting('CHATBOT_EMBEDDING_MODEL', None) or default_model}"
+
+
+def get_embedding_function(batched=None, provider=None):
+    provider, model = get_embedding_provider_id(provider).split(":", 1)
+    factory, _ = EMBEDDING_PROVIDERS[provider]
+    embeddings = factory(model)
+    if batched is None:
+        batched = _setting("CHATBOT_EMBEDDING_BATCHING", False)
+    if batched and provider not in BATCHING_PROVIDERS:
+        # the single dispatcher thread would turn parallel requests into
+        # back-to-back ones
+        logger.warning("%s embeddings have no batch call; CHATBOT_EMBEDDING_BATCHING ignored", provider)
+        batched = False
+    if batched:
+        # Concurrent queries arriving within a few ms share one embed_documents call.
+        embeddings = EmbeddingBatcher(
+            embeddings,
+            window_ms=_setting("CHATBOT_EMBEDDING_BATCH_WINDOW_MS", 10),
+            max_batch_size=_setting("CHATBOT_EMBEDDING_BATCH_MAX_SIZE", 32),
+        )
     return embeddings
+
+
+def check_index_provider(db, provider_id=None):
+    """
+    make sure the Chroma collection was built with the configured embedding
+    provider; vectors from another model would silently return nonsense
+    """
+    provider_id = provider_id or get_embedding_provider_id()
+    metadata = db._collection.metadata or {}
+    recorded = metadata.get(INDEX_PROVIDER_KEY)
+    if recorded is None:
+        logger.warning(
+            "Chroma collection has no %s recorded; assuming it matches %s", INDEX_PROVIDER_KEY, provider_id
+        )
+    elif recorded != provider_id:
+        raise ImproperlyConfigured(
+            f"Chroma index was built with {recorded} but CHATBOT_EMBEDDING_PROVIDER gives {provider_id}; "
+            "run `manage.py ingest_chroma --rebuild` or change the setting"
+        )
+
+
+def record_index_provider(db, provider_id=None):
+    """store the embedding provider in the Chroma collection metadata"""
+    provider_id = provider_id or get_embedding_provider_id()
+    # chromadb refuses to modify the hnsw:* settings of an existing collection
+    metadata = {
+        key: value for key, value in (db._collection.metadata or {}).items() if not key.startswith("hnsw:")
+    }
+    metadata[INDEX_PROVIDER_KEY] = provider_id
+    db._collection.modify(metadata=metadata)
@@ -0,0 +1,67 @@
+import threading
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .tools import classifier_loaded, get_classifier
+
+
+class RouteStats:
+    """counts and total latency per route ('intent', 'rag', ...)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = defaultdict(int)
+        self._seconds = defaultdict(float)
+
+    def record(self, route, seconds):
+        with self._lock:
+            self._counts[route] += 1
+            self._seconds[route] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                route: {
+                    "count": count,
+                    "mean_ms": 1000 * self._seconds[route] / count,
+                }
+                for route, count in self._counts.items()
+            }
+
+
+route_stats = RouteStats()
+
+# the intents.json tags that are safe to answer without looking anything up
+SMALL_TALK_TAGS = ("greeting", "goodbye", "thanks")
+
+
+def intent_answer(message):
+    """
+    return a canned reply from intents.json when the intent model is
+    confident about the message, otherwise None so the caller falls
+    through to RAG
+    """
+    if not getattr(settings, "CHATBOT_INTENT_ROUTING", True):
+        return None
+    classifier = get_classifier()
+    [(tag, prob, coverage)] = classifier.classify([message])
+    # data.pth is trained on small talk and a shop's FAQ: "how long does rice
+    # take to grow" scores high for 'delivery' on the words it does know, so
+    # only small-talk tags may answer, and only when it knows (nearly) every word
+    if prob < getattr(settings, "CHATBOT_INTENT_THRESHOLD", 0.75):
+        return None
+    if coverage < getattr(settings, "CHATBOT_INTENT_MIN_COVERAGE", 0.9):
+        return None
+    allowed = getattr(settings, "CHATBOT_INTENT_TAGS", SMALL_TALK_TAGS)
+    if allowed is not None and tag not in allowed:
+        return None
+    return classifier.respond(tag)
+
+
+async def aintent_answer(message):
+    """intent_answer for async views; the first call loads the model off the event loop"""
+    if getattr(settings, "CHATBOT_INTENT_ROUTING", True) and not classifier_loaded():
+        await sync_to_async(get_classifier, thread_sensitive=False)()
+    return intent_answer(message)
@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+
+import requests
+from django.conf import settings
+from langchain_core.callbacks import BaseCallbackHandler
+
+from .metrics import add_stage, note
+
+logger = logging.getLogger(__name__)
+
+NANOSECONDS = 1e9
+
+
+def _seconds(info, key):
+    value = (info or {}).get(key)
+    return value / NANOSECONDS if value is not None else None
+
+
+class OllamaTimings(BaseCallbackHandler):
+    """
+    Record the timings Ollama reports with each generation on the current
+    request trace: llm_load is the model cold-load (near zero while the model
+    is resident), llm_prompt_eval the server-side prefill, and
+    prompt_eval_tokens how many prompt tokens were actually evaluated, which
+    drops when the shared prompt prefix is reused from the KV cache.
+    """
+
+    run_inline = True
+
+    def on_llm_end(self, response, **kwargs):
+        try:
+            info = response.generations[0][0].generation_info
+        except (AttributeError, IndexError):
+            return
+        load = _seconds(info, "load_duration")
+        if load is not None:
+            add_stage("llm_load", load)
+        prompt_eval = _seconds(info, "prompt_eval_duration")
+        if prompt_eval is not None:
+            add_stage("llm_prompt_eval", prompt_eval)
+        if (info or {}).get("prompt_eval_count") is not None:
+            note("prompt_eval_tokens", info["prompt_eval_count"])
+
+
+class OllamaKeepAlive:
+    """
+    Keeps the chat model resident in Ollama.
+    preload() loads the model and evaluates `prefix`, the static start of
+    every RAG prompt, so the first real question finds both the weights and
+    the prefix's KV cache warm. The heartbeat thread then repeats a
+    prompt-less load request every `interval` seconds, renewing Ollama's
+    keep_alive timer before it can unload the model (interval 0 only preloads).
+    """
+
+    def __init__(self, base_url, model, keep_alive="30m", interval=240, prefix="", timeout=300):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.keep_alive = keep_alive
+        self.interval = interval
+        self.prefix = prefix
+        self.timeout = timeout
+        self._stop = threading.Event()
+        self._thread = None
+        self.preloads = 0
+        self.failures = 0
+        self.last = None
+
+    def _load(self, prompt):
+        payload = {"model": self.model, "keep_alive": self.keep_alive, "stream": False}
+        if prompt:
+            payload.update(prompt=prompt, options={"num_predict": 1})
+        started = time.perf_counter()
+        response = requests.post(f"{self.base_url}/api/generate", json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        info = response.json()
+        self.preloads += 1
+        self.last = {
+            "at": time.time(),
+            "seconds": time.perf_counter() - started,
+            "load_seconds": _seconds(info, "load_duration"),
+            "prompt_eval_seconds": _seconds(info, "prompt_eval_duration"),
+            "prompt_eval_tokens": info.get("prompt_eval_count"),
+        }
+        return self.last
+
+    def preload(self):
+        """load the model and prime the prompt prefix; returns Ollama's timings"""
+        timings = self._load(self.prefix)
+        logger.info(
+            "Ollama model %s preloaded in %.2fs (cold load %.2fs, prefix prefill %.2fs over %s tokens)",
+            self.model, timings["seconds"], timings["load_seconds"] or 0.0,
+            timings["prompt_eval_seconds"] or 0.0, timings["prompt_eval_tokens"],
+        )
+        return timings
+
+    def heartbeat(self):
+        return self._load("")
+
+    def _run(self):
+        try:
+            self.preload()
+        except requests.RequestException as exc:
+            self.failures += 1
+            logger.warning("preloading Ollama model %s failed: %s", self.model, exc)
+        while self.interval and not self._stop.wait(self.interval):
+            try:
+                timings = self.heartbeat()
+            except requests.RequestException as exc:
+                self.failures += 1
+                logger.warning("Ollama keep-alive for %s failed: %s", self.model, exc)
+                continue
+            if (timings["load_seconds"] or 0.0) > 1.0:
+                logger.info("Ollama had unloaded %s; reloaded in %.2fs", self.model, timings["load_seconds"])
+
+    def start(self):
+        """preload now and keep the model resident from a daemon thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="chatbot-ollama-keepalive", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            "url": self.base_url,
+            "model": self.model,
+            "keep_alive": self.keep_alive,
+            "interval_seconds": self.interval,
+            "running": self._thread is not None and self._thread.is_alive(),
+            "preloads": self.preloads,
+            "failures": self.failures,
+            "last": self.last,
+        }
+
+
+_keepalives = None
+_keepalives_lock = threading.Lock()
+
+
+def get_keepalives():
+    """return this worker's OllamaKeepAlive for each Ollama server of the chat model"""
+    global _keepalives
+    if _keepalives is None:
+        with _keepalives_lock:
+            if _keepalives is None:
+                from .runtime import PROMPT_PREFIX, ollama_backends
+
+                _keepalives = [
+                    OllamaKeepAlive(
+                        base_url=url,
+                        model=getattr(settings, "CHATBOT_LLM_MODEL", "mistral"),
+                        keep_alive=getattr(settings, "CHATBOT_LLM_KEEP_ALIVE", "30m"),
+                        interval=getattr(settings, "CHATBOT_LLM_HEARTBEAT_SECONDS", 240),
+                        prefix=PROMPT_PREFIX,
+                    )
+                    for url in ollama_backends()
+                ]
+    return _keepalives
@@ -0,0 +1,151 @@
+import hashlib
+import itertools
+import logging
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from langchain_core.documents import Document
+
+from .tagging import matches
+
+logger = logging.getLogger(__name__)
+
+# words, numbers and hyphen/dot compounds such as "npk-20" or "2.5" stay whole
+_token = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+
+
+def tokenize(text):
+    return _token.findall(text.lower())
+
+
+def chunk_key(document):
+    """the id query_rag reports for a chunk, or a hash of its text if it has none"""
+    return document.metadata.get("id") or hashlib.sha256(document.page_content.encode("utf-8")).hexdigest()
+
+
+def reciprocal_rank_fusion(result_lists, k=60):
+    """
+    fuse several ranked [(document, score), ...] lists into one
+    score(d) = sum over lists of 1 / (k + rank of d in that list)
+    """
+    scores = defaultdict(float)
+    documents = {}
+    for results in result_lists:
+        for rank, (document, _) in enumerate(results, start=1):
+            key = chunk_key(document)
+            scores[key] += 1.0 / (k + rank)
+            documents.setdefault(key, document)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [(documents[key], scores[key]) for key in ranked]
+
+
+class BM25Index:
+    """
+    In-process Okapi BM25 index over the chunks of the Chroma collection.
+    sync() brings it up to date with the collection, re-tokenizing only
+    chunks that were added or changed since the last sync.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = defaultdict(dict)  # term -> {chunk id: term frequency}
+        self._lengths = {}                  # chunk id -> number of tokens
+        self._hashes = {}                   # chunk id -> content hash
+        self._terms = {}                    # chunk id -> distinct terms, for removal
+        self._documents = {}                # chunk id -> Document
+        self._total_length = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def _remove(self, chunk_id):
+        for term in self._terms.pop(chunk_id):
+            postings = self._postings[term]
+            postings.pop(chunk_id, None)
+            if not postings:
+                del self._postings[term]
+        self._total_length -= self._lengths.pop(chunk_id)
+        del self._hashes[chunk_id]
+        del self._documents[chunk_id]
+
+    def add(self, chunk_id, text, metadata=None, content_hash=None):
+        with self._lock:
+            if chunk_id in self._lengths:
+                self._remove(chunk_id)
+            counts = Counter(tokenize(text))
+            for term, frequency in counts.items():
+                self._postings[term][chunk_id] = frequency
+            length = sum(counts.values())
+            self._lengths[chunk_id] = length
+            self._total_length += length
+            self._hashes[chunk_id] = content_hash
+            self._terms[chunk_id] = tuple(counts)
+            self._documents[chunk_id] = Document(page_content=text, metadata=dict(metadata or {}))
+
+    def remove(self, chunk_id):
+        with self._lock:
+            if chunk_id in self._lengths:
+                self._remove(chunk_id)
+
+    def sync(self, collection, page_size=5000):
+        """update the index from a Chroma collection; returns (added or changed, removed)"""
+        start = time.perf_counter()
+        seen = set()
+        changed = 0
+        offset = 0
+        while True:
+            page = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+            for chunk_id, text, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+                metadata = metadata or {}
+                content_hash = metadata.get("content_hash") or hashlib.sha256(text.encode("utf-8")).hexdigest()
+                # retagging changes only the metadata the filters read
+                if metadata.get("tag_version"):
+                    content_hash = f"{content_hash}:{metadata['tag_version']}"
+                seen.add(chunk_id)
+                if self._hashes.get(chunk_id) != content_hash:
+                    self.add(chunk_id, text, metadata, content_hash)
+                    changed += 1
+            if len(page["ids"]) < page_size:
+                break
+            offset += page_size
+        with self._lock:
+            removed = [chunk_id for chunk_id in self._lengths if chunk_id not in seen]
+            for chunk_id in removed:
+                self._remove(chunk_id)
+        logger.info(
+            "BM25 index synced in %.2fs: %d added or changed, %d removed, %d chunks",
+            time.perf_counter() - start, changed, len(removed), len(self),
+        )
+        return changed, len(removed)
+
+    def search(self, query_text, k=5, where=None):
+        """
+        return up to k [(document, bm25 score), ...] best first, only from
+        chunks whose metadata satisfies the Chroma-style filter `where`
+        """
+        terms = set(tokenize(query_text))
+        with self._lock:
+            n = len(self._lengths)
+            if not n or not terms:
+                return []
+            average_length = self._total_length / n
+            scores = defaultdict(float)
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for chunk_id, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[chunk_id] / average_length)
+                    scores[chunk_id] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+            ranked = sorted(scores, key=scores.get, reverse=True)
+            if where is not None:
+                # check the filter best first, stopping once k chunks pass
+                ranked = (chunk_id for chunk_id in ranked if matches(self._documents[chunk_id].metadata, where))
+            best = itertools.islice(ranked, k)
+            return [(self._documents[chunk_id], scores[chunk_id]) for chunk_id in best]
@@ -0,0 +1,237 @@
+import logging
+import threading
+import time
+
+import requests
+
+from .metrics import LATENCY_BUCKETS_MS, Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class Backend:
+    """one Ollama server in an OllamaPool, with its load and health"""
+
+    def __init__(self, url, llm):
+        self.url = url.rstrip("/")
+        self.llm = llm
+        self.outstanding = 0
+        self.ejected = False
+        self.ejected_at = None
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+        # smoothed seconds per call, the tie-break between equally busy backends
+        self.mean_seconds = 0.0
+        self.first_chunk_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.total_ms = Histogram(LATENCY_BUCKETS_MS)
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "healthy": not self.ejected,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "ejections": self.ejections,
+            "consecutive_failures": self.consecutive_failures,
+            "first_chunk_ms": self.first_chunk_ms.snapshot(),
+            "total_ms": self.total_ms.snapshot(),
+        }
+
+
+class OllamaPool:
+    """
+    Spreads LLM calls over several Ollama servers.
+    Each call goes to the healthy backend with the fewest requests in
+    flight (least outstanding requests), ties going to the one that has
+    been answering fastest. A backend that fails `max_failures` calls in a
+    row is ejected; a background health check polls every backend's
+    /api/tags every `health_check_seconds`, ejecting the ones that do not
+    answer and re-admitting the ones that recover. A call that fails before
+    producing any output is retried on the next backend. Without health
+    checks an ejected backend is only used again when every backend is
+    ejected. Offers the invoke/stream/ainvoke/astream subset of the
+    LangChain LLM interface.
+    """
+
+    def __init__(self, backends, max_failures=3, health_check_seconds=10, health_check_timeout=2):
+        if not backends:
+            raise ValueError("OllamaPool needs at least one backend")
+        self.backends = [Backend(url, llm) for url, llm in backends]
+        self.max_failures = max_failures
+        self.health_check_seconds = health_check_seconds
+        self.health_check_timeout = health_check_timeout
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if health_check_seconds:
+            self._thread = threading.Thread(target=self._health_loop, name="chatbot-llm-health", daemon=True)
+            self._thread.start()
+
+    def __getattr__(self, name):
+        if name == "backends":
+            raise AttributeError(name)
+        return getattr(self.backends[0].llm, name)
+
+    #----Balancing----
+    def _acquire(self, exclude=()):
+        with self._lock:
+            candidates = [b for b in self.backends if not b.ejected and b not in exclude]
+            if not candidates:
+                # everything is ejected: keep trying rather than fail every request
+                candidates = [b for b in self.backends if b not in exclude]
+            if not candidates:
+                return None
+            backend = min(candidates, key=lambda b: (b.outstanding, b.mean_seconds))
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def _release(self, backend, started, first_chunk=None, failed=False):
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            backend.outstanding -= 1
+            if failed:
+                backend.errors += 1
+                backend.consecutive_failures += 1
+                if backend.consecutive_failures >= self.max_failures and not backend.ejected:
+                    self._eject(backend, f"{backend.consecutive_failures} failed calls in a row")
+                return
+            backend.consecutive_failures = 0
+            if backend.mean_seconds:
+                elapsed_mean = 0.8 * backend.mean_seconds + 0.2 * elapsed
+            else:
+                elapsed_mean = elapsed
+            backend.mean_seconds = elapsed_mean
+            backend.total_ms.observe(1000 * elapsed)
+            if first_chunk is not None:
+                backend.first_chunk_ms.observe(1000 * (first_chunk - started))
+
+    def _eject(self, backend, reason):
+        backend.ejected = True
+        backend.ejected_at = time.time()
+        backend.ejections += 1
+        logger.warning("LLM backend %s ejected: %s", backend.url, reason)
+
+    def _readmit(self, backend):
+        backend.ejected = False
+        backend.consecutive_failures = 0
+        logger.info("LLM backend %s re-admitted after %.0fs", backend.url, time.time() - backend.ejected_at)
+
+    #----Health checks----
+    def check(self, backend):
+        try:
+            response = requests.get(f"{backend.url}/api/tags", timeout=self.health_check_timeout)
+            response.raise_for_status()
+        except requests.RequestException as exc:
+            with self._lock:
+                if not backend.ejected:
+                    self._eject(backend, f"health check failed: {exc}")
+            return False
+        with self._lock:
+            if backend.ejected:
+                self._readmit(backend)
+        return True
+
+    def _health_loop(self):
+        while not self._stop.wait(self.health_check_seconds):
+            for backend in self.backends:
+                self.check(backend)
+
+    def close(self):
+        self._stop.set()
+
+    #----LLM interface----
+    def _attempts(self):
+        tried = []
+        while len(tried) < len(self.backends):
+            backend = self._acquire(exclude=tried)
+            if backend is None:
+                return
+            tried.append(backend)
+            yield backend, len(tried) == len(self.backends)
+
+    def invoke(self, prompt, **kwargs):
+        for backend, last in self._attempts():
+            started = time.perf_counter()
+            try:
+                result = backend.llm.invoke(prompt, **kwargs)
+            except Exception as exc:
+                self._release(backend, started, failed=True)
+                if last:
+                    raise
+                logger.warning("LLM backend %s failed (%s), retrying elsewhere", backend.url, exc)
+                continue
+            self._release(backend, started)
+            return result
+
+    def stream(self, prompt, **kwargs):
+        for backend, last in self._attempts():
+            started = time.perf_counter()
+            first_chunk = None
+            try:
+                for chunk in backend.llm.stream(prompt, **kwargs):
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter()
+                    yield chunk
+            except Exception as exc:
+                self._release(backend, started, failed=True)
+                # once output has reached the client it cannot be taken back
+                if last or first_chunk is not None:
+                    raise
+                logger.warning("LLM backend %s failed (%s), retrying elsewhere", backend.url, exc)
+                continue
+            except BaseException:
+                # the consumer closed the stream early
+                self._release(backend, started, first_chunk)
+                raise
+            self._release(backend, started, first_chunk)
+            return
+
+    async def ainvoke(self, prompt, **kwargs):
+        for backend, last in self._attempts():
+            started = time.perf_counter()
+            try:
+                result = await backend.llm.ainvoke(prompt, **kwargs)
+            except Exception as exc:
+                self._release(backend, started, failed=True)
+                if last:
+                    raise
+                logger.warning("LLM backend %s failed (%s), retrying elsewhere", backend.url, exc)
+                continue
+            except BaseException:
+                self._release(backend, started)
+                raise
+            self._release(backend, started)
+            return result
+
+    async def astream(self, prompt, **kwargs):
+        for backend, last in self._attempts():
+            started = time.perf_counter()
+            first_chunk = None
+            try:
+                async for chunk in backend.llm.astream(prompt, **kwargs):
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter()
+                    yield chunk
+            except Exception as exc:
+                self._release(backend, started, failed=True)
+                if last or first_chunk is not None:
+                    raise
+                logger.warning("LLM backend %s failed (%s), retrying elsewhere", backend.url, exc)
+                continue
+            except BaseException:
+                # closed early or cancelled
+                self._release(backend, started, first_chunk)
+                raise
+            self._release(backend, started, first_chunk)
+            return
+
+    def stats(self):
+        with self._lock:
+            return {
+                "healthy": sum(not b.ejected for b in self.backends),
+                "backends": [b.stats() for b in self.backends],
+            }
@@ -0,0 +1,294 @@
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CROPS = ['rice', 'wheat', 'maize', 'cotton', 'sugarcane', 'chickpea', 'banana', 'mango', 'coffee', 'jute']
+TOPICS = {
+    'fertiliser': 'apply {n} kg of nitrogen per hectare in split doses, with phosphorus at sowing',
+    'irrigation': 'irrigate every {n} days during flowering and keep the soil moist but not waterlogged',
+    'pests': 'scout weekly for stem borer and aphids and spray neem oil when {n} percent of plants are hit',
+    'sowing': 'sow after the first rains at a spacing of {n} cm between rows',
+    'harvest': 'harvest when {n} percent of the grains or fruits have matured and dry before storage',
+}
+QUESTIONS = [
+    'How much fertiliser does {crop} need per hectare?',
+    'When should I irrigate {crop} during flowering?',
+    'What pests attack {crop} and how do I control them?',
+    'What spacing should I use when sowing {crop}?',
+    'When is {crop} ready to harvest and how should I store it?',
+]
+
+
+def synthetic_corpus(size=500, seed=0):
+    """[(chunk id, text)] of short agronomy notes to index for a load test"""
+    rng = random.Random(seed)
+    chunks = []
+    for index in range(size):
+        crop = CROPS[index % len(CROPS)]
+        topic = rng.choice(sorted(TOPICS))
+        advice = TOPICS[topic].format(n=rng.randint(5, 120))
+        chunks.append((f'loadtest/{crop}.txt:0:{index}', f'{crop.title()} {topic}: for {crop} {advice}.'))
+    return chunks
+
+
+def synthetic_questions(seed=0):
+    rng = random.Random(seed)
+    questions = [template.format(crop=crop) for template in QUESTIONS for crop in CROPS]
+    rng.shuffle(questions)
+    return questions
+
+
+def stub_vector(text, dimensions):
+    """deterministic unit vector for a text; equal texts embed equally"""
+    rng = random.Random(hashlib.sha256(text.encode('utf-8')).digest())
+    vector = [rng.gauss(0.0, 1.0) for _ in range(dimensions)]
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class _StubOllamaHandler(BaseHTTPRequestHandler):
+    # HTTP/1.0: the body ends when the connection closes, so generation can
+    # be streamed line by line without chunked encoding
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self._json({'models': [{'name': self.server.model}]})
+        else:
+            self._json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        self.server.requests += 1
+        if self.server.failure_rate and random.random() < self.server.failure_rate:
+            self._json({'error': 'injected failure'}, status=500)
+        elif self.path == '/api/embeddings':
+            time.sleep(self.server.latency)
+            self._json({'embedding': stub_vector(payload.get('prompt', ''), self.server.dimensions)})
+        elif self.path == '/api/embed':
+            time.sleep(self.server.latency)
+            texts = payload.get('input', [])
+            texts = [texts] if isinstance(texts, str) else texts
+            self._json({'embeddings': [stub_vector(text, self.server.dimensions) for text in texts]})
+        elif self.path == '/api/generate':
+            self._generate(payload)
+        else:
+            self._json({'error': 'not found'}, status=404)
+
+    def _generate(self, payload):
+        server = self.server
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        load = 0.0
+        if not server.loaded:
+            load = server.cold_start
+            time.sleep(load)
+            server.loaded = True
+        prompt = payload.get('prompt', '').split()
+        if not prompt:
+            # a preload or keep-alive request: load the model, generate nothing
+            self.wfile.write(json.dumps({'model': server.model, 'response': '', 'done': True,
+                                         'load_duration': int(load * 1e9)}).encode() + b'\n')
+            return
+        # prefill grows with the prompt tokens not already in the KV cache,
+        # which holds the previous prompt like a single llama.cpp slot
+        with server.cache_lock:
+            reused = 0
+            for cached, word in zip(server.cached_prompt, prompt):
+                if cached != word:
+                    break
+                reused += 1
+            server.cached_prompt = prompt
+        evaluated = len(prompt) - reused
+        prefill = evaluated / server.prefill_tokens_per_second
+        time.sleep(server.latency + prefill)
+        stream = payload.get('stream', True)
+        count = (payload.get('options') or {}).get('num_predict') or server.response_tokens
+        words = []
+        for index in range(count):
+            word = f'token{index} '
+            words.append(word)
+            if stream:
+                line = {'model': server.model, 'response': word, 'done': False}
+                self.wfile.write(json.dumps(line).encode() + b'\n')
+                self.wfile.flush()
+            time.sleep(1.0 / server.tokens_per_second)
+        final = {'model': server.model, 'response': '' if stream else ''.join(words), 'done': True,
+                 'load_duration': int(load * 1e9), 'prompt_eval_count': evaluated,
+                 'prompt_eval_duration': int(prefill * 1e9), 'eval_count': count}
+        self.wfile.write(json.dumps(final).encode() + b'\n')
+
+
+class StubOllamaServer(ThreadingHTTPServer):
+    """
+    Local stand-in for an Ollama server, for load tests without a GPU.
+    Speaks /api/generate (streamed NDJSON), /api/embeddings, /api/embed and
+    /api/tags. The first generate call pays `cold_start` to "load the
+    model". `latency` is added to every call; generation then takes prompt
+    tokens not shared with the previous prompt / prefill_tokens_per_second
+    before the first token and 1 / tokens_per_second per token after it.
+    Embeddings are deterministic unit vectors of `dimensions`. Attributes may
+    be changed while running.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, tokens_per_second=50.0, prefill_tokens_per_second=2000.0,
+                 response_tokens=64, dimensions=256, failure_rate=0.0, cold_start=0.0, model='stub'):
+        super().__init__(('127.0.0.1', 0), _StubOllamaHandler)
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.response_tokens = response_tokens
+        self.dimensions = dimensions
+        self.failure_rate = failure_rate
+        self.cold_start = cold_start
+        self.model = model
+        self.loaded = False
+        self.cached_prompt = []
+        self.cache_lock = threading.Lock()
+        self.requests = 0
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def percentile(values, q):
+    """q-th percentile (0-100) by linear interpolation, None for no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100.0
+    lower = math.floor(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(values):
+    """count, mean and p50/p95/p99/max of a list of milliseconds"""
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+class TraceCollector:
+    """keeps the raw stage timings of every finished request trace"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_ms = defaultdict(list)
+        self.values = defaultdict(list)
+        self.events = Counter()
+        self.routes = Counter()
+
+    def __call__(self, trace):
+        with self._lock:
+            self.routes[trace.route] += 1
+            self.stage_ms['total'].append(1000 * trace.total())
+            for name, seconds in trace.stages.items():
+                self.stage_ms[name].append(1000 * seconds)
+            for name, value in trace.values.items():
+                self.values[name].append(value)
+            self.events.update(trace.events)
+
+    def report(self):
+        with self._lock:
+            return {
+                'routes': dict(self.routes),
+                'stages_ms': {name: summarize(values) for name, values in sorted(self.stage_ms.items())},
+                'sizes': {name: summarize(values) for name, values in sorted(self.values.items())},
+                'events': dict(self.events),
+            }
+
+
+def drive(questions, concurrency, requests=None, duration=None, turns_per_session=1, path='/chatbot/'):
+    """
+    POST questions to the chat view from `concurrency` threads, each with its
+    own django.test.Client (its own session, so conversations are kept for
+    `turns_per_session` turns), until `requests` were sent or `duration`
+    seconds passed; return (latencies in ms, Counter of outcomes, seconds)
+    """
+    from django.db import connections
+    from django.test import Client
+
+    lock = threading.Lock()
+    sent = [0]
+    latencies = []
+    outcomes = Counter()
+    deadline = time.perf_counter() + duration if duration else None
+
+    def next_index():
+        with lock:
+            if requests is not None and sent[0] >= requests:
+                return None
+            if deadline is not None and time.perf_counter() >= deadline:
+                return None
+            sent[0] += 1
+            return sent[0] - 1
+
+    def worker():
+        client, turns = Client(), 0
+        try:
+            while True:
+                index = next_index()
+                if index is None:
+                    return
+                if turns >= turns_per_session:
+                    client, turns = Client(), 0
+                turns += 1
+                started = time.perf_counter()
+                try:
+                    response = client.post(path, {'message': questions[index % len(questions)]})
+                    outcome = 'ok' if response.status_code == 200 else f'http_{response.status_code}'
+                except Exception as exc:
+                    outcome = f'exception_{type(exc).__name__}'
+                elapsed = 1000 * (time.perf_counter() - started)
+                with lock:
+                    outcomes[outcome] += 1
+                    if outcome == 'ok':
+                        latencies.append(elapsed)
+        finally:
+            connections.close_all()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, outcomes, time.perf_counter() - started
@@ -0,0 +1,94 @@
+import gzip
+import json
+import os
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from chatbot.models import ChatMessage, ChatQueryMessage, ChatSession
+
+# model, the timestamp that ages it, columns kept in the archive, extra condition
+ARCHIVED = [
+    (ChatQueryMessage, 'created_at', ['id', 'session_id', 'message', 'response', 'created_at'], Q()),
+    (ChatMessage, 'created_at', ['id', 'session_id', 'message', 'response', 'created_at'], Q()),
+    # a session goes once all of its turns have been archived
+    (ChatSession, 'created_at', ['id', 'summary', 'summarized_until', 'created_at', 'updated_at'],
+     Q(messages__isnull=True, queries__isnull=True)),
+]
+
+
+def archive_file(archive_path, model, month):
+    return os.path.join(archive_path, f'{model._meta.db_table}-{month}.jsonl.gz')
+
+
+def archive_rows(model, date_field, fields, cutoff, archive_path, condition=Q(), batch_size=5000, dry_run=False):
+    """
+    move rows whose `date_field` is before `cutoff` into gzipped JSON-lines
+    files, one per table and month, oldest first and one batch at a time;
+    returns {month: rows archived}
+    A batch is appended and fsynced before it is deleted, so an interruption
+    can at worst leave a batch in both places (archived again on the next run).
+    """
+    archived = defaultdict(int)
+    rows = model.objects.filter(condition, **{f'{date_field}__lt': cutoff}).order_by(date_field, 'id')
+    last = None
+    while True:
+        page = rows
+        if dry_run and last is not None:
+            # nothing is deleted in a dry run, so page past what was counted
+            after, last_id = last
+            page = rows.filter(Q(**{f'{date_field}__gt': after}) | Q(**{date_field: after, 'id__gt': last_id}))
+        batch = list(page.values(*fields)[:batch_size])
+        if not batch:
+            return archived
+        by_month = defaultdict(list)
+        for row in batch:
+            by_month[row[date_field].strftime('%Y-%m')].append(row)
+        if not dry_run:
+            for month, month_rows in by_month.items():
+                # appending adds a gzip member; gzip readers see one stream
+                with open(archive_file(archive_path, model, month), 'ab') as raw:
+                    with gzip.GzipFile(fileobj=raw, mode='ab') as f:
+                        for row in month_rows:
+                            f.write(json.dumps(row, cls=DjangoJSONEncoder).encode('utf-8') + b'\n')
+                    raw.flush()
+                    os.fsync(raw.fileno())
+            with transaction.atomic():
+                model.objects.filter(id__in=[row['id'] for row in batch]).delete()
+        for month, month_rows in by_month.items():
+            archived[month] += len(month_rows)
+        last = (batch[-1][date_field], batch[-1]['id'])
+
+
+class Command(BaseCommand):
+    help = ('Move chat logs and sessions older than the retention period into gzipped monthly archive files; '
+            'run it daily from cron or a systemd timer')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=getattr(settings, 'CHATBOT_CHAT_LOG_RETENTION_DAYS', 90),
+                            help='Keep this many days of chat logs in the database')
+        parser.add_argument('--archive-path',
+                            default=getattr(settings, 'CHATBOT_CHAT_LOG_ARCHIVE_PATH', 'chat_archive'))
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--dry-run', action='store_true', help='Count what would be archived, change nothing')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        os.makedirs(options['archive_path'], exist_ok=True)
+        for model, date_field, fields, condition in ARCHIVED:
+            archived = archive_rows(model, date_field, fields, cutoff, options['archive_path'], condition,
+                                    batch_size=options['batch_size'], dry_run=options['dry_run'])
+            for month, count in sorted(archived.items()):
+                self.stdout.write(f'{model._meta.db_table} {month}: {count} rows')
+            self.stdout.write(f'{model._meta.db_table}: {sum(archived.values())} rows older than '
+                              f'{cutoff:%Y-%m-%d} {"would be " if options["dry_run"] else ""}archived')
+        self.stdout.write(self.style.SUCCESS(f'done in {time.perf_counter() - start:.1f}s'))
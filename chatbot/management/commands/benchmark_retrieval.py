@@ -0,0 +1,260 @@
+import itertools
+import json
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from chatbot.loadtest import TraceCollector
+from chatbot.management.commands.loadtest_chat import parse_setting
+from chatbot.vector_index import QUANTIZATIONS
+
+# questions retrieved untimed before each configuration (model loads, page cache)
+WARMUP_QUESTIONS = 10
+
+
+def load_labels(path):
+    """
+    [(question, [relevant labels])] from a JSON-lines file of
+    {"question": "...", "relevant": ["data/rice.pdf:3:0", "data/urea.pdf", ...]}
+    A label is a chunk id, a page ("<source>:<page>") or a whole source file.
+    """
+    labels = []
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                question, relevant = record['question'], record['relevant']
+            except (ValueError, KeyError, TypeError):
+                raise CommandError(f'{path}:{number}: expected {{"question": ..., "relevant": [...]}}')
+            if not relevant:
+                raise CommandError(f'{path}:{number}: no relevant chunks for {question!r}')
+            labels.append((question, [relevant] if isinstance(relevant, str) else list(relevant)))
+    if not labels:
+        raise CommandError(f'{path} has no labelled questions')
+    return labels
+
+
+def is_relevant(chunk_id, label):
+    return chunk_id == label or chunk_id.startswith(label + ':')
+
+
+def score(chunk_ids, relevant):
+    """(recall, reciprocal rank) of one ranked list of retrieved chunk ids"""
+    found = sum(any(is_relevant(chunk_id, label) for chunk_id in chunk_ids) for label in relevant)
+    for rank, chunk_id in enumerate(chunk_ids, start=1):
+        if any(is_relevant(chunk_id, label) for label in relevant):
+            return found / len(relevant), 1.0 / rank
+    return found / len(relevant), 0.0
+
+
+class PrecomputedEmbeddings:
+    """hands retrieve() query vectors computed up front, so only the search is timed"""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def embed_query(self, text):
+        return self.vectors[text]
+
+    async def aembed_query(self, text):
+        return self.vectors[text]
+
+
+def configurations(options):
+    """every distinct combination of the swept options"""
+    seen = set()
+    for values in itertools.product(
+        options['store'], options['quantization'], options['dimensions'], options['lists'], options['nprobe'],
+        options['rescore_factor'], options['mode'], options['rerank'], options['metadata_filter'], options['k'],
+    ):
+        config = dict(zip(
+            ('store', 'quantization', 'dimensions', 'lists', 'nprobe', 'rescore_factor', 'mode', 'rerank',
+             'metadata_filter', 'k'),
+            values,
+        ))
+        if config['store'] == 'chroma':
+            # Chroma's HNSW parameters are fixed when the collection is built
+            config.update(quantization=None, dimensions=None, lists=None, nprobe=None, rescore_factor=None)
+        elif not config['lists']:
+            config['nprobe'] = None
+        key = tuple(config.items())
+        if key not in seen:
+            seen.add(key)
+            yield config
+
+
+class Command(BaseCommand):
+    help = ('Sweep retrieval settings (k, vector store and index parameters, hybrid search, rerank, metadata '
+            'filters) over labelled questions and report recall@k, MRR and p50/p99 retrieval latency')
+
+    def add_arguments(self, parser):
+        parser.add_argument('labels', help='JSON-lines file of {"question": ..., "relevant": [chunk ids]}')
+
+        sweep = parser.add_argument_group('sweep (each option takes one or more values)')
+        sweep.add_argument('--k', type=int, nargs='+',
+                           default=[getattr(settings, 'CHATBOT_RETRIEVAL_K', 5)])
+        sweep.add_argument('--store', nargs='+', choices=['chroma', 'numpy'], default=['chroma'])
+        sweep.add_argument('--quantization', nargs='+', choices=QUANTIZATIONS,
+                           default=[getattr(settings, 'CHATBOT_VECTOR_INDEX_QUANTIZATION', 'int8')])
+        sweep.add_argument('--dimensions', type=int, nargs='+',
+                           default=[getattr(settings, 'CHATBOT_VECTOR_INDEX_DIMENSIONS', None) or 0],
+                           help='Principal components kept by the numpy index (0: all)')
+        sweep.add_argument('--lists', type=int, nargs='+',
+                           default=[getattr(settings, 'CHATBOT_VECTOR_INDEX_LISTS', 0)])
+        sweep.add_argument('--nprobe', type=int, nargs='+',
+                           default=[getattr(settings, 'CHATBOT_VECTOR_INDEX_NPROBE', 8)])
+        sweep.add_argument('--rescore-factor', type=int, nargs='+',
+                           default=[getattr(settings, 'CHATBOT_VECTOR_INDEX_RESCORE_FACTOR', 4)],
+                           help='0 builds the numpy index without its full-precision copy')
+        sweep.add_argument('--mode', nargs='+', choices=['vector', 'hybrid'],
+                           default=[getattr(settings, 'CHATBOT_RETRIEVAL_MODE', 'vector')])
+        sweep.add_argument('--rerank', nargs='+', choices=['none', 'lexical', 'cross-encoder'],
+                           default=[getattr(settings, 'CHATBOT_RERANK', None) or 'none'])
+        sweep.add_argument('--metadata-filter', nargs='+', choices=['on', 'off'],
+                           default=['on' if getattr(settings, 'CHATBOT_METADATA_FILTER', True) else 'off'])
+
+        parser.add_argument('--repeat', type=int, default=3, help='Timed passes over the questions')
+        parser.add_argument('--min-recall', type=float,
+                            help='Also report the fastest configuration (by p99) with at least this recall@k')
+        parser.add_argument('--set', action='append', default=[], metavar='CHATBOT_NAME=VALUE',
+                            help='Override a chatbot setting for every configuration; may be repeated')
+        parser.add_argument('--output', default='retrieval_benchmark.json', help='Where to write the JSON report')
+
+    def handle(self, *args, **options):
+        labels = load_labels(options['labels'])
+        overrides = dict(parse_setting(value) for value in options['set'])
+        workdir = tempfile.mkdtemp(prefix='chatbot-retrieval-benchmark-')
+        try:
+            with override_settings(**overrides):
+                results = self._sweep(options, labels, workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        report = {'labels': options['labels'], 'questions': len(labels), 'repeat': options['repeat'],
+                  'settings': overrides, 'results': results}
+        if options['min_recall'] is not None:
+            eligible = [result for result in results if result['recall'] >= options['min_recall']]
+            report['best'] = min(eligible, key=lambda result: result['latency_ms']['p99']) if eligible else None
+        with open(options['output'], 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        self._print(report, options['min_recall'])
+        self.stdout.write(self.style.SUCCESS(f"report written to {options['output']}"))
+
+    def _sweep(self, options, labels, workdir):
+        from langchain_chroma import Chroma
+
+        from chatbot.get_embedding_function import check_index_provider, get_embedding_function
+        from chatbot.lexical import BM25Index
+        from chatbot.runtime import RAGComponents
+        from chatbot.vector_index import QuantizedVectorIndex, build_vector_index, export_collection
+
+        embeddings = get_embedding_function(batched=False)
+        chroma = Chroma(persist_directory=getattr(settings, 'CHATBOT_CHROMA_PATH', 'chroma'),
+                        embedding_function=embeddings)
+        check_index_provider(chroma)
+        self.stdout.write(f'embedding {len(labels)} questions')
+        questions = sorted({question for question, _ in labels})
+        vectors = {question: embeddings.embed_query(question) for question in questions}
+        query_embeddings = PrecomputedEmbeddings(vectors)
+
+        lexical = None
+        if 'hybrid' in options['mode']:
+            lexical = BM25Index()
+            lexical.sync(chroma._collection)
+
+        exported = None
+        indexes = {}
+
+        def numpy_index(config):
+            nonlocal exported
+            key = (config['quantization'], config['dimensions'], config['lists'], bool(config['rescore_factor']))
+            if key not in indexes:
+                if exported is None:
+                    exported = export_collection(chroma._collection)
+                path = os.path.join(workdir, f'index-{len(indexes)}')
+                build_vector_index(path, *exported, metadata=chroma._collection.metadata,
+                                   dimensions=config['dimensions'] or None, quantization=config['quantization'],
+                                   lists=config['lists'], rescore=bool(config['rescore_factor']))
+                indexes[key] = path
+            return QuantizedVectorIndex(indexes[key], query_embeddings, nprobe=config['nprobe'] or 0,
+                                        rescore_factor=config['rescore_factor'] or 1)
+
+        results = []
+        for config in configurations(options):
+            db = chroma if config['store'] == 'chroma' else numpy_index(config)
+            rag = RAGComponents(query_embeddings, db, None, None, None,
+                                lexical if config['mode'] == 'hybrid' else None)
+            result = dict(config, **self._measure(rag, config, labels, options['repeat']))
+            self.stdout.write(f"{self._describe(config)}: recall@{config['k']} {result['recall']:.3f}, "
+                              f"p50 {result['latency_ms']['p50']:.1f}ms")
+            results.append(result)
+        return results
+
+    def _measure(self, rag, config, labels, repeat):
+        from chatbot.lexical import chunk_key
+        from chatbot.metrics import registry, trace_request
+        from chatbot.retrieval import retrieve
+
+        overrides = {
+            'CHATBOT_RERANK': None if config['rerank'] == 'none' else config['rerank'],
+            'CHATBOT_METADATA_FILTER': config['metadata_filter'] == 'on',
+        }
+        with override_settings(**overrides):
+            for question, _ in labels[:WARMUP_QUESTIONS]:
+                retrieve(rag, question, config['k'])
+            collector = TraceCollector()
+            registry.observers.append(collector)
+            recalls, ranks = [], []
+            try:
+                for attempt in range(repeat):
+                    for question, relevant in labels:
+                        with trace_request('retrieval'):
+                            _, results = retrieve(rag, question, config['k'])
+                        if attempt == 0:
+                            recall, rank = score([chunk_key(document) for document, _ in results], relevant)
+                            recalls.append(recall)
+                            ranks.append(rank)
+            finally:
+                registry.observers.remove(collector)
+        traces = collector.report()
+        return {
+            'recall': sum(recalls) / len(recalls),
+            'mrr': sum(ranks) / len(ranks),
+            'latency_ms': traces['stages_ms']['total'],
+            'stages_ms': {name: stats for name, stats in traces['stages_ms'].items() if name != 'total'},
+            'events': traces['events'],
+        }
+
+    @staticmethod
+    def _describe(config):
+        if config['store'] == 'chroma':
+            index = 'chroma'
+        else:
+            dimensions = f"{config['dimensions']}d" if config['dimensions'] else 'full-dim'
+            index = f"numpy {config['quantization']} {dimensions}"
+            if config['lists']:
+                index += f" ivf{config['lists']}/{config['nprobe']}"
+            index += f" rescore x{config['rescore_factor']}" if config['rescore_factor'] else ''
+        return f"{index}, {config['mode']}, rerank {config['rerank']}, filter {config['metadata_filter']}"
+
+    def _print(self, report, min_recall):
+        self.stdout.write(f"{report['questions']} questions, {report['repeat']} timed passes")
+        width = max(len(self._describe(result)) for result in report['results']) + 2
+        self.stdout.write(f"{'configuration':<{width}}{'k':>4}{'recall':>8}{'mrr':>8}{'p50 ms':>9}{'p99 ms':>9}")
+        for result in sorted(report['results'], key=lambda result: result['latency_ms']['p50']):
+            self.stdout.write(
+                f"{self._describe(result):<{width}}{result['k']:>4}{result['recall']:>8.3f}{result['mrr']:>8.3f}"
+                f"{result['latency_ms']['p50']:>9.2f}{result['latency_ms']['p99']:>9.2f}"
+            )
+        if min_recall is not None:
+            best = report['best']
+            if best is None:
+                self.stdout.write(self.style.WARNING(f'no configuration reaches recall@k {min_recall}'))
+            else:
+                self.stdout.write(f"fastest with recall@k >= {min_recall}: {self._describe(best)}, k={best['k']}")
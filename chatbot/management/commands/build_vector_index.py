@@ -0,0 +1,38 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from langchain_chroma import Chroma
+
+from chatbot.vector_index import QUANTIZATIONS, build_from_collection, vector_index_options
+
+
+class Command(BaseCommand):
+    help = 'Export the Chroma index into the memory-mapped vector index used when CHATBOT_VECTOR_STORE = "numpy"'
+
+    def add_arguments(self, parser):
+        defaults = vector_index_options()
+        parser.add_argument('--output', default=getattr(settings, 'CHATBOT_VECTOR_INDEX_PATH', 'vector_index'))
+        parser.add_argument('--dimensions', type=int, default=defaults['dimensions'],
+                            help='Keep this many principal components (default: all)')
+        parser.add_argument('--quantization', choices=QUANTIZATIONS, default=defaults['quantization'])
+        parser.add_argument('--lists', type=int, default=defaults['lists'],
+                            help='IVF lists; 0 searches every row')
+        parser.add_argument('--no-rescore', action='store_true',
+                            help='Skip the full-precision copy used to re-score the top candidates')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        db = Chroma(persist_directory=getattr(settings, 'CHATBOT_CHROMA_PATH', 'chroma'))
+        try:
+            meta = build_from_collection(
+                db._collection, options['output'], dimensions=options['dimensions'],
+                quantization=options['quantization'], lists=options['lists'], rescore=not options['no_rescore'],
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(self.style.SUCCESS(
+            f"{meta['count']} vectors ({meta['source_dimensions']} -> {meta['dimensions']} dims, "
+            f"{meta['quantization']}, {meta['lists']} lists) written to {options['output']} "
+            f"in {time.perf_counter() - start:.1f}s"
+        ))
@@ -0,0 +1,202 @@
+import hashlib
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from langchain_chroma import Chroma
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from chatbot.get_embedding_function import (
+    INDEX_PROVIDER_KEY, check_index_provider, get_embedding_function, get_embedding_provider_id,
+    record_index_provider,
+)
+from chatbot.tagging import get_tagger, is_tag_key
+from chatbot.vector_index import QuantizedVectorIndex, build_from_collection, vector_index_options
+
+TEXT_EXTENSIONS = {'.txt', '.md'}
+
+
+def iter_documents(data_path):
+    """stream pages from every PDF and text file under data_path, one file at a time"""
+    from langchain_community.document_loaders import PyPDFLoader, TextLoader
+
+    for root, _, files in os.walk(data_path):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            extension = os.path.splitext(name)[1].lower()
+            if extension == '.pdf':
+                loader = PyPDFLoader(path)
+            elif extension in TEXT_EXTENSIONS:
+                loader = TextLoader(path, encoding='utf-8')
+            else:
+                continue
+            yield from loader.lazy_load()
+
+
+def iter_chunks(documents, splitter, tagger=None):
+    """
+    split documents into chunks with a stable id and a content hash
+    id: "<source>:<page>:<chunk index on that page>", as read by query_rag
+    With a tagger, chunks also carry the crop, region and topic tags of
+    their text and file name.
+    """
+    for document in documents:
+        source = document.metadata.get('source')
+        page = document.metadata.get('page', 0)
+        for index, chunk in enumerate(splitter.split_documents([document])):
+            chunk.metadata['id'] = f'{source}:{page}:{index}'
+            chunk.metadata['content_hash'] = hashlib.sha256(chunk.page_content.encode('utf-8')).hexdigest()
+            if tagger is not None:
+                name = os.path.splitext(os.path.basename(source or ''))[0]
+                chunk.metadata.update(tagger.metadata(f'{name}\n{chunk.page_content}'))
+            yield chunk
+
+
+def existing_metadata(collection, page_size=5000):
+    """return {chunk id: metadata} for everything already in the collection"""
+    metadatas = {}
+    offset = 0
+    while True:
+        page = collection.get(include=['metadatas'], limit=page_size, offset=offset)
+        for chunk_id, metadata in zip(page['ids'], page['metadatas']):
+            metadatas[chunk_id] = metadata or {}
+        if len(page['ids']) < page_size:
+            return metadatas
+        offset += page_size
+
+
+def retagged_metadata(chunk, stored):
+    # Chroma merges metadata on update and upsert; None removes tags the chunk lost
+    metadata = dict(chunk.metadata)
+    metadata.update({key: None for key in stored if is_tag_key(key) and key not in metadata})
+    return metadata
+
+
+def vector_index_stale(path):
+    """True when the numpy index at `path` is missing or was built with another embedding provider"""
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return True
+    try:
+        check_index_provider(QuantizedVectorIndex(path))
+    except ImproperlyConfigured:
+        return True
+    return False
+
+
+class Command(BaseCommand):
+    help = 'Incrementally (re)build the chatbot Chroma index: embed new or changed chunks, delete removed ones'
+    # chatbot.E001 (index built with another provider) tells users to run this command
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--data-path', default=getattr(settings, 'CHATBOT_DATA_PATH', 'data'),
+                            help='Directory of source PDF/text documents')
+        parser.add_argument('--chunk-size', type=int, default=800)
+        parser.add_argument('--chunk-overlap', type=int, default=80)
+        parser.add_argument('--batch-size', type=int, default=64, help='Chunks per embedding call')
+        parser.add_argument('--workers', type=int, default=4, help='Embedding calls in flight at once')
+        parser.add_argument('--keep-removed', action='store_true',
+                            help='Do not delete chunks whose source text disappeared')
+        parser.add_argument('--no-tags', action='store_true',
+                            help='Do not tag new chunks with crop, region and topic metadata')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Drop the collection and embed every chunk again, e.g. after changing '
+                                 'CHATBOT_EMBEDDING_PROVIDER or CHATBOT_EMBEDDING_MODEL')
+
+    def handle(self, *args, **options):
+        data_path = options['data_path']
+        if not os.path.isdir(data_path):
+            raise CommandError(f'{data_path} is not a directory')
+        start = time.perf_counter()
+
+        embeddings = get_embedding_function(batched=False)
+        chroma_path = getattr(settings, 'CHATBOT_CHROMA_PATH', 'chroma')
+        db = Chroma(persist_directory=chroma_path, embedding_function=embeddings)
+        provider_id = get_embedding_provider_id()
+        recorded = (db._collection.metadata or {}).get(INDEX_PROVIDER_KEY)
+        if options['rebuild']:
+            # a new model may have another dimension, which a collection cannot change
+            db.delete_collection()
+            db = Chroma(persist_directory=chroma_path, embedding_function=embeddings)
+        elif recorded is not None and recorded != provider_id:
+            # unchanged chunks would keep vectors from the old model
+            raise CommandError(
+                f'{chroma_path} was embedded with {recorded}, not {provider_id}; '
+                'run with --rebuild to embed every chunk again'
+            )
+        collection = db._collection
+        known = existing_metadata(collection)
+        tagger = None if options['no_tags'] else get_tagger()
+        splitter = RecursiveCharacterTextSplitter(
+            chunk_size=options['chunk_size'], chunk_overlap=options['chunk_overlap'], length_function=len,
+        )
+        batch_size = options['batch_size']
+
+        def embed_and_upsert(batch):
+            vectors = embeddings.embed_documents([chunk.page_content for chunk in batch])
+            collection.upsert(
+                ids=[chunk.metadata['id'] for chunk in batch],
+                embeddings=vectors,
+                documents=[chunk.page_content for chunk in batch],
+                metadatas=[retagged_metadata(chunk, known.get(chunk.metadata['id'], {})) for chunk in batch],
+            )
+            return len(batch)
+
+        def update_tags(batch):
+            collection.update(ids=[chunk.metadata['id'] for chunk in batch],
+                              metadatas=[retagged_metadata(chunk, known[chunk.metadata['id']]) for chunk in batch])
+            return len(batch)
+
+        seen = set()
+        unchanged = upserted = retagged = 0
+        pending = []
+        retag = []
+        in_flight = deque()
+        max_in_flight = 2 * options['workers']
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            for chunk in iter_chunks(iter_documents(data_path), splitter, tagger):
+                chunk_id = chunk.metadata['id']
+                seen.add(chunk_id)
+                stored = known.get(chunk_id)
+                if stored is not None and stored.get('content_hash') == chunk.metadata['content_hash']:
+                    if tagger is None or stored.get('tag_version') == tagger.version:
+                        unchanged += 1
+                    else:
+                        # same text, new vocabulary: refresh the tags without re-embedding
+                        retag.append(chunk)
+                        if len(retag) == batch_size:
+                            retagged += update_tags(retag)
+                            retag = []
+                    continue
+                pending.append(chunk)
+                if len(pending) == batch_size:
+                    in_flight.append(pool.submit(embed_and_upsert, pending))
+                    pending = []
+                    # don't read further ahead than the embedder can keep up with
+                    if len(in_flight) >= max_in_flight:
+                        upserted += in_flight.popleft().result()
+            if pending:
+                in_flight.append(pool.submit(embed_and_upsert, pending))
+            upserted += sum(future.result() for future in in_flight)
+        if retag:
+            retagged += update_tags(retag)
+
+        removed = [] if options['keep_removed'] else [chunk_id for chunk_id in known if chunk_id not in seen]
+        for index in range(0, len(removed), 5000):
+            collection.delete(ids=removed[index:index + 5000])
+        # every vector in the collection now comes from provider_id
+        record_index_provider(db, provider_id)
+        index_path = getattr(settings, 'CHATBOT_VECTOR_INDEX_PATH', 'vector_index')
+        if getattr(settings, 'CHATBOT_VECTOR_STORE', 'chroma') == 'numpy' and (
+                upserted or retagged or removed or (collection.count() and vector_index_stale(index_path))):
+            # the mmapped index is a read-only snapshot of Chroma; re-export it
+            build_from_collection(collection, index_path, **vector_index_options())
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{upserted} chunks embedded, {retagged} retagged, {unchanged} unchanged, {len(removed)} removed '
+            f'in {time.perf_counter() - start:.1f}s'
+        ))
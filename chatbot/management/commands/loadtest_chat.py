@@ -0,0 +1,224 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from chatbot.loadtest import (
+    StubOllamaServer, TraceCollector, drive, summarize, synthetic_corpus, synthetic_questions,
+)
+
+
+def parse_setting(value):
+    """NAME=VALUE with VALUE read as JSON when it parses, else as a string"""
+    name, sep, raw = value.partition('=')
+    if not sep or not name.startswith('CHATBOT_'):
+        raise CommandError(f'--set expects CHATBOT_NAME=VALUE, got {value!r}')
+    try:
+        return name, json.loads(raw)
+    except ValueError:
+        return name, raw
+
+
+class Command(BaseCommand):
+    help = ('Load-test the chat view offline: stub Ollama LLM and embedding servers, a synthetic Chroma '
+            'index and a throwaway test database; writes a JSON report of throughput, per-stage '
+            'p50/p95/p99 and error rates')
+
+    def add_arguments(self, parser):
+        load = parser.add_argument_group('load')
+        load.add_argument('--concurrency', type=int, default=8, help='Simultaneous clients')
+        load.add_argument('--requests', type=int, default=200, help='Measured requests in total')
+        load.add_argument('--duration', type=float, help='Stop after this many seconds instead')
+        load.add_argument('--warmup', type=int, default=10, help='Unmeasured requests sent first')
+        load.add_argument('--turns-per-session', type=int, default=1,
+                          help='Questions each client asks in one conversation before starting a new one')
+        load.add_argument('--questions', help='File of questions, one per line (default: synthetic)')
+        load.add_argument('--corpus-size', type=int, default=500, help='Synthetic chunks to index')
+
+        stubs = parser.add_argument_group('stub servers')
+        stubs.add_argument('--llm-latency-ms', type=float, default=50.0, help='Fixed overhead per LLM call')
+        stubs.add_argument('--llm-cold-start-ms', type=float, default=0.0,
+                           help='Model load time paid by the first generation (or by the preload)')
+        stubs.add_argument('--prefill-tokens-per-second', type=float, default=2000.0)
+        stubs.add_argument('--tokens-per-second', type=float, default=50.0, help='Generation rate')
+        stubs.add_argument('--response-tokens', type=int, default=64)
+        stubs.add_argument('--llm-backends', type=int, default=1,
+                           help='Stub Ollama servers to balance over (more than one uses the LLM pool)')
+        stubs.add_argument('--down-backends', type=int, default=0,
+                           help='Of those, how many to shut down after warm-up')
+        stubs.add_argument('--embedding-latency-ms', type=float, default=20.0)
+        stubs.add_argument('--dimensions', type=int, default=256)
+        stubs.add_argument('--failure-rate', type=float, default=0.0,
+                           help='Fraction of stub calls answered with HTTP 500')
+
+        parser.add_argument('--answer-cache', action='store_true',
+                            help='Leave the semantic answer cache on (off by default, questions repeat)')
+        parser.add_argument('--set', action='append', default=[], metavar='CHATBOT_NAME=VALUE',
+                            help='Override a chatbot setting for the run; may be repeated')
+        parser.add_argument('--output', default='loadtest_report.json', help='Where to write the JSON report')
+
+    def handle(self, *args, **options):
+        if options['questions']:
+            with open(options['questions'], encoding='utf-8') as f:
+                questions = [line.strip() for line in f if line.strip()]
+        else:
+            questions = synthetic_questions()
+        if not questions:
+            raise CommandError('no questions to ask')
+
+        llms = [
+            StubOllamaServer(
+                latency=options['llm_latency_ms'] / 1000,
+                tokens_per_second=options['tokens_per_second'],
+                prefill_tokens_per_second=options['prefill_tokens_per_second'],
+                response_tokens=options['response_tokens'],
+                cold_start=options['llm_cold_start_ms'] / 1000,
+            ).start()
+            for _ in range(options['llm_backends'])
+        ]
+        embedder = StubOllamaServer(dimensions=options['dimensions']).start()
+        workdir = tempfile.mkdtemp(prefix='chatbot-loadtest-')
+        overrides = {
+            'CHATBOT_LLM_MODEL': 'stub',
+            'CHATBOT_OLLAMA_BASE_URL': llms[0].url,
+            'CHATBOT_OLLAMA_BACKENDS': [llm.url for llm in llms] if len(llms) > 1 else [],
+            'CHATBOT_EMBEDDING_PROVIDER': 'ollama',
+            'CHATBOT_EMBEDDING_MODEL': 'stub',
+            'CHATBOT_EMBEDDING_BASE_URL': embedder.url,
+            'CHATBOT_CHROMA_PATH': os.path.join(workdir, 'chroma'),
+            'CHATBOT_VECTOR_INDEX_PATH': os.path.join(workdir, 'vector_index'),
+            'CHATBOT_EMBEDDING_CACHE_PATH': None,
+            'CHATBOT_ANSWER_CACHE_ENABLED': options['answer_cache'],
+            'CHATBOT_RELOAD_CHECK_SECONDS': 0,
+            'CHATBOT_SLOW_QUERY_SECONDS': None,
+            'CHATBOT_LLM_PRELOAD': False,
+        }
+        overrides.update(parse_setting(value) for value in options['set'])
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(**overrides):
+                report = self._run(options, questions, llms, embedder)
+            report['settings'] = overrides
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            for llm in llms:
+                llm.stop()
+            embedder.stop()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        with open(options['output'], 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        self._print(report)
+        self.stdout.write(self.style.SUCCESS(f"report written to {options['output']}"))
+
+    def _run(self, options, questions, llms, embedder):
+        from langchain_chroma import Chroma
+
+        from chatbot.admission import get_admission_gate
+        from chatbot.chat_log import get_chat_log_writer
+        from chatbot.keepalive import get_keepalives
+        from chatbot.get_embedding_function import get_embedding_function, record_index_provider
+        from chatbot.metrics import registry
+        from chatbot.runtime import get_runtime
+        from chatbot.tagging import get_tagger
+        from chatbot.vector_index import build_from_collection, vector_index_options
+
+        self.stdout.write(f"indexing {options['corpus_size']} synthetic chunks")
+        db = Chroma(persist_directory=settings.CHATBOT_CHROMA_PATH,
+                    embedding_function=get_embedding_function(batched=False))
+        corpus = synthetic_corpus(options['corpus_size'])
+        tagger = get_tagger()
+        for start in range(0, len(corpus), 100):
+            batch = corpus[start:start + 100]
+            db.add_texts([text for _, text in batch], ids=[chunk_id for chunk_id, _ in batch],
+                         metadatas=[{'id': chunk_id, 'source': chunk_id.split(':')[0], **tagger.metadata(text)}
+                                    for chunk_id, text in batch])
+        record_index_provider(db)
+        if getattr(settings, 'CHATBOT_VECTOR_STORE', 'chroma') == 'numpy':
+            build_from_collection(db._collection, settings.CHATBOT_VECTOR_INDEX_PATH, **vector_index_options())
+        get_runtime().components()
+        if getattr(settings, 'CHATBOT_LLM_PRELOAD', False):
+            for keepalive in get_keepalives():
+                keepalive.preload()
+
+        # latency only applies to query traffic, not to building the index
+        embedder.latency = options['embedding_latency_ms'] / 1000
+        for server in llms + [embedder]:
+            server.failure_rate = options['failure_rate']
+        for llm in llms[1:options['down_backends'] + 1]:
+            # an unreachable server: the pool has to eject it and route around it
+            llm.stop()
+
+        if options['warmup']:
+            drive(questions, options['concurrency'], requests=options['warmup'])
+        for server in llms + [embedder]:
+            server.requests = 0
+
+        collector = TraceCollector()
+        registry.observers.append(collector)
+        try:
+            self.stdout.write(f"driving chatbot_home with {options['concurrency']} clients")
+            latencies, outcomes, seconds = drive(
+                questions, options['concurrency'], requests=None if options['duration'] else options['requests'],
+                duration=options['duration'], turns_per_session=options['turns_per_session'],
+            )
+        finally:
+            registry.observers.remove(collector)
+        if getattr(settings, 'CHATBOT_CHAT_LOG_ASYNC', True):
+            # let the writer finish with the test database before it is dropped
+            writer = get_chat_log_writer()
+            writer.close()
+            chat_log = writer.stats()
+        else:
+            chat_log = None
+
+        sent = sum(outcomes.values())
+        return {
+            'load': {
+                'concurrency': options['concurrency'],
+                'requests': sent,
+                'seconds': seconds,
+                'throughput_rps': outcomes['ok'] / seconds if seconds else None,
+                'error_rate': (sent - outcomes['ok']) / sent if sent else None,
+                'outcomes': dict(outcomes),
+            },
+            'latency_ms': summarize(latencies),
+            'pipeline': collector.report(),
+            'llm_admission': get_admission_gate().stats(),
+            'chat_log': chat_log,
+            'runtime': get_runtime().stats(),
+            'stubs': {
+                'llm': {'backends': [{'url': llm.url, 'requests': llm.requests} for llm in llms],
+                        'down_backends': options['down_backends'],
+                        'latency_ms': options['llm_latency_ms'],
+                        'tokens_per_second': options['tokens_per_second'],
+                        'prefill_tokens_per_second': options['prefill_tokens_per_second'],
+                        'response_tokens': options['response_tokens']},
+                'embeddings': {'url': embedder.url, 'requests': embedder.requests,
+                               'latency_ms': options['embedding_latency_ms'], 'dimensions': options['dimensions']},
+                'failure_rate': options['failure_rate'],
+            },
+        }
+
+    def _print(self, report):
+        load = report['load']
+        self.stdout.write(
+            f"{load['requests']} requests in {load['seconds']:.1f}s: "
+            f"{load['throughput_rps'] or 0:.2f} req/s, error rate {load['error_rate'] or 0:.1%} {load['outcomes']}"
+        )
+        self.stdout.write(f"{'stage':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        rows = [('client', report['latency_ms'])] + list(report['pipeline']['stages_ms'].items())
+        for name, stats in rows:
+            if not stats['count']:
+                continue
+            self.stdout.write(
+                f"{name:<16}{stats['count']:>8}{stats['p50']:>10.1f}{stats['p95']:>10.1f}{stats['p99']:>10.1f}"
+            )
@@ -0,0 +1,188 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger("chatbot.slow_queries")
+
+# upper bounds in milliseconds for stage timings, and in tokens for sizes
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000)
+SIZE_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+class Histogram:
+    """fixed-bucket histogram with sum and count, Prometheus style"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """upper bound of the bucket holding the q-quantile"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], self.counts)),
+        }
+
+
+class RequestTrace:
+    """timings, sizes and cache outcomes of one chat request"""
+
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.stages = defaultdict(float)  # stage -> seconds
+        self.values = {}                  # token counts, chunk counts, ...
+        self.events = defaultdict(int)    # cache hits and misses, ...
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - started
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def as_dict(self):
+        return {
+            "route": self.route,
+            "total_ms": round(1000 * self.total(), 2),
+            "stages_ms": {name: round(1000 * seconds, 2) for name, seconds in self.stages.items()},
+            "values": dict(self.values),
+            "events": dict(self.events),
+        }
+
+
+class MetricsRegistry:
+    """process-wide aggregation of finished RequestTraces"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_ms = defaultdict(lambda: Histogram(LATENCY_BUCKETS_MS))
+        self.sizes = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        self.events = defaultdict(int)
+        self.slow_queries = deque(maxlen=50)
+        # callables given every finished trace, e.g. the load-test collector
+        self.observers = []
+
+    def record(self, trace):
+        total = trace.total()
+        with self._lock:
+            self.stage_ms[f"{trace.route}.total"].observe(1000 * total)
+            for name, seconds in trace.stages.items():
+                self.stage_ms[name].observe(1000 * seconds)
+            for name, value in trace.values.items():
+                self.sizes[name].observe(value)
+            for name, count in trace.events.items():
+                self.events[name] += count
+        for observer in list(self.observers):
+            observer(trace)
+        threshold = getattr(settings, "CHATBOT_SLOW_QUERY_SECONDS", None)
+        if threshold is not None and total >= threshold:
+            breakdown = trace.as_dict()
+            with self._lock:
+                self.slow_queries.append(breakdown)
+            slow_logger.warning("slow chat request: %s", breakdown)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "stages_ms": {name: h.snapshot() for name, h in sorted(self.stage_ms.items())},
+                "sizes": {name: h.snapshot() for name, h in sorted(self.sizes.items())},
+                "events": dict(self.events),
+                "slow_queries": list(self.slow_queries),
+            }
+
+
+registry = MetricsRegistry()
+_current = contextvars.ContextVar("chatbot_trace", default=None)
+
+
+@contextmanager
+def trace_request(route):
+    """collect the stages of one request and add them to the registry when it ends"""
+    trace = RequestTrace(route)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            # a streaming generator closed from another context
+            _current.set(None)
+        registry.record(trace)
+
+
+def current_trace():
+    return _current.get()
+
+
+@contextmanager
+def stage(name):
+    """time a pipeline stage of the current request; a no-op outside one"""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    with trace.stage(name):
+        yield
+
+
+def set_route(route):
+    """name the path (intent, rag, ...) the current request ended up taking"""
+    trace = _current.get()
+    if trace is not None:
+        trace.route = route
+
+
+def add_stage(name, seconds):
+    trace = _current.get()
+    if trace is not None:
+        trace.stages[name] += seconds
+
+
+def note(name, value):
+    """record a size (tokens, chunks) for the current request"""
+    trace = _current.get()
+    if trace is not None:
+        trace.values[name] = value
+
+
+def event(name):
+    """count an outcome such as a cache hit for the current request"""
+    trace = _current.get()
+    if trace is not None:
+        trace.events[name] += 1
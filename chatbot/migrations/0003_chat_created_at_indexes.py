@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatbot", "0002_chatquerymessage"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="chatmessage",
+            index=models.Index(fields=["created_at", "id"], name="chatmsg_created_id_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="chatquerymessage",
+            index=models.Index(fields=["created_at", "id"], name="chatquerymsg_created_id_idx"),
+        ),
+    ]
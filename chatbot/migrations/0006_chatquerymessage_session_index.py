@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatbot", "0005_chat_created_at_default"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="chatquerymessage",
+            index=models.Index(fields=["session", "created_at", "id"], name="chatquerymsg_sess_created_idx"),
+        ),
+    ]
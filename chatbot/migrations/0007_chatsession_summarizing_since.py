@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatbot", "0006_chatquerymessage_session_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatsession",
+            name="summarizing_since",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
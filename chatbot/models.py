@@ -1,18 +1,51 @@
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
+class ChatSession(models.Model):
+    # rolling summary of every turn up to and including summarized_until
+    summary = models.TextField(blank=True, default='')
+    summarized_until = models.BigIntegerField(default=0)
+    # set while a worker is summarising the session, as a lock shared by processes
+    summarizing_since = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'Chat session {self.pk}'
+
+
 class ChatMessage(models.Model):
+    session = models.ForeignKey(ChatSession, null=True, blank=True, on_delete=models.SET_NULL, related_name='messages')
     message = models.TextField()
     response = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # set when the turn happens, not when the batched chat-log writer inserts it
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        # keyset pagination walks (created_at, id)
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='chatmsg_created_id_idx'),
+            # recent turns of one conversation
+            models.Index(fields=['session', 'id'], name='chatmsg_session_id_idx'),
+        ]
 
     def __str__(self):
         return f'{self.message}'
     
 class ChatQueryMessage(models.Model):
+    session = models.ForeignKey(ChatSession, null=True, blank=True, on_delete=models.SET_NULL, related_name='queries')
     message = models.TextField()
     response = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # set when the turn happens, not when the batched chat-log writer inserts it
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='chatquerymsg_created_id_idx'),
+            # one session's history, newest first
+            models.Index(fields=['session', 'created_at', 'id'], name='chatquerymsg_sess_created_idx'),
+        ]
 
     def __str__(self):
-        return f'{self.message}'
\ No newline at end of file
+        return f'{self.message}'
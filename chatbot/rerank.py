@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import math
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .lexical import reciprocal_rank_fusion, tokenize
+
+logger = logging.getLogger(__name__)
+
+# Scoring runs here so a request can stop waiting once its budget is spent.
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="rerank")
+
+
+def lexical_overlap_scores(query_text, documents):
+    """
+    idf-weighted share of the question's terms that appear in each chunk,
+    with idf taken over the candidate set itself
+    """
+    terms = set(tokenize(query_text))
+    chunk_terms = [set(tokenize(document.page_content)) for document in documents]
+    if not terms:
+        return [0.0] * len(documents)
+    df = Counter(term for words in chunk_terms for term in words & terms)
+    n = len(documents)
+    idf = {term: math.log(1 + n / (1 + df[term])) for term in terms}
+    total = sum(idf.values())
+    return [sum(idf[term] for term in words & terms) / total for words in chunk_terms]
+
+
+_cross_encoders = {}
+_cross_encoders_lock = threading.Lock()
+
+
+def cross_encoder_scores(query_text, documents):
+    """relevance scores from a local sentence-transformers cross-encoder, in one batch"""
+    model = getattr(settings, "CHATBOT_RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+    with _cross_encoders_lock:
+        if model not in _cross_encoders:
+            try:
+                from sentence_transformers import CrossEncoder
+            except ImportError:
+                raise ImproperlyConfigured("The cross-encoder reranker needs the sentence-transformers package")
+            _cross_encoders[model] = CrossEncoder(model, device="cpu")
+        encoder = _cross_encoders[model]
+    pairs = [(query_text, document.page_content) for document in documents]
+    return encoder.predict(pairs, batch_size=len(pairs) or 1, show_progress_bar=False).tolist()
+
+
+SCORERS = {
+    "lexical": lexical_overlap_scores,
+    "cross-encoder": cross_encoder_scores,
+}
+
+
+def get_scorer():
+    """return the configured scoring function, or None when reranking is off"""
+    name = getattr(settings, "CHATBOT_RERANK", None)
+    if not name:
+        return None
+    if name not in SCORERS:
+        raise ImproperlyConfigured(f"Unknown CHATBOT_RERANK {name!r}, choose one of {sorted(SCORERS)}")
+    return SCORERS[name]
+
+
+def _ordered(results, scores, top_n):
+    # fuse the scorer's order with the retrieval order rather than replacing
+    # it: term overlap alone ignores everything the retriever knew
+    rescored = sorted(zip(results, scores), key=lambda pair: pair[1], reverse=True)
+    return reciprocal_rank_fusion([results, [(document, score) for (document, _), score in rescored]])[:top_n]
+
+
+def _budget():
+    return getattr(settings, "CHATBOT_RERANK_BUDGET_MS", 150) / 1000.0
+
+
+def rerank(scorer, query_text, results, top_n):
+    """
+    keep the top_n of [(document, score), ...] by the scorer's rank fused with
+    the retrieval rank; if scoring fails or does not finish within
+    CHATBOT_RERANK_BUDGET_MS the incoming order is kept
+    """
+    documents = [document for document, _ in results]
+    future = _executor.submit(scorer, query_text, documents)
+    try:
+        scores = future.result(timeout=_budget())
+    except TimeoutError:
+        future.cancel()
+        logger.warning("rerank of %d chunks exceeded its budget, keeping retrieval order", len(results))
+        return results[:top_n]
+    except Exception:
+        logger.exception("rerank of %d chunks failed, keeping retrieval order", len(results))
+        return results[:top_n]
+    return _ordered(results, scores, top_n)
+
+
+async def arerank(scorer, query_text, results, top_n):
+    documents = [document for document, _ in results]
+    future = _executor.submit(scorer, query_text, documents)
+    try:
+        scores = await asyncio.wait_for(asyncio.wrap_future(future), timeout=_budget())
+    except asyncio.TimeoutError:
+        future.cancel()
+        logger.warning("rerank of %d chunks exceeded its budget, keeping retrieval order", len(results))
+        return results[:top_n]
+    except Exception:
+        logger.exception("rerank of %d chunks failed, keeping retrieval order", len(results))
+        return results[:top_n]
+    return _ordered(results, scores, top_n)
@@ -0,0 +1,114 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .lexical import chunk_key, reciprocal_rank_fusion, tokenize
+from .metrics import event, note, stage
+from .rerank import arerank, get_scorer, rerank
+from .tagging import get_tagger, query_filter, tagger_loaded
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _metadata_filter(query_text):
+    # A question naming a crop or region only searches chunks tagged with it.
+    with stage("tag"):
+        where = query_filter(query_text)
+    if where is not None:
+        event("metadata_filter")
+    return where
+
+
+def _lexical_fast_path(rag, query_text, k, where):
+    # Short keyword questions ("rice blast", "urea dose") are answered from
+    # the BM25 index alone, skipping the embedding call and vector search.
+    if rag.lexical is None or len(tokenize(query_text)) > _setting("CHATBOT_LEXICAL_FAST_PATH_MAX_TERMS", 3):
+        return None
+    with stage("lexical_search"):
+        results = rag.lexical.search(query_text, k, where=where)
+    if results:
+        event("lexical_fast_path")
+    return results or None
+
+
+def _fetch_k(rag, k, scorer):
+    # over-fetch when later stages (fusion, rerank) pick the final k
+    fetch_k = k
+    if rag.lexical is not None:
+        fetch_k = max(fetch_k, _setting("CHATBOT_HYBRID_CANDIDATES", 20))
+    if scorer is not None:
+        fetch_k = max(fetch_k, _setting("CHATBOT_RERANK_CANDIDATES", 30))
+    return fetch_k
+
+
+def _vector_search(rag, query_vector, k, fetch_k, where):
+    if where is None:
+        return rag.db.similarity_search_by_vector_with_relevance_scores(query_vector, k=fetch_k)
+    hits = rag.db.similarity_search_by_vector_with_relevance_scores(query_vector, k=fetch_k, filter=where)
+    if len(hits) < k:
+        # too few tagged chunks: top up from the whole collection, tagged hits first
+        event("metadata_filter_fallback")
+        seen = {chunk_key(document) for document, _ in hits}
+        more = rag.db.similarity_search_by_vector_with_relevance_scores(query_vector, k=fetch_k)
+        hits += [hit for hit in more if chunk_key(hit[0]) not in seen][:fetch_k - len(hits)]
+    return hits
+
+
+def _fuse(rag, query_text, vector_hits, where):
+    if rag.lexical is None:
+        return vector_hits
+    with stage("lexical_search"):
+        lexical_hits = rag.lexical.search(query_text, len(vector_hits), where=where)
+        return reciprocal_rank_fusion([vector_hits, lexical_hits])
+
+
+def retrieve(rag, query_text, k=None):
+    """
+    return (query vector or None, [(document, score), ...]) for a question
+    Vector search, fused with BM25 by reciprocal rank when hybrid retrieval
+    is on and reranked when CHATBOT_RERANK is set; the query vector is None
+    when the lexical fast path answered. Questions that name a crop or
+    region are searched within the chunks tagged with it.
+    """
+    k = k or _setting("CHATBOT_RETRIEVAL_K", 5)
+    where = _metadata_filter(query_text)
+    results = _lexical_fast_path(rag, query_text, k, where)
+    if results is not None:
+        return None, results
+    scorer = get_scorer()
+    with stage("embed"):
+        query_vector = rag.embeddings.embed_query(query_text)
+    with stage("vector_search"):
+        vector_hits = _vector_search(rag, query_vector, k, _fetch_k(rag, k, scorer), where)
+    candidates = _fuse(rag, query_text, vector_hits, where)
+    note("candidate_chunks", len(candidates))
+    if scorer is not None:
+        with stage("rerank"):
+            return query_vector, rerank(scorer, query_text, candidates, k)
+    return query_vector, candidates[:k]
+
+
+async def aretrieve(rag, query_text, k=None):
+    k = k or _setting("CHATBOT_RETRIEVAL_K", 5)
+    if _setting("CHATBOT_METADATA_FILTER", True) and not tagger_loaded():
+        # the first call reads the crop vocabulary CSVs; keep that off the loop
+        await sync_to_async(get_tagger, thread_sensitive=False)()
+    where = _metadata_filter(query_text)
+    results = _lexical_fast_path(rag, query_text, k, where)
+    if results is not None:
+        return None, results
+    scorer = get_scorer()
+    with stage("embed"):
+        query_vector = await rag.embeddings.aembed_query(query_text)
+    # Chroma's client is synchronous; run the search off the event loop.
+    with stage("vector_search"):
+        vector_hits = await sync_to_async(_vector_search, thread_sensitive=False)(
+            rag, query_vector, k, _fetch_k(rag, k, scorer), where
+        )
+    candidates = _fuse(rag, query_text, vector_hits, where)
+    note("candidate_chunks", len(candidates))
+    if scorer is not None:
+        with stage("rerank"):
+            return query_vector, await arerank(scorer, query_text, candidates, k)
+    return query_vector, candidates[:k]
@@ -0,0 +1,222 @@
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from langchain_chroma import Chroma
+from langchain.prompts import PromptTemplate
+from langchain_community.llms.ollama import Ollama
+
+from .admission import GatedLLM, get_admission_gate
+from .embedding_cache import CachedQueryEmbeddings, get_embedding_cache
+from .get_embedding_function import check_index_provider, get_embedding_function
+from .keepalive import OllamaTimings
+from .llm_pool import OllamaPool
+from .lexical import BM25Index
+from .vector_index import QuantizedVectorIndex, vector_index_version
+
+logger = logging.getLogger(__name__)
+
+CHROMA_PATH = "chroma"
+# The static instructions come first and never contain a placeholder: every
+# prompt then starts with the same tokens, and Ollama reuses their KV cache
+# from the previous call (and from the preload) instead of evaluating them
+# again. Everything that varies per question follows.
+PROMPT_PREFIX = """You are PlowPal, an assistant for farmers. Answer the question using only the
+context passages below. If they do not contain the answer, say that you do not
+know. Keep the answer short and practical.
+
+Context:
+"""
+PROMPT_TEMPLATE = PROMPT_PREFIX + """{context}
+
+---
+
+{history}Question: {question}
+Answer:"""
+
+# One consistent set of RAG components. Requests take a snapshot of this
+# tuple so a hot reload never swaps a component halfway through a query.
+RAGComponents = namedtuple("RAGComponents", ["embeddings", "db", "prompt", "llm", "index_version", "lexical"])
+
+
+def chroma_index_version(chroma_path):
+    """
+    return a token that changes whenever the persisted Chroma index changes
+    (mtime and size of the sqlite file), or None if there is no index yet
+    """
+    sqlite_file = os.path.join(chroma_path, "chroma.sqlite3")
+    try:
+        stat = os.stat(sqlite_file)
+    except OSError:
+        return None
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def ollama_backends():
+    """base URLs of the Ollama servers that answer chat questions"""
+    return list(getattr(settings, "CHATBOT_OLLAMA_BACKENDS", None) or [
+        getattr(settings, "CHATBOT_OLLAMA_BASE_URL", "http://localhost:11434")
+    ])
+
+
+class RAGRuntime:
+    """
+    Lazily built, process-wide holder for the embedder, Chroma handle,
+    prompt template and Ollama client used by query_rag.
+    Components are created on first use and reused across requests.
+    """
+
+    def __init__(self, chroma_path=None, llm_model=None, reload_check_seconds=None):
+        self.chroma_path = chroma_path or getattr(settings, "CHATBOT_CHROMA_PATH", CHROMA_PATH)
+        self.llm_model = llm_model or getattr(settings, "CHATBOT_LLM_MODEL", "mistral")
+        if reload_check_seconds is None:
+            reload_check_seconds = getattr(settings, "CHATBOT_RELOAD_CHECK_SECONDS", 5)
+        self.reload_check_seconds = reload_check_seconds
+        # 'chroma', or 'numpy' for the mmapped QuantizedVectorIndex exported from it
+        self.vector_store = getattr(settings, "CHATBOT_VECTOR_STORE", "chroma")
+        self.vector_index_path = getattr(settings, "CHATBOT_VECTOR_INDEX_PATH", "vector_index")
+        self._lock = threading.Lock()
+        self._components = None
+        self._last_check = 0.0
+        self._llm_pool = None
+        # kept across reloads so a changed index is synced, not rebuilt
+        self.lexical = BM25Index() if getattr(settings, "CHATBOT_RETRIEVAL_MODE", "vector") == "hybrid" else None
+
+    def _build(self):
+        # Repeated questions are answered from the query embedding cache
+        # instead of another round trip to the embedding backend.
+        embeddings = CachedQueryEmbeddings(get_embedding_function(), get_embedding_cache())
+        if self.vector_store == "numpy":
+            db = QuantizedVectorIndex(
+                self.vector_index_path, embeddings,
+                nprobe=getattr(settings, "CHATBOT_VECTOR_INDEX_NPROBE", 8),
+                rescore_factor=getattr(settings, "CHATBOT_VECTOR_INDEX_RESCORE_FACTOR", 4),
+            )
+        else:
+            db = Chroma(persist_directory=self.chroma_path, embedding_function=embeddings)
+        check_index_provider(db)
+        # a plain completion prompt, so the text sent starts with PROMPT_PREFIX
+        prompt = PromptTemplate.from_template(PROMPT_TEMPLATE)
+        # every generation waits for a slot, so bursts queue (or are turned
+        # away) instead of overloading the Ollama servers
+        llm = GatedLLM(
+            self._llm_client(),
+            get_admission_gate(),
+            timeout=getattr(settings, "CHATBOT_LLM_QUEUE_TIMEOUT", 30),
+        )
+        if self.lexical is not None:
+            self.lexical.sync(db._collection)
+        return RAGComponents(embeddings, db, prompt, llm, self.index_version(), self.lexical)
+
+    def _ollama(self, base_url):
+        return Ollama(
+            model=self.llm_model,
+            base_url=base_url,
+            timeout=getattr(settings, "CHATBOT_LLM_TIMEOUT", 120),
+            keep_alive=getattr(settings, "CHATBOT_LLM_KEEP_ALIVE", "30m"),
+            callbacks=[OllamaTimings()],
+        )
+
+    def _llm_client(self):
+        """one Ollama client, or an OllamaPool balancing over CHATBOT_OLLAMA_BACKENDS"""
+        backends = ollama_backends()
+        if len(backends) == 1:
+            return self._ollama(backends[0])
+        if self._llm_pool is None:
+            # kept across reloads, with its health state and latency history
+            self._llm_pool = OllamaPool(
+                [(url, self._ollama(url)) for url in backends],
+                max_failures=getattr(settings, "CHATBOT_LLM_EJECT_AFTER_FAILURES", 3),
+                health_check_seconds=getattr(settings, "CHATBOT_LLM_HEALTH_CHECK_SECONDS", 10),
+            )
+        return self._llm_pool
+
+    def index_version(self):
+        if self.vector_store == "numpy":
+            return vector_index_version(self.vector_index_path)
+        return chroma_index_version(self.chroma_path)
+
+    def components(self):
+        """return the current components, building them on first use"""
+        components = self._components
+        if components is None:
+            with self._lock:
+                if self._components is None:
+                    start = time.perf_counter()
+                    self._components = self._build()
+                    self._last_check = time.monotonic()
+                    logger.info("RAG runtime loaded in %.2fs", time.perf_counter() - start)
+                components = self._components
+        elif self.reload_check_seconds:
+            components = self.reload_if_changed()
+        return components
+
+    def reload_if_changed(self):
+        """rebuild the components if the Chroma directory changed on disk"""
+        now = time.monotonic()
+        if now - self._last_check < self.reload_check_seconds:
+            return self._components
+        self._last_check = now
+        if self.index_version() != self._components.index_version:
+            return self.reload(only_if_changed=True)
+        return self._components
+
+    def reload(self, only_if_changed=False):
+        """
+        build a fresh set of components and swap them in atomically
+        With only_if_changed the index version is compared again under the
+        lock, so requests that all noticed the same change rebuild only once.
+        """
+        with self._lock:
+            old = self._components
+            if only_if_changed and old is not None and self.index_version() == old.index_version:
+                self._last_check = time.monotonic()
+                return old
+            if old is not None:
+                logger.info("reloading RAG runtime from the %s index", self.vector_store)
+                # chromadb caches one client per path; drop it so the new
+                # handle sees the files that are on disk now.
+                clear_cache = getattr(getattr(old.db, "_client", None), "clear_system_cache", None)
+                if clear_cache is not None:
+                    clear_cache()
+            self._components = self._build()
+            self._last_check = time.monotonic()
+            return self._components
+
+    def warmup(self):
+        """load everything and touch the embedder and index once"""
+        start = time.perf_counter()
+        components = self.components()
+        components.db.similarity_search_with_score("warmup", k=1)
+        logger.info("RAG runtime warm in %.2fs", time.perf_counter() - start)
+        return components
+
+    def stats(self):
+        """index version, embedding batcher and LLM pool counters, without building anything"""
+        components = self._components
+        if components is None:
+            return {"loaded": False}
+        stats = {"loaded": True, "index_version": components.index_version}
+        embeddings = getattr(components.embeddings, "embeddings", None)
+        if hasattr(embeddings, "stats"):
+            stats["embedding_batcher"] = embeddings.stats()
+        if self._llm_pool is not None:
+            stats["llm_pool"] = self._llm_pool.stats()
+        return stats
+
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+def get_runtime():
+    """return the RAGRuntime shared by every request in this worker"""
+    global _runtime
+    if _runtime is None:
+        with _runtime_lock:
+            if _runtime is None:
+                _runtime = RAGRuntime()
+    return _runtime
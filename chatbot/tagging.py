@@ -0,0 +1,240 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TAG_FIELDS = ("crop", "region", "topic")
+# A chunk that names no region is general advice and matches any region; a
+# chunk that names no crop does not match a question about a crop.
+OPEN_FIELDS = ("region",)
+UNTAGGED = "untagged"
+
+# Words that place a chunk or a question under a topic, in singular form.
+TOPICS = {
+    "fertiliser": ["fertiliser", "fertilizer", "manure", "compost", "nitrogen", "phosphorus", "potassium",
+                   "potash", "urea", "dap", "npk", "nutrient", "micronutrient"],
+    "irrigation": ["irrigation", "irrigate", "irrigating", "watering", "drip", "sprinkler", "waterlogging"],
+    "pests": ["pest", "insect", "aphid", "borer", "weevil", "caterpillar", "mite", "nematode", "locust",
+              "pesticide", "insecticide", "whitefly", "bollworm"],
+    "disease": ["disease", "blight", "rust", "wilt", "rot", "fungus", "fungal", "fungicide", "mildew",
+                "virus", "blast", "leaf spot"],
+    "sowing": ["sow", "sowing", "seeding", "seed rate", "spacing", "nursery", "transplant", "transplanting",
+               "germination"],
+    "harvest": ["harvest", "harvesting", "threshing", "storage"],
+    "soil": ["soil", "ph", "loam", "clay", "salinity", "erosion", "tillage"],
+    "weather": ["rain", "rainfall", "monsoon", "drought", "frost", "temperature", "humidity", "weather",
+                "climate", "heatwave"],
+}
+
+# Other names for a crop or region, mapped to one name used for it in the
+# CSVs; the two CSVs also spell some crops differently ("mungbean", "Moong").
+SYNONYMS = {
+    "crop": {
+        "mungbean": "moong", "mung bean": "moong", "mung": "moong", "pigeonpea": "arhar", "pigeon pea": "arhar",
+        "chickpea": "gram", "bengal gram": "gram", "blackgram": "urad", "black gram": "urad",
+        "lentil": "masoor", "mothbean": "moth", "moth bean": "moth", "paddy": "rice", "corn": "maize",
+        "soybean": "soyabean", "sorghum": "jowar", "pearl millet": "bajra", "finger millet": "ragi",
+        "cassava": "tapioca", "peanut": "groundnut", "sesame": "sesamum", "chilli": "dry chillies",
+        "chili": "dry chillies", "chillies": "dry chillies",
+    },
+    "region": {"orissa": "odisha", "pondicherry": "puducherry", "j&k": "jammu and kashmir"},
+}
+# parts of CSV crop names that are not crops on their own
+_GENERIC = {"lint", "pulses", "seed", "dry", "small", "beans"}
+# crop names that are also common words ("50 gram per plant", "moth larvae");
+# these crops are only recognised by their other names
+_AMBIGUOUS = {"gram", "moth"}
+
+_word = re.compile(r"[a-z0-9]+")
+
+
+def _singular(word):
+    # close enough for matching crop and topic words: "pests" -> "pest"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def words(text):
+    return tuple(_singular(word) for word in _word.findall(text.lower()))
+
+
+def slug(name):
+    return re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+
+
+def tag_key(field, value):
+    """the boolean metadata key marking a chunk as tagged `value` for `field`"""
+    return f"{field}_{slug(value)}"
+
+
+def is_tag_key(key):
+    return any(key.startswith(f"{field}_") for field in TAG_FIELDS)
+
+
+def _crop_names(name):
+    """(canonical name, aliases) of a crop name as spelled in the CSVs"""
+    name = re.sub(r"\s*&\s*", " & ", " ".join(name.split()).lower())
+    if name.startswith("other") or "total" in name:
+        return None, set()
+    canonical = re.split(r"[(/]", name)[0].strip()
+    aliases = {canonical}
+    for part in re.split(r"[()/&]", name):
+        part = part.strip()
+        if part and part not in _GENERIC:
+            aliases.add(part)
+            if part.endswith(" seed"):
+                aliases.add(part[:-len(" seed")])
+    return canonical, aliases
+
+
+def default_vocabulary_sources():
+    base = getattr(settings, "BASE_DIR", ".")
+    return [
+        (os.path.join(base, "crop_recommendation", "Crop_recommendation.csv"), "label", "crop"),
+        (os.path.join(base, "yield_prediction", "crop_yield.csv"), "Crop", "crop"),
+        (os.path.join(base, "yield_prediction", "crop_yield.csv"), "State", "region"),
+    ]
+
+
+def load_vocabulary(sources):
+    """{field: {name as spelled in the data: canonical name}} from (csv path, column, field) sources"""
+    synonyms = {field: {words(alias): canonical for alias, canonical in names.items()}
+                for field, names in SYNONYMS.items()}
+    vocabulary = defaultdict(dict)
+    canonicals = defaultdict(set)
+    for path, column, field in sources:
+        try:
+            with open(path, newline="", encoding="utf-8") as f:
+                names = {(row.get(column) or "").strip() for row in csv.DictReader(f)}
+        except OSError as exc:
+            logger.warning("tag vocabulary %s not loaded: %s", path, exc)
+            continue
+        for name in filter(None, names):
+            if field == "crop":
+                canonical, aliases = _crop_names(name)
+            else:
+                canonical = " ".join(name.split()).lower()
+                aliases = {canonical}
+            if canonical is None:
+                continue
+            canonical = synonyms.get(field, {}).get(words(canonical), canonical)
+            canonicals[field].add(canonical)
+            for alias in aliases - _AMBIGUOUS:
+                vocabulary[field].setdefault(alias, canonical)
+    for field, names in SYNONYMS.items():
+        for alias, canonical in names.items():
+            if canonical in canonicals[field]:
+                vocabulary[field].setdefault(alias, canonical)
+    for topic, keywords in TOPICS.items():
+        for keyword in keywords:
+            vocabulary["topic"].setdefault(keyword, topic)
+    return dict(vocabulary)
+
+
+class EntityTagger:
+    """
+    Finds the crops, regions and topics a piece of text mentions by looking
+    its words up in a phrase table, longest phrase first, so it costs a few
+    dict lookups per word and no model call. The same tagger labels chunks
+    at ingestion and questions at query time; `version` changes with the
+    vocabulary, so ingestion knows when stored tags are stale.
+    """
+
+    def __init__(self, vocabulary):
+        self._phrases = {}
+        for field, names in vocabulary.items():
+            for alias, canonical in names.items():
+                self._phrases.setdefault(words(alias), (field, canonical))
+        self._longest = max((len(phrase) for phrase in self._phrases), default=0)
+        encoded = json.dumps({field: sorted(names.items()) for field, names in sorted(vocabulary.items())})
+        self.version = hashlib.sha256(encoded.encode("utf-8")).hexdigest()[:16]
+
+    def tag(self, text):
+        """{field: set of canonical names} mentioned in `text`"""
+        tokens = words(text)
+        tags = defaultdict(set)
+        position = 0
+        while position < len(tokens):
+            for length in range(min(self._longest, len(tokens) - position), 0, -1):
+                match = self._phrases.get(tokens[position:position + length])
+                if match is not None:
+                    tags[match[0]].add(match[1])
+                    position += length
+                    break
+            else:
+                position += 1
+        return dict(tags)
+
+    def metadata(self, text):
+        """
+        chunk metadata for `text`: a True flag per tag, a `<field>_untagged`
+        flag per field it names nothing for, and the tagger version
+        """
+        metadata = {"tag_version": self.version}
+        tags = self.tag(text)
+        for field in TAG_FIELDS:
+            for value in tags.get(field) or [UNTAGGED]:
+                metadata[tag_key(field, value)] = True
+        return metadata
+
+
+def _any_of(field, values):
+    values = sorted(values) + ([UNTAGGED] if field in OPEN_FIELDS else [])
+    conditions = [{tag_key(field, value): True} for value in values]
+    return conditions[0] if len(conditions) == 1 else {"$or": conditions}
+
+
+def metadata_filter(tags, fields=("crop", "region")):
+    """
+    Chroma `where` clause keeping chunks tagged with any of the question's
+    values for each of `fields`, or None when the question names none of them
+    """
+    conditions = [_any_of(field, tags[field]) for field in fields if tags.get(field)]
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def matches(metadata, where):
+    """evaluate the subset of Chroma's `where` syntax metadata_filter produces"""
+    if "$and" in where:
+        return all(matches(metadata, condition) for condition in where["$and"])
+    if "$or" in where:
+        return any(matches(metadata, condition) for condition in where["$or"])
+    return all(metadata.get(key) == value for key, value in where.items())
+
+
+_tagger = None
+_tagger_lock = threading.Lock()
+
+
+def get_tagger():
+    """return the EntityTagger built from CHATBOT_TAG_VOCABULARY, loaded once per process"""
+    global _tagger
+    if _tagger is None:
+        with _tagger_lock:
+            if _tagger is None:
+                sources = getattr(settings, "CHATBOT_TAG_VOCABULARY", None) or default_vocabulary_sources()
+                _tagger = EntityTagger(load_vocabulary(sources))
+    return _tagger
+
+
+def tagger_loaded():
+    return _tagger is not None
+
+
+def query_filter(query_text):
+    """the metadata filter for a question, per CHATBOT_METADATA_FILTER_FIELDS, or None"""
+    if not getattr(settings, "CHATBOT_METADATA_FILTER", True):
+        return None
+    fields = getattr(settings, "CHATBOT_METADATA_FILTER_FIELDS", ("crop", "region"))
+    return metadata_filter(get_tagger().tag(query_text), fields)
@@ -1,3 +1,1312 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import torch
+from asgiref.sync import sync_to_async
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from langchain_core.documents import Document
+from langchain_core.outputs import Generation, LLMResult
+
+from . import model, tools, views
+from .admission import AdmissionGate, GatedLLM, Overloaded
+from .answer_cache import SemanticAnswerCache
+from .chat_log import ChatLogWriter
+from .context import CONTEXT_SEPARATOR, build_context, count_tokens
+from .conversation import SESSION_KEY, Conversation
+from .embedding_cache import CachedQueryEmbeddings, EmbeddingCache
+from .embedding_batcher import EmbeddingBatcher
+from .checks import check_chroma_embedding_provider
+from .get_embedding_function import (
+    BATCHING_PROVIDERS, EMBEDDING_PROVIDERS, LocalEmbeddings, check_index_provider, get_embedding_function,
+    get_embedding_provider_id, record_index_provider, register_provider,
+)
+from .intent_router import intent_answer
+from .keepalive import OllamaKeepAlive, OllamaTimings
+from .lexical import BM25Index, reciprocal_rank_fusion
+from .llm_pool import OllamaPool
+from .loadtest import StubOllamaServer, TraceCollector, percentile, stub_vector, synthetic_corpus
+from .management.commands.benchmark_retrieval import configurations, load_labels, score
+from .metrics import MetricsRegistry, event, note, registry, set_route, stage, trace_request
+from .models import ChatMessage, ChatQueryMessage, ChatSession
+from .rerank import arerank, rerank
+from .retrieval import retrieve
+from .runtime import RAGComponents, RAGRuntime
+from .tagging import EntityTagger, load_vocabulary, matches, metadata_filter
+from .tools import FILE, IntentClassifier, bag_of_words, json_file, tokenize
+from .vector_index import QuantizedVectorIndex, build_vector_index
+from .views import chat_history
+
+
+class FakeClassifier:
+    """stands in for data.pth with the (tag, probability, coverage) it gives each message"""
+
+    def __init__(self, predictions):
+        self.predictions = predictions
+
+    def classify(self, messages):
+        return [self.predictions[message] for message in messages]
+
+    def respond(self, tag):
+        return f"{tag} reply"
+
+
+class IntentRoutingTests(SimpleTestCase):
+    # what the coffee-shop model in data.pth predicts for these messages
+    predictions = {
+        "Hello": ("greeting", 0.99, 1.0),
+        "Thanks a lot!": ("thanks", 0.97, 1.0),
+        "How long does rice take to grow?": ("delivery", 0.93, 0.57),
+        "When do I sow rice?": ("delivery", 0.88, 0.5),
+        "Do you have seeds for wheat?": ("items", 0.96, 0.6),
+        "Do you take credit cards?": ("payments", 0.99, 1.0),
+        "Hi, how do I grow rice?": ("greeting", 0.9, 0.5),
+    }
+
+    def setUp(self):
+        patcher = mock.patch("chatbot.intent_router.get_classifier",
+                             return_value=FakeClassifier(self.predictions))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_small_talk_is_answered(self):
+        self.assertEqual(intent_answer("Hello"), "greeting reply")
+        self.assertEqual(intent_answer("Thanks a lot!"), "thanks reply")
+
+    def test_agronomy_questions_fall_through_to_rag(self):
+        for message in ("How long does rice take to grow?", "When do I sow rice?",
+                        "Do you have seeds for wheat?", "Hi, how do I grow rice?"):
+            with self.subTest(message=message):
+                self.assertIsNone(intent_answer(message))
+
+    def test_shop_tags_never_answer(self):
+        self.assertIsNone(intent_answer("Do you take credit cards?"))
+
+    def test_routing_can_be_turned_off(self):
+        with self.settings(CHATBOT_INTENT_ROUTING=False):
+            self.assertIsNone(intent_answer("Hello"))
+
+
+class ChatHistoryTests(TestCase):
+    def setUp(self):
+        self.session = ChatSession.objects.create()
+        # the batched chat-log writer can give several turns the same timestamp
+        created_at = datetime(2024, 5, 1, 12, 0, tzinfo=dt_timezone.utc)
+        self.chats = [
+            ChatQueryMessage.objects.create(session=self.session, message=f"q{n}", response=f"a{n}",
+                                            created_at=created_at)
+            for n in range(5)
+        ]
+        ChatQueryMessage.objects.create(session=ChatSession.objects.create(), message="other visitor",
+                                        response="a", created_at=created_at)
+
+    def test_pages_cover_equal_timestamps_once(self):
+        seen = []
+        before = None
+        while True:
+            page, before = chat_history(self.session.pk, before, page_size=2)
+            seen = page + seen
+            if before is None:
+                break
+        self.assertEqual([chat.pk for chat in seen], [chat.pk for chat in self.chats])
+
+    def test_only_the_sessions_chats(self):
+        page, older = chat_history(self.session.pk, page_size=10)
+        self.assertEqual(len(page), 5)
+        self.assertIsNone(older)
+        self.assertNotIn("other visitor", [chat.message for chat in page])
+
+    def test_invalid_cursor_starts_from_the_newest_page(self):
+        first_page, _ = chat_history(self.session.pk, page_size=2)
+        for cursor in ("garbage", "2024-05-01T12:00:00+00:00|x", "not a date|3", "a|b|c"):
+            with self.subTest(cursor=cursor):
+                page, _ = chat_history(self.session.pk, cursor, page_size=2)
+                self.assertEqual(page, first_page)
+
+
+class FixedEmbeddings:
+    """returns the same query vector for every question"""
+
+    def __init__(self, vector):
+        self.vector = vector
+
+    def embed_query(self, text):
+        return self.vector
+
+
+class UntaggedVectorIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path, True)
+        # as written for a collection ingested with --no-tags: no tag_rows.npy
+        build_vector_index(self.path, ["a", "b", "c"], ["rice", "wheat", "urea"], [{}, {}, None],
+                           [[1.0, 0.0], [0.0, 1.0], [0.7, 0.7]], quantization="float32")
+        self.index = QuantizedVectorIndex(self.path)
+
+    def test_tag_filter_matches_nothing(self):
+        self.assertIsNone(self.index.tag_rows)
+        self.assertEqual(self.index.search([1.0, 0.0], k=2, where={"crop_rice": True}), [])
+        self.assertEqual(self.index.search([1.0, 0.0], k=2, where={"$or": [{"crop_rice": True},
+                                                                          {"crop_untagged": True}]}), [])
+
+    def test_filtered_retrieval_falls_back_to_the_whole_index(self):
+        rag = RAGComponents(FixedEmbeddings([1.0, 0.0]), self.index, None, None, None, None)
+        with self.settings(CHATBOT_RERANK=None), \
+                mock.patch("chatbot.retrieval.query_filter", return_value={"crop_rice": True}):
+            _, results = retrieve(rag, "When do I sow rice?", k=2)
+        self.assertEqual([document.page_content for document, _ in results], ["rice", "urea"])
+
+
+class HashEmbeddings:
+    """deterministic vectors whose values and dimension depend on the model name"""
+
+    def __init__(self, model):
+        self.model = model
+        self.dimensions = 4 if model == "model-a" else 6
+
+    def embed_documents(self, texts):
+        return [[byte / 255 for byte in hashlib.sha256(f"{self.model}:{text}".encode()).digest()[:self.dimensions]]
+                for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class IngestTests(SimpleTestCase):
+    def setUp(self):
+        register_provider("test-hash", "model-a")(HashEmbeddings)
+        self.addCleanup(EMBEDDING_PROVIDERS.pop, "test-hash")
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+        self.data_path = os.path.join(self.workdir, "data")
+        os.mkdir(self.data_path)
+        with open(os.path.join(self.data_path, "rice.txt"), "w", encoding="utf-8") as f:
+            f.write("Transplant rice seedlings after 25 days.")
+        self.chroma_path = os.path.join(self.workdir, "chroma")
+
+    def ingest(self, model, **options):
+        out = StringIO()
+        with self.settings(CHATBOT_EMBEDDING_PROVIDER="test-hash", CHATBOT_EMBEDDING_MODEL=model,
+                           CHATBOT_CHROMA_PATH=self.chroma_path, CHATBOT_VECTOR_STORE="chroma"):
+            call_command("ingest_chroma", data_path=self.data_path, no_tags=True, stdout=out, **options)
+        return out.getvalue()
+
+    def collection(self):
+        from langchain_chroma import Chroma
+
+        return Chroma(persist_directory=self.chroma_path)
+
+    def write(self, name, text):
+        with open(os.path.join(self.data_path, name), "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def test_only_new_and_changed_chunks_are_embedded(self):
+        self.write("urea.txt", "Split urea into three doses.")
+        self.assertIn("2 chunks embedded, 0 retagged, 0 unchanged, 0 removed", self.ingest("model-a"))
+        self.write("urea.txt", "Split urea into two doses.")
+        os.remove(os.path.join(self.data_path, "rice.txt"))
+        self.write("wheat.txt", "Sow wheat in November.")
+        self.assertIn("2 chunks embedded, 0 retagged, 0 unchanged, 1 removed", self.ingest("model-a"))
+        stored = self.collection()._collection.get()
+        self.assertEqual(sorted(stored["documents"]), ["Sow wheat in November.", "Split urea into two doses."])
+        self.assertIn("0 chunks embedded, 0 retagged, 2 unchanged, 0 removed", self.ingest("model-a"))
+
+    def test_new_model_requires_a_rebuild(self):
+        self.assertIn("1 chunks embedded", self.ingest("model-a"))
+        self.assertIn("0 chunks embedded, 0 retagged, 1 unchanged", self.ingest("model-a"))
+        with self.assertRaisesMessage(CommandError, "--rebuild"):
+            self.ingest("model-b")
+        # the model-a vectors are still recorded as model-a
+        check_index_provider(self.collection(), "test-hash:model-a")
+
+        self.assertIn("1 chunks embedded", self.ingest("model-b", rebuild=True))
+        db = self.collection()
+        check_index_provider(db, "test-hash:model-b")
+        [vector] = db._collection.get(include=["embeddings"])["embeddings"]
+        self.assertEqual(len(vector), 6)
+
+
+class FakeLLM:
+    """streams a fixed answer a chunk at a time"""
+
+    def __init__(self, chunks=("Sow ", "in ", "June."), delay=0.0):
+        self.chunks = chunks
+        self.delay = delay
+
+    def stream(self, prompt, **kwargs):
+        for chunk in self.chunks:
+            time.sleep(self.delay)
+            yield chunk
+
+
+class GenerationTimingTests(SimpleTestCase):
+    def test_prefill_excludes_the_admission_wait(self):
+        gate = AdmissionGate(max_concurrent=1, max_queue=4)
+        held = threading.Event()
+
+        def busy():
+            with gate.slot():
+                held.set()
+                time.sleep(0.2)
+
+        other = threading.Thread(target=busy)
+        other.start()
+        held.wait(5)
+        rag = mock.Mock(llm=GatedLLM(FakeLLM(), gate, timeout=5))
+        with trace_request("test") as trace:
+            answer = "".join(views._generate(rag, "prompt"))
+        other.join()
+        self.assertEqual(answer, "Sow in June.")
+        self.assertGreaterEqual(trace.stages["llm_queue"], 0.1)
+        self.assertLess(trace.stages["llm_prefill"], 0.1)
+
+
+class ConversationSummaryTests(TestCase):
+    def setUp(self):
+        self.session = ChatSession.objects.create()
+        self.turns = [ChatMessage.objects.create(session=self.session, message=f"q{n}", response=f"a{n}")
+                      for n in range(20)]
+        self.conversation = Conversation(self.session.pk)
+        self.llm = mock.Mock()
+        self.llm.invoke.return_value = "rice questions"
+        runtime = mock.patch("chatbot.runtime.get_runtime")
+        runtime.start().return_value.components.return_value.llm = self.llm
+        self.addCleanup(runtime.stop)
+        # _summarize closes the connection its thread opened; not the test's
+        closing = mock.patch("chatbot.conversation.connection")
+        closing.start()
+        self.addCleanup(closing.stop)
+
+    @override_settings(CHATBOT_MEMORY_TURNS=4)
+    def test_a_backlog_is_folded_in_oldest_first(self):
+        self.conversation._summarize()
+        self.assertEqual(self.conversation.summary(), ("rice questions", self.turns[7].pk))
+        self.assertIn("Farmer: q0\n", self.llm.invoke.call_args[0][0])
+        self.conversation._summarize()
+        self.assertEqual(self.conversation.summary()[1], self.turns[15].pk)
+        self.assertIn("Farmer: q8\n", self.llm.invoke.call_args[0][0])
+        # the last CHATBOT_MEMORY_TURNS turns stay verbatim
+        self.conversation._summarize()
+        self.assertEqual(self.conversation.summary()[1], self.turns[15].pk)
+        self.assertEqual(self.llm.invoke.call_count, 2)
+
+    @override_settings(CHATBOT_MEMORY_TURNS=4)
+    def test_one_summariser_per_session(self):
+        with mock.patch("chatbot.conversation.threading.Thread") as thread:
+            self.conversation.after_turn()
+            self.conversation.after_turn()
+        self.assertEqual(thread.call_count, 1)
+        self.session.refresh_from_db()
+        self.assertIsNotNone(self.session.summarizing_since)
+
+        # a lock left by a worker that died is taken over
+        ChatSession.objects.filter(pk=self.session.pk).update(
+            summarizing_since=self.session.summarizing_since - timedelta(hours=1))
+        with mock.patch("chatbot.conversation.threading.Thread") as thread:
+            self.conversation.after_turn()
+        self.assertEqual(thread.call_count, 1)
+
+    @override_settings(CHATBOT_MEMORY_TURNS=4)
+    def test_summarising_releases_the_lock(self):
+        ChatSession.objects.filter(pk=self.session.pk).update(summarizing_since=datetime.now(dt_timezone.utc))
+        self.llm.invoke.side_effect = RuntimeError("ollama is down")
+        self.conversation._summarize()
+        self.session.refresh_from_db()
+        self.assertIsNone(self.session.summarizing_since)
+        self.assertEqual(self.session.summarized_until, 0)
+
+
+class ConversationSessionTests(TestCase):
+    def test_viewing_the_page_starts_no_session(self):
+        response = self.client.get("/chatbot/")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(ChatSession.objects.exists())
+        self.assertNotIn(SESSION_KEY, self.client.session)
+
+    def test_session_is_started_on_first_use(self):
+        request = RequestFactory().post("/chatbot/")
+        SessionMiddleware(lambda request: None).process_request(request)
+        self.assertIsNone(Conversation.for_request(request, create=False))
+        conversation = Conversation.for_request(request)
+        self.assertEqual(request.session[SESSION_KEY], conversation.session_id)
+        self.assertEqual(Conversation.for_request(request, create=False).session_id, conversation.session_id)
+
+
+def chunks(*ids):
+    return [(Document(page_content=f"chunk {chunk_id}", metadata={"id": chunk_id}), 0.0) for chunk_id in ids]
+
+
+def chunk_ids(results):
+    return [document.metadata["id"] for document, _ in results]
+
+
+class RerankTests(SimpleTestCase):
+    def test_scores_are_fused_with_the_retrieval_order(self):
+        # the scorer alone would put d first; retrieval put it last
+        results = rerank(lambda query, documents: [0.0, 0.1, 0.2, 0.9], "q", chunks("a", "b", "c", "d"), 2)
+        self.assertEqual(chunk_ids(results), ["a", "d"])
+
+    @override_settings(CHATBOT_RERANK_BUDGET_MS=20)
+    def test_slow_scorer_keeps_the_retrieval_order(self):
+        done = threading.Event()
+        # free the rerank workers for the next test
+        self.addCleanup(done.set)
+
+        def slow(query, documents):
+            done.wait(5)
+            return [1.0] * len(documents)
+
+        self.assertEqual(chunk_ids(rerank(slow, "q", chunks("a", "b", "c"), 2)), ["a", "b"])
+        self.assertEqual(chunk_ids(asyncio.run(arerank(slow, "q", chunks("a", "b", "c"), 2))), ["a", "b"])
+
+    def test_failing_scorer_keeps_the_retrieval_order(self):
+        def broken(query, documents):
+            raise OSError("cross-encoder weights not found")
+
+        with self.assertLogs("chatbot.rerank", "ERROR"):
+            self.assertEqual(chunk_ids(rerank(broken, "q", chunks("a", "b", "c"), 2)), ["a", "b"])
+        with self.assertLogs("chatbot.rerank", "ERROR"):
+            self.assertEqual(chunk_ids(asyncio.run(arerank(broken, "q", chunks("a", "b", "c"), 2))), ["a", "b"])
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+    def setUp(self):
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir, True)
+        self.path = os.path.join(workdir, "cache.sqlite3")
+
+    def test_tiers(self):
+        cache = EmbeddingCache(self.path, max_entries=1)
+        first, second = EmbeddingCache.key("m", "How do I grow  Rice"), EmbeddingCache.key("m", "urea dose")
+        self.assertEqual(first, EmbeddingCache.key("m", " how do i grow rice "))
+        self.assertEqual(cache.lookup(first), (None, "miss"))
+        cache.put(first, [0.5, 0.25])
+        self.assertEqual(cache.lookup(first), ([0.5, 0.25], "memory"))
+        # the LRU holds one entry; the first vector is now only on disk
+        cache.put(second, [1.0, 0.0])
+        self.assertEqual(cache.lookup(first), ([0.5, 0.25], "disk"))
+        # another worker shares the sqlite file
+        self.assertEqual(EmbeddingCache(self.path).lookup(second), ([1.0, 0.0], "disk"))
+
+    def test_disk_tier_keeps_the_newest_rows(self):
+        cache = EmbeddingCache(self.path, max_entries=1, max_disk_entries=3)
+        keys = [EmbeddingCache.key("m", f"question {n}") for n in range(5)]
+        with mock.patch("chatbot.embedding_cache.DISK_PRUNE_INTERVAL", 1):
+            for n, key in enumerate(keys):
+                cache.put(key, [float(n)])
+        self.assertEqual(cache.stats()["disk_evictions"], 2)
+        reopened = EmbeddingCache(self.path)
+        self.assertEqual([reopened.lookup(key)[1] for key in keys], ["miss", "miss", "disk", "disk", "disk"])
+
+    def test_a_smaller_limit_is_applied_on_start(self):
+        cache = EmbeddingCache(self.path)
+        for n in range(4):
+            cache.put(EmbeddingCache.key("m", f"question {n}"), [float(n)])
+        self.assertEqual(EmbeddingCache(self.path, max_disk_entries=1).stats()["disk_evictions"], 3)
+
+
+class CountingRuntime(RAGRuntime):
+    """a RAGRuntime whose index version is set by the test and whose builds are counted"""
+
+    def __init__(self):
+        super().__init__(chroma_path="unused", llm_model="unused", reload_check_seconds=1e-9)
+        self.version = "v1"
+        self.builds = 0
+
+    def index_version(self):
+        return self.version
+
+    def _build(self):
+        self.builds += 1
+        # long enough for every waiting request to notice the new version
+        time.sleep(0.05)
+        return RAGComponents(None, None, None, None, self.version, None)
+
+
+class RuntimeReloadTests(SimpleTestCase):
+    def test_components_are_built_once(self):
+        runtime = CountingRuntime()
+        first = runtime.components()
+        self.assertIs(runtime.components(), first)
+        self.assertEqual(runtime.builds, 1)
+
+    def test_concurrent_requests_rebuild_a_changed_index_once(self):
+        runtime = CountingRuntime()
+        runtime.components()
+        runtime.version = "v2"
+        barrier = threading.Barrier(8)
+        seen = []
+
+        def request():
+            barrier.wait()
+            seen.append(runtime.components().index_version)
+
+        threads = [threading.Thread(target=request) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(runtime.builds, 2)
+        self.assertEqual(seen, ["v2"] * 8)
+
+
+class SemanticAnswerCacheTests(SimpleTestCase):
+    sources = ("data/rice.pdf:3:0",)
+
+    def test_threshold(self):
+        cache = SemanticAnswerCache(threshold=0.95)
+        cache.put([1.0, 0.0], self.sources, "answer", "v1")
+        self.assertEqual(cache.get([2.0, 0.1], self.sources, "v1"), "answer")
+        # cosine similarity 0.8
+        self.assertIsNone(cache.get([0.8, 0.6], self.sources, "v1"))
+        self.assertIsNone(cache.get([1.0, 0.0], ("data/wheat.pdf:1:0",), "v1"))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_ttl(self):
+        cache = SemanticAnswerCache(ttl=60)
+        with mock.patch("chatbot.answer_cache.time") as clock:
+            clock.monotonic.return_value = 1000.0
+            cache.put([1.0, 0.0], self.sources, "answer", "v1")
+            clock.monotonic.return_value = 1059.0
+            self.assertEqual(cache.get([1.0, 0.0], self.sources, "v1"), "answer")
+            clock.monotonic.return_value = 1061.0
+            self.assertIsNone(cache.get([1.0, 0.0], self.sources, "v1"))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_new_index_version_drops_everything(self):
+        cache = SemanticAnswerCache()
+        cache.put([1.0, 0.0], self.sources, "answer", "v1")
+        self.assertIsNone(cache.get([1.0, 0.0], self.sources, "v2"))
+        self.assertIsNone(cache.get([1.0, 0.0], self.sources, "v1"))
+        self.assertEqual(cache.stats()["entries"], 0)
+
+
+def session_request(method="post", path="/chatbot/", **data):
+    request = getattr(RequestFactory(), method)(path, data)
+    SessionMiddleware(lambda request: None).process_request(request)
+    request.user = mock.Mock(is_staff=False)
+    return request
+
+
+def sse_events(response):
+    body = b"".join(response.streaming_content).decode("utf-8")
+    return [json.loads(event[len("data: "):]) for event in body.split("\n\n") if event]
+
+
+@override_settings(CHATBOT_CHAT_LOG_ASYNC=False)
+class StreamViewTests(TestCase):
+    def stream(self, message, chunks):
+        def stream_message(message, history=""):
+            yield from chunks()
+
+        with mock.patch("chatbot.views.stream_message", side_effect=stream_message):
+            response = views.chatbot_stream(session_request(message=message))
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            return sse_events(response)
+
+    def test_tokens_are_sent_as_they_are_generated(self):
+        events = self.stream("When do I sow rice?", lambda: iter(["Sow ", "in June."]))
+        self.assertEqual(events, [{"token": "Sow "}, {"token": "in June."}, {"done": True}])
+        self.assertEqual(ChatQueryMessage.objects.get().response, "Sow in June.")
+
+    def test_overload_is_reported_in_the_stream(self):
+        def overloaded():
+            raise Overloaded(7)
+            yield
+
+        [event] = self.stream("When do I sow rice?", overloaded)
+        self.assertEqual(event["retry_after"], 7)
+        self.assertIn("error", event)
+        self.assertFalse(ChatQueryMessage.objects.exists())
+
+    def test_post_only(self):
+        self.assertEqual(views.chatbot_stream(session_request("get")).status_code, 405)
+
+
+@override_settings(CHATBOT_CHAT_LOG_ASYNC=False)
+class AsyncViewTests(TestCase):
+    async def test_answer_is_saved_in_the_conversation(self):
+        request = session_request(message="When do I sow rice?")
+        with mock.patch("chatbot.views.aanswer_message", mock.AsyncMock(return_value="Sow in June.")):
+            response = await views.achatbot_home(request)
+        self.assertEqual(json.loads(response.content), {"message": "When do I sow rice?", "response": "Sow in June."})
+        chat = await sync_to_async(ChatQueryMessage.objects.get)()
+        self.assertEqual(chat.session_id, request.session[SESSION_KEY])
+
+    async def test_overload_is_a_503(self):
+        overloaded = mock.AsyncMock(side_effect=Overloaded(4))
+        with mock.patch("chatbot.views.aanswer_message", overloaded):
+            response = await views.achatbot_home(session_request(message="When do I sow rice?"))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "4")
+
+
+class AsyncQueryEmbeddingTests(SimpleTestCase):
+    def setUp(self):
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir, True)
+        self.path = os.path.join(workdir, "cache.sqlite3")
+        self.backend = mock.Mock()
+        self.backend.aembed_query = mock.AsyncMock(return_value=[0.6, 0.8])
+
+    def test_cache_misses_call_the_backend_once(self):
+        embeddings = CachedQueryEmbeddings(self.backend, EmbeddingCache(self.path), model_id="m")
+        self.assertEqual(asyncio.run(embeddings.aembed_query("urea dose")), [0.6, 0.8])
+        self.assertEqual(asyncio.run(embeddings.aembed_query("Urea  dose")), [0.6, 0.8])
+        self.backend.aembed_query.assert_awaited_once()
+
+    def test_sqlite_is_read_off_the_event_loop(self):
+        EmbeddingCache(self.path).put(EmbeddingCache.key("m", "urea dose"), [1.0, 0.0])
+        cache = EmbeddingCache(self.path)
+        disk_threads = []
+        lookup = cache.lookup
+
+        def recording_lookup(key, disk=True):
+            if disk:
+                disk_threads.append(threading.get_ident())
+            return lookup(key, disk)
+
+        cache.lookup = recording_lookup
+        embeddings = CachedQueryEmbeddings(self.backend, cache, model_id="m")
+
+        async def query():
+            return threading.get_ident(), await embeddings.aembed_query("urea dose")
+
+        loop_thread, vector = asyncio.run(query())
+        self.assertEqual(vector, [1.0, 0.0])
+        self.assertEqual(len(disk_threads), 1)
+        self.assertNotEqual(disk_threads[0], loop_thread)
+        self.backend.aembed_query.assert_not_awaited()
+
+
+class RecordingEmbeddings:
+    """embeds a text as [its length], remembering every embed_documents call"""
+
+    def __init__(self, model="recording", fail=False):
+        self.model = model
+        self.fail = fail
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        if self.fail:
+            raise ConnectionError("embedding server unreachable")
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class EmbeddingBatcherTests(SimpleTestCase):
+    def concurrently(self, batcher, texts):
+        barrier = threading.Barrier(len(texts))
+        results = {}
+
+        def query(index, text):
+            barrier.wait()
+            try:
+                results[index] = batcher.embed_query(text)
+            except Exception as exc:
+                results[index] = exc
+
+        threads = [threading.Thread(target=query, args=item) for item in enumerate(texts)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [results[index] for index in range(len(texts))]
+
+    def test_concurrent_queries_share_one_call(self):
+        backend = RecordingEmbeddings()
+        batcher = EmbeddingBatcher(backend, window_ms=200, max_batch_size=8)
+        vectors = self.concurrently(batcher, ["rice", "urea dose", "rice", "wheat"])
+        self.assertEqual(vectors, [[4.0], [9.0], [4.0], [5.0]])
+        # identical questions are embedded once
+        [texts] = backend.calls
+        self.assertEqual(sorted(texts), ["rice", "urea dose", "wheat"])
+        self.assertEqual(batcher.stats()["batch_sizes"], {4: 1})
+
+    def test_batches_are_capped(self):
+        backend = RecordingEmbeddings()
+        batcher = EmbeddingBatcher(backend, window_ms=200, max_batch_size=2)
+        self.concurrently(batcher, ["a", "bb", "ccc", "dddd"])
+        self.assertEqual(sorted(len(call) for call in backend.calls), [2, 2])
+
+    def test_a_failed_batch_fails_every_query(self):
+        batcher = EmbeddingBatcher(RecordingEmbeddings(fail=True), window_ms=100)
+        with self.assertLogs("chatbot.embedding_batcher", "ERROR"):
+            errors = self.concurrently(batcher, ["rice", "wheat"])
+        self.assertTrue(all(isinstance(error, ConnectionError) for error in errors))
+
+
+class EmbeddingProviderBatchingTests(SimpleTestCase):
+    def setUp(self):
+        register_provider("test-batching", "model", batches=True)(RecordingEmbeddings)
+        register_provider("test-looping", "model")(RecordingEmbeddings)
+        self.addCleanup(BATCHING_PROVIDERS.discard, "test-batching")
+        for name in ("test-batching", "test-looping"):
+            self.addCleanup(EMBEDDING_PROVIDERS.pop, name)
+
+    @override_settings(CHATBOT_EMBEDDING_BATCHING=True)
+    def test_only_providers_with_a_batch_call_are_batched(self):
+        self.assertIsInstance(get_embedding_function(provider="test-batching"), EmbeddingBatcher)
+        with self.assertLogs("chatbot.get_embedding_function", "WARNING"):
+            embeddings = get_embedding_function(provider="test-looping")
+        self.assertIsInstance(embeddings, RecordingEmbeddings)
+
+    @override_settings(CHATBOT_EMBEDDING_BATCHING=True)
+    def test_callers_can_opt_out(self):
+        self.assertIsInstance(get_embedding_function(batched=False, provider="test-batching"), RecordingEmbeddings)
+
+
+class EmbeddingProviderTests(SimpleTestCase):
+    def test_provider_id(self):
+        with self.settings(CHATBOT_EMBEDDING_PROVIDER="local", CHATBOT_EMBEDDING_MODEL=None):
+            self.assertEqual(get_embedding_provider_id(), "local:sentence-transformers/all-MiniLM-L6-v2")
+        with self.settings(CHATBOT_EMBEDDING_PROVIDER="ollama", CHATBOT_EMBEDDING_MODEL="mxbai-embed-large"):
+            self.assertEqual(get_embedding_provider_id(), "ollama:mxbai-embed-large")
+        with self.settings(CHATBOT_EMBEDDING_PROVIDER="openai"):
+            with self.assertRaises(ImproperlyConfigured):
+                get_embedding_provider_id()
+
+    def test_local_embeddings_are_lists_of_floats(self):
+        encoder = mock.Mock()
+        encoder.encode.side_effect = lambda texts, **kwargs: np.ones((len(texts), 3), dtype=np.float32)
+        with mock.patch.dict("chatbot.get_embedding_function._local_models", {"test-model": encoder}):
+            embeddings = LocalEmbeddings("test-model")
+            self.assertEqual(embeddings.embed_documents(["rice", "wheat"]), [[1.0] * 3, [1.0] * 3])
+            self.assertEqual(embeddings.embed_query("rice"), [1.0] * 3)
+        self.assertTrue(encoder.encode.call_args.kwargs["normalize_embeddings"])
+
+
+class IndexProviderCheckTests(SimpleTestCase):
+    def setUp(self):
+        from langchain_chroma import Chroma
+
+        self.chroma_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.chroma_path, True)
+        record_index_provider(Chroma(persist_directory=self.chroma_path), "ollama:nomic-embed-text")
+
+    def check(self, provider):
+        with self.settings(CHATBOT_CHROMA_PATH=self.chroma_path, CHATBOT_VECTOR_STORE="chroma",
+                           CHATBOT_EMBEDDING_PROVIDER=provider, CHATBOT_EMBEDDING_MODEL=None):
+            return check_chroma_embedding_provider(None)
+
+    def test_matching_provider_passes(self):
+        self.assertEqual(self.check("ollama"), [])
+
+    def test_other_provider_fails_start_up(self):
+        [error] = self.check("bedrock")
+        self.assertEqual(error.id, "chatbot.E001")
+        self.assertIn("ingest_chroma --rebuild", error.msg)
+
+
+class FakeCollection:
+    """the paged get() of a Chroma collection over {id: (text, metadata)}"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def get(self, include, limit, offset):
+        ids = sorted(self.chunks)[offset:offset + limit]
+        return {
+            "ids": ids,
+            "documents": [self.chunks[chunk_id][0] for chunk_id in ids],
+            "metadatas": [self.chunks[chunk_id][1] for chunk_id in ids],
+        }
+
+
+class BM25SyncTests(SimpleTestCase):
+    def setUp(self):
+        self.collection = FakeCollection({
+            "rice:1:0": ("Transplant rice seedlings after 25 days", {"content_hash": "r1"}),
+            "wheat:1:0": ("Sow wheat in November", {"content_hash": "w1"}),
+            "urea:1:0": ("Split urea into three doses", {"content_hash": "u1"}),
+        })
+        self.index = BM25Index()
+        self.assertEqual(self.index.sync(self.collection, page_size=2), (3, 0))
+
+    def test_unchanged_collection_is_not_reindexed(self):
+        self.assertEqual(self.index.sync(self.collection, page_size=2), (0, 0))
+        self.assertEqual(len(self.index), 3)
+
+    def test_changed_and_removed_chunks(self):
+        self.collection.chunks["wheat:1:0"] = ("Sow wheat in late October", {"content_hash": "w2"})
+        del self.collection.chunks["urea:1:0"]
+        self.assertEqual(self.index.sync(self.collection, page_size=2), (1, 1))
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.search("urea doses"), [])
+        self.assertEqual(self.index.search("november"), [])
+        [(document, _)] = self.index.search("october")
+        self.assertEqual(document.page_content, "Sow wheat in late October")
+
+    def test_hybrid_fusion_ranks_agreeing_chunks_first(self):
+        rice, wheat, urea = chunks("rice", "wheat", "urea")
+        fused = reciprocal_rank_fusion([[wheat, rice], [rice, urea]])
+        self.assertEqual(chunk_ids(fused), ["rice", "wheat", "urea"])
+
+    def test_retagged_chunk_is_reindexed(self):
+        self.collection.chunks["rice:1:0"] = ("Transplant rice seedlings after 25 days",
+                                              {"content_hash": "r1", "tag_version": "t2", "crop_rice": True})
+        self.assertEqual(self.index.sync(self.collection, page_size=2), (1, 0))
+        [(document, _)] = self.index.search("seedlings", where={"crop_rice": True})
+        self.assertEqual(document.metadata["tag_version"], "t2")
+
+
+def passage(text, chunk_id):
+    return Document(page_content=text, metadata={"id": chunk_id}), 0.0
+
+
+class BuildContextTests(SimpleTestCase):
+    rice = "Transplant rice seedlings when they are about 25 days old and keep two to three centimetres of standing water."
+
+    def test_near_duplicate_chunks_are_dropped(self):
+        context = build_context([
+            passage(self.rice, "a"),
+            passage("Note: " + self.rice, "b"),
+            passage("Split urea into three doses.", "c"),
+        ], token_budget=1500)
+        self.assertEqual([document.metadata["id"] for document in context.documents], ["a", "c"])
+        self.assertEqual(context.duplicates, 1)
+        self.assertEqual(context.text, CONTEXT_SEPARATOR.join([self.rice, "Split urea into three doses."]))
+        self.assertFalse(context.truncated)
+
+    def test_chunks_stop_at_the_token_budget(self):
+        sentences = " ".join(f"Sentence {i} about field number {i}." for i in range(40))
+        context = build_context([
+            passage(self.rice, "a"),
+            passage(sentences, "b"),
+            passage("Split urea into three doses.", "c"),
+        ], token_budget=100)
+        self.assertTrue(context.truncated)
+        self.assertLessEqual(context.tokens, 100)
+        self.assertEqual(context.tokens, count_tokens(context.text))
+        self.assertEqual([document.metadata["id"] for document in context.documents], ["a", "b"])
+        # the truncated chunk is cut back to a sentence end
+        self.assertTrue(context.text.endswith("."))
+
+    def test_small_remainder_is_not_filled_with_a_fragment(self):
+        context = build_context([passage(self.rice, "a"), passage("Split urea into three doses. " * 5, "b")],
+                                token_budget=40)
+        self.assertEqual([document.metadata["id"] for document in context.documents], ["a"])
+        self.assertEqual(context.text, self.rice)
+        self.assertTrue(context.truncated)
+
+
+class IntentClassifierTests(SimpleTestCase):
+    messages = ["Hi", "Do you take credit cards?", "Tell me a joke!", "How long does shipping take to Taipei?", "?!"]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.classifier = IntentClassifier(FILE)
+
+    def test_batched_classify_matches_dense_forward_pass(self):
+        words = list(self.classifier.vocabulary)
+        results = self.classifier.classify(self.messages)
+        self.assertEqual(len(results), len(self.messages))
+        for message, (tag, probability, _) in zip(self.messages, results):
+            bag = torch.from_numpy(bag_of_words(tokenize(message), words)).unsqueeze(0)
+            with torch.no_grad():
+                probs = torch.softmax(self.classifier.model(bag), dim=1)
+            expected_probability, label = torch.max(probs, dim=1)
+            self.assertEqual(tag, self.classifier.tags[label.item()], message)
+            self.assertAlmostEqual(probability, expected_probability.item(), places=5)
+
+    def test_known_patterns_and_coverage(self):
+        [greeting, payments, funny, delivery, punctuation] = self.classifier.classify(self.messages)
+        self.assertEqual((greeting[0], greeting[2]), ("greeting", 1.0))
+        self.assertEqual(payments[0], "payments")
+        self.assertEqual(funny[0], "funny")
+        # "taipei" is not in the vocabulary
+        self.assertEqual(delivery[0], "delivery")
+        self.assertLess(delivery[2], 1.0)
+        self.assertEqual(punctuation[2], 0.0)
+        self.assertEqual(self.classifier.classify([]), [])
+
+    def test_respond_picks_from_the_intent(self):
+        self.assertIn(self.classifier.respond("thanks"), self.classifier.responses["thanks"])
+        self.assertIsNone(self.classifier.respond("unknown"))
+
+
+def import_train():
+    # train.py runs as a script from chatbot/ and imports its siblings top-level
+    with mock.patch.dict(sys.modules, {"tools": tools, "model": model}):
+        return importlib.import_module("chatbot.train")
+
+
+class TrainTests(SimpleTestCase):
+    def setUp(self):
+        self.train = import_train()
+        self.all_words, self.tags, self.xy = self.train.load_corpus(json_file)
+
+    def test_vectorize_builds_bag_of_words_rows(self):
+        X, y = self.train.vectorize(self.xy, self.all_words, self.tags)
+        self.assertEqual(tuple(X.shape), (len(self.xy), len(self.all_words)))
+        for row, (words, _) in zip(X, self.xy):
+            self.assertEqual(set(row.nonzero().flatten().tolist()), {self.all_words.index(w) for w in words})
+            self.assertEqual(row.sum().item(), len(set(words)))
+        self.assertEqual([self.tags[label] for label in y.tolist()], [tag for _, tag in self.xy])
+
+    def test_exported_model_serves_the_classifier(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        export = os.path.join(directory, "intent_model.pt")
+        argv = ["train.py", "--intents", str(json_file), "--output", os.path.join(directory, "data.pth"),
+                "--export", export, "--max-epochs", "300"]
+        torch.manual_seed(0)
+        with mock.patch.object(sys, "argv", argv), redirect_stdout(StringIO()):
+            self.train.main()
+        classifier = IntentClassifier(export)
+        self.assertEqual(classifier.tags, self.tags)
+        self.assertEqual(list(classifier.vocabulary), self.all_words)
+        tags = [tag for tag, _, _ in classifier.classify(["Hi", "Do you accept Mastercard?", "Tell me a joke!"])]
+        self.assertEqual(tags, ["greeting", "payments", "funny"])
+
+
+class AdmissionGateTests(SimpleTestCase):
+    def test_full_queue_is_rejected(self):
+        gate = AdmissionGate(max_concurrent=1, max_queue=1)
+        release = threading.Event()
+        with gate.slot():
+            waiting = threading.Thread(target=self._hold, args=(gate, release))
+            waiting.start()
+            while gate.stats()["queued"] < 1:
+                time.sleep(0.001)
+            with self.assertRaises(Overloaded) as raised:
+                with gate.slot():
+                    pass
+        release.set()
+        waiting.join()
+        self.assertEqual(raised.exception.reason, "queue full")
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+        self.assertEqual(gate.stats()["rejected"], 1)
+        self.assertEqual(gate.stats()["active"], 0)
+
+    @staticmethod
+    def _hold(gate, release):
+        with gate.slot(timeout=5):
+            release.wait(5)
+
+    def test_deadline_leaves_the_queue(self):
+        gate = AdmissionGate(max_concurrent=1, max_queue=4)
+        with gate.slot():
+            with self.assertRaises(Overloaded) as raised:
+                with gate.slot(timeout=0.01):
+                    pass
+            self.assertEqual(gate.stats()["queued"], 0)
+        self.assertEqual(raised.exception.reason, "deadline exceeded")
+        self.assertEqual(gate.stats()["timed_out"], 1)
+        self.assertEqual(gate.stats()["active"], 0)
+
+
+class OverloadedViewTests(TestCase):
+    def test_busy_backend_returns_503_and_records_the_event(self):
+        traces = []
+        registry.observers.append(traces.append)
+        self.addCleanup(registry.observers.remove, traces.append)
+        with mock.patch.object(views, "answer_message", side_effect=Overloaded(retry_after=3)), \
+                mock.patch.object(views, "save_chat") as save_chat:
+            response = views.chatbot_home(session_request(message="How do I sow wheat?"))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "3")
+        self.assertEqual(json.loads(response.content)["retry_after"], 3)
+        save_chat.assert_not_called()
+        [trace] = traces
+        self.assertEqual(trace.events["overloaded"], 1)
+
+
+@mock.patch.object(views, "get_keepalives", lambda: [])
+class MetricsViewTests(SimpleTestCase):
+    def test_hidden_from_visitors(self):
+        response = views.chatbot_metrics(session_request("get", "/chatbot/metrics/"))
+        self.assertEqual(response.status_code, 404)
+
+    def test_staff_see_the_snapshot(self):
+        request = session_request("get", "/chatbot/metrics/")
+        request.user.is_staff = True
+        response = views.chatbot_metrics(request)
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.content)
+        self.assertIn("events", body["pipeline"])
+        self.assertEqual(body["llm_keepalive"], [])
+
+    @override_settings(CHATBOT_METRICS_PUBLIC=True)
+    def test_public_setting_opens_the_endpoint(self):
+        response = views.chatbot_metrics(session_request("get", "/chatbot/metrics/"))
+        self.assertEqual(response.status_code, 200)
+
+
+class RequestTraceTests(SimpleTestCase):
+    def test_stages_sizes_and_events_reach_the_registry(self):
+        traces = []
+        registry.observers.append(traces.append)
+        self.addCleanup(registry.observers.remove, traces.append)
+        with trace_request("chat"):
+            with stage("retrieval"):
+                time.sleep(0.01)
+            note("context_tokens", 420)
+            event("embedding_cache_hit")
+            set_route("rag")
+        [trace] = traces
+        self.assertEqual(trace.route, "rag")
+        self.assertGreaterEqual(trace.stages["retrieval"], 0.01)
+        self.assertEqual(trace.values["context_tokens"], 420)
+        self.assertEqual(trace.events["embedding_cache_hit"], 1)
+
+    def test_registry_aggregates_traces(self):
+        local = MetricsRegistry()
+        with mock.patch("chatbot.metrics.registry", local):
+            for _ in range(2):
+                with trace_request("chat"):
+                    event("answer_cache_miss")
+        snapshot = local.snapshot()
+        self.assertEqual(snapshot["events"], {"answer_cache_miss": 2})
+        self.assertEqual(snapshot["stages_ms"]["chat.total"]["count"], 2)
+
+    def test_stage_outside_a_request_is_a_no_op(self):
+        with stage("retrieval"):
+            note("chunks", 3)
+            event("hit")
+
+
+def post_json(url, payload):
+    request = urllib.request.Request(url, json.dumps(payload).encode(), {"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return [json.loads(line) for line in response.read().splitlines() if line]
+
+
+class StubOllamaServerTests(SimpleTestCase):
+    def setUp(self):
+        self.server = StubOllamaServer(tokens_per_second=1000.0, response_tokens=3, dimensions=8).start()
+        self.addCleanup(self.server.stop)
+
+    def test_embeddings_are_deterministic_unit_vectors(self):
+        [single] = post_json(f"{self.server.url}/api/embeddings", {"prompt": "rice"})
+        [batch] = post_json(f"{self.server.url}/api/embed", {"input": ["rice", "wheat"]})
+        self.assertEqual(single["embedding"], stub_vector("rice", 8))
+        self.assertEqual(batch["embeddings"][0], single["embedding"])
+        self.assertAlmostEqual(sum(x * x for x in batch["embeddings"][1]), 1.0)
+
+    def test_generation_streams_and_reuses_the_shared_prompt_prefix(self):
+        lines = post_json(f"{self.server.url}/api/generate", {"prompt": "context about rice question one"})
+        self.assertEqual("".join(line["response"] for line in lines), "token0 token1 token2 ")
+        self.assertEqual(lines[-1]["prompt_eval_count"], 5)
+        lines = post_json(f"{self.server.url}/api/generate", {"prompt": "context about rice question two"})
+        self.assertEqual(lines[-1]["prompt_eval_count"], 1)
+        self.assertEqual(self.server.requests, 2)
+
+
+class LoadTestReportTests(SimpleTestCase):
+    def test_percentile_interpolates(self):
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(percentile([10, 20, 30, 40], 50), 25)
+        self.assertEqual(percentile([10, 20, 30, 40], 100), 40)
+
+    def test_collector_summarizes_traces(self):
+        collector = TraceCollector()
+        for seconds in (0.1, 0.3):
+            with trace_request("chat") as trace:
+                trace.stages["retrieval"] += seconds
+                event("answer_cache_miss")
+            collector(trace)
+        report = collector.report()
+        self.assertEqual(report["routes"], {"chat": 2})
+        self.assertEqual(report["events"], {"answer_cache_miss": 2})
+        self.assertEqual(report["stages_ms"]["retrieval"]["count"], 2)
+        self.assertAlmostEqual(report["stages_ms"]["retrieval"]["p50"], 200)
+
+    def test_synthetic_corpus_is_reproducible(self):
+        self.assertEqual(synthetic_corpus(20, seed=1), synthetic_corpus(20, seed=1))
+        self.assertEqual(len({chunk_id for chunk_id, _ in synthetic_corpus(20)}), 20)
+
+
+class QuantizedVectorIndexTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        rng = np.random.default_rng(0)
+        cls.vectors = rng.normal(size=(300, 32)).astype(np.float32)
+        cls.ids = [f"doc.txt:0:{row}" for row in range(300)]
+        cls.texts = [f"chunk {row}" for row in range(300)]
+        cls.metadatas = [{"crop_rice": True} if row % 2 == 0 else {"crop_wheat": True} for row in range(300)]
+
+    def build(self, **options):
+        path = os.path.join(tempfile.mkdtemp(), "index")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path), True)
+        meta = build_vector_index(path, self.ids, self.texts, self.metadatas, self.vectors, **options)
+        return meta, QuantizedVectorIndex(path, FixedEmbeddings(self.vectors[7].tolist()))
+
+    def test_every_quantization_finds_the_stored_vector(self):
+        for quantization in ("float32", "float16", "int8"):
+            for rescore in (True, False):
+                with self.subTest(quantization=quantization, rescore=rescore):
+                    meta, index = self.build(quantization=quantization, rescore=rescore)
+                    self.assertEqual(meta["count"], 300)
+                    for row in (0, 41, 299):
+                        [(found, score)] = index.search(self.vectors[row], k=1)
+                        self.assertEqual(index._collection.record(found)["id"], self.ids[row])
+                        self.assertAlmostEqual(score, 1.0, places=1)
+
+    def test_ivf_and_projection(self):
+        meta, index = self.build(lists=8, dimensions=16)
+        self.assertEqual((meta["lists"], meta["dimensions"], meta["source_dimensions"]), (8, 16, 32))
+        index.nprobe = 8
+        results = index.search(self.vectors[12], k=5)
+        self.assertEqual(index._collection.record(results[0][0])["id"], self.ids[12])
+        self.assertEqual([score for _, score in results], sorted((score for _, score in results), reverse=True))
+
+    def test_tag_filter_limits_the_rows(self):
+        _, index = self.build()
+        results = index.similarity_search_with_score("chunk 7", k=5, filter={"crop_rice": True})
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(document.metadata == {"crop_rice": True} for document, _ in results))
+        [(document, _)] = index.similarity_search_with_score("chunk 7", k=1, filter={
+            "$or": [{"crop_rice": True}, {"crop_wheat": {"$eq": True}}],
+        })
+        self.assertEqual(document.page_content, "chunk 7")
+        with self.assertRaises(ValueError):
+            index.search(self.vectors[0], where={"crop_rice": False})
+
+
+class OllamaKeepAliveTests(SimpleTestCase):
+    def setUp(self):
+        self.server = StubOllamaServer(cold_start=0.05, tokens_per_second=1000.0).start()
+        self.addCleanup(self.server.stop)
+
+    def test_preload_warms_the_model_and_prompt_prefix(self):
+        keepalive = OllamaKeepAlive(self.server.url, "stub", interval=0, prefix="You are a farming assistant.")
+        timings = keepalive.preload()
+        self.assertTrue(self.server.loaded)
+        self.assertGreaterEqual(timings["load_seconds"], 0.05)
+        self.assertEqual(timings["prompt_eval_tokens"], 5)
+        # the prefix is now cached, so a prompt starting with it evaluates only the rest
+        [*_, final] = post_json(f"{self.server.url}/api/generate",
+                                {"prompt": "You are a farming assistant. When to sow rice?"})
+        self.assertEqual(final["prompt_eval_count"], 4)
+        self.assertEqual(keepalive.heartbeat()["load_seconds"], 0.0)
+        self.assertEqual(keepalive.stats()["preloads"], 2)
+
+    def test_unreachable_server_counts_a_failure(self):
+        with self.assertLogs("chatbot.keepalive", "WARNING"):
+            keepalive = OllamaKeepAlive("http://127.0.0.1:9", "stub", interval=0, timeout=1).start()
+            keepalive._thread.join(5)
+        stats = keepalive.stats()
+        self.assertEqual((stats["failures"], stats["preloads"], stats["running"]), (1, 0, False))
+
+
+class OllamaTimingsTests(SimpleTestCase):
+    def test_generation_info_is_recorded_on_the_trace(self):
+        info = {"load_duration": 2_000_000_000, "prompt_eval_duration": 250_000_000, "prompt_eval_count": 37}
+        with trace_request("chat") as trace:
+            OllamaTimings().on_llm_end(LLMResult(generations=[[Generation(text="ok", generation_info=info)]]))
+            OllamaTimings().on_llm_end(LLMResult(generations=[]))
+        self.assertEqual(trace.stages["llm_load"], 2.0)
+        self.assertEqual(trace.stages["llm_prompt_eval"], 0.25)
+        self.assertEqual(trace.values["prompt_eval_tokens"], 37)
+
+
+class FailingLLM:
+    def __init__(self):
+        self.calls = 0
+
+    def invoke(self, prompt, **kwargs):
+        self.calls += 1
+        raise ConnectionError("ollama is down")
+
+    def stream(self, prompt, **kwargs):
+        self.calls += 1
+        raise ConnectionError("ollama is down")
+        yield
+
+
+class OllamaPoolTests(SimpleTestCase):
+    def pool(self, *llms, **options):
+        pool = OllamaPool([(f"http://ollama-{i}:11434", llm) for i, llm in enumerate(llms)],
+                          health_check_seconds=0, **options)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_least_outstanding_backend_is_chosen(self):
+        pool = self.pool(FakeLLM(), FakeLLM())
+        first = pool.stream("question")
+        next(first)
+        # backend 0 is still streaming, so the next call goes to backend 1
+        self.assertEqual("".join(pool.stream("question")), "Sow in June.")
+        self.assertEqual([b["outstanding"] for b in pool.stats()["backends"]], [1, 0])
+        self.assertEqual([b["requests"] for b in pool.stats()["backends"]], [1, 1])
+        first.close()
+        self.assertEqual([b["outstanding"] for b in pool.stats()["backends"]], [0, 0])
+
+    def test_failed_call_is_retried_and_backend_ejected(self):
+        failing = FailingLLM()
+        pool = self.pool(failing, FakeLLM(), max_failures=2)
+        with self.assertLogs("chatbot.llm_pool", "WARNING"):
+            for _ in range(3):
+                self.assertEqual("".join(pool.stream("question")), "Sow in June.")
+        # ejected after two failures in a row, so the third call skips it
+        self.assertEqual(failing.calls, 2)
+        stats = pool.stats()
+        self.assertEqual(stats["healthy"], 1)
+        self.assertEqual(stats["backends"][0]["ejections"], 1)
+        self.assertEqual(stats["backends"][1]["requests"], 3)
+
+    def test_error_surfaces_when_every_backend_fails(self):
+        pool = self.pool(FailingLLM(), FailingLLM())
+        with self.assertLogs("chatbot.llm_pool", "WARNING"), self.assertRaises(ConnectionError):
+            pool.invoke("question")
+        self.assertEqual([b["errors"] for b in pool.stats()["backends"]], [1, 1])
+
+    def test_health_check_readmits_a_recovered_backend(self):
+        server = StubOllamaServer().start()
+        self.addCleanup(server.stop)
+        pool = OllamaPool([(server.url, FakeLLM())], health_check_seconds=0)
+        [backend] = pool.backends
+        with self.assertLogs("chatbot.llm_pool", "WARNING"):
+            pool._eject(backend, "test")
+        self.assertTrue(pool.check(backend))
+        self.assertEqual(pool.stats()["healthy"], 1)
+
+
+class ChatLogWriterTests(TransactionTestCase):
+    def test_close_drains_the_queue(self):
+        session = ChatSession.objects.create()
+        # nothing is flushed on its own within the test
+        writer = ChatLogWriter(batch_size=100, flush_seconds=60)
+        for n in range(3):
+            writer.write(f"q{n}", f"a{n}", session.pk)
+        self.assertEqual(len(writer.pending(session.pk)), 3)
+        writer.close()
+        self.assertEqual(
+            list(ChatQueryMessage.objects.filter(session=session).order_by("id").values_list("message", flat=True)),
+            ["q0", "q1", "q2"],
+        )
+        self.assertEqual(session.messages.count(), 3)
+        self.assertEqual(writer.pending(session.pk), [])
+        self.assertEqual(writer.stats()["written"], 3)
+        with self.assertRaises(RuntimeError):
+            writer.write("late", "a", session.pk)
+
+
+class ArchiveChatLogsTests(TestCase):
+    def setUp(self):
+        self.archive = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive)
+        self.old_session, self.active_session = ChatSession.objects.create(), ChatSession.objects.create()
+        for n in range(3):
+            ChatMessage.objects.create(message=f"old {n}", response="a", session=self.old_session)
+        ChatMessage.objects.create(message="recent", response="a", session=self.active_session)
+        old = datetime(2025, 3, 14, tzinfo=dt_timezone.utc)
+        ChatMessage.objects.filter(session=self.old_session).update(created_at=old)
+        ChatSession.objects.update(created_at=old)
+
+    def archive_logs(self, *args):
+        call_command("archive_chat_logs", "--days", "90", "--archive-path", self.archive, "--batch-size", "2",
+                     *args, stdout=StringIO())
+
+    def test_dry_run_changes_nothing(self):
+        self.archive_logs("--dry-run")
+        self.assertEqual(ChatMessage.objects.count(), 4)
+        self.assertEqual(os.listdir(self.archive), [])
+
+    def test_old_turns_and_finished_sessions_are_archived(self):
+        self.archive_logs()
+        self.assertEqual(list(ChatMessage.objects.values_list("message", flat=True)), ["recent"])
+        # the active session still has a turn in the database
+        self.assertEqual(list(ChatSession.objects.values_list("pk", flat=True)), [self.active_session.pk])
+        with gzip.open(Path(self.archive) / f"{ChatMessage._meta.db_table}-2025-03.jsonl.gz") as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual([row["message"] for row in rows], ["old 0", "old 1", "old 2"])
+        with gzip.open(Path(self.archive) / f"{ChatSession._meta.db_table}-2025-03.jsonl.gz") as f:
+            self.assertEqual([json.loads(line)["id"] for line in f], [self.old_session.pk])
+
+
+class EntityTaggingTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        directory = tempfile.mkdtemp()
+        crops = os.path.join(directory, "crops.csv")
+        with open(crops, "w") as f:
+            f.write("Crop,State\nRice,Assam\nMoong(Green Gram),Odisha\nWheat,Punjab\nTotal foodgrain,Punjab\n")
+        try:
+            cls.tagger = EntityTagger(load_vocabulary([(crops, "Crop", "crop"), (crops, "State", "region")]))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_crops_regions_and_topics_with_synonyms(self):
+        self.assertEqual(self.tagger.tag("How much urea for paddy in Assam?"),
+                         {"crop": {"rice"}, "region": {"assam"}, "topic": {"fertiliser"}})
+        self.assertEqual(self.tagger.tag("Aphids on mung bean in Orissa"),
+                         {"crop": {"moong"}, "region": {"odisha"}, "topic": {"pests"}})
+        # "total foodgrain" is not a crop, and "gram" alone is a unit
+        self.assertEqual(self.tagger.tag("50 gram of total foodgrain"), {})
+
+    def test_metadata_and_filter_agree(self):
+        general = self.tagger.metadata("Transplant paddy seedlings after 25 days")
+        self.assertEqual(general["tag_version"], self.tagger.version)
+        self.assertTrue(general["crop_rice"] and general["region_untagged"] and general["topic_sowing"])
+        where = metadata_filter(self.tagger.tag("When do I sow rice in Punjab?"))
+        self.assertEqual(where, {"$and": [{"crop_rice": True},
+                                          {"$or": [{"region_punjab": True}, {"region_untagged": True}]}]})
+        # advice naming no region applies to every region; another crop does not
+        self.assertTrue(matches(general, where))
+        self.assertFalse(matches(self.tagger.metadata("Sow wheat in November"), where))
+        self.assertIsNone(metadata_filter(self.tagger.tag("Hello there")))
+
+
+class RetrievalBenchmarkTests(SimpleTestCase):
+    def write_labels(self, text):
+        handle, path = tempfile.mkstemp(suffix=".jsonl")
+        with os.fdopen(handle, "w") as f:
+            f.write(text)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_load_labels(self):
+        path = self.write_labels(
+            '{"question": "When to sow rice?", "relevant": ["data/rice.pdf:3"]}\n\n'
+            '{"question": "Urea dose?", "relevant": "data/urea.pdf"}\n'
+        )
+        self.assertEqual(load_labels(path), [("When to sow rice?", ["data/rice.pdf:3"]),
+                                             ("Urea dose?", ["data/urea.pdf"])])
+        with self.assertRaisesMessage(CommandError, ":1: no relevant chunks"):
+            load_labels(self.write_labels('{"question": "Hi", "relevant": []}\n'))
+        with self.assertRaisesMessage(CommandError, ":2: expected"):
+            load_labels(self.write_labels('{"question": "Hi", "relevant": ["a"]}\n{"question": "x"}\n'))
+
+    def test_score_matches_chunks_pages_and_sources(self):
+        retrieved = ["data/wheat.pdf:1:0", "data/rice.pdf:3:2", "data/urea.pdf:7:0"]
+        self.assertEqual(score(retrieved, ["data/rice.pdf:3"]), (1.0, 0.5))
+        self.assertEqual(score(retrieved, ["data/urea.pdf", "data/maize.pdf"]), (0.5, 1 / 3))
+        # a page label does not match a page that merely starts with the same digits
+        self.assertEqual(score(["data/rice.pdf:30:0"], ["data/rice.pdf:3"]), (0.0, 0.0))
+
+    def test_configurations_skip_parameters_chroma_ignores(self):
+        options = {"store": ["chroma", "numpy"], "quantization": ["int8", "float16"], "dimensions": [0],
+                   "lists": [0, 16], "nprobe": [4, 8], "rescore_factor": [4], "mode": ["vector"],
+                   "rerank": ["none"], "metadata_filter": ["on"], "k": [5]}
+        configs = list(configurations(options))
+        self.assertEqual(sum(config["store"] == "chroma" for config in configs), 1)
+        # no IVF lists: nprobe does not matter
+        self.assertEqual(len([c for c in configs if c["store"] == "numpy" and not c["lists"]]), 2)
+        self.assertEqual(len([c for c in configs if c["store"] == "numpy" and c["lists"]]), 4)
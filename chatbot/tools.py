@@ -1,31 +1,31 @@
-from typing import List
-
-from django.conf import settings
-#from .models import ChatMessage
-
-#-------Import Pytorch packages------------
 import random
-import sys
+import re
 import json
-import torch
-import torch.nn as nn
+import threading
+from functools import lru_cache
 from pathlib import Path
-#from .nltk_utils import bag_of_words, tokenize
 
 import numpy as np
-import nltk
-# nltk.download('punkt')
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
 from nltk.stem.porter import PorterStemmer
 stemmer = PorterStemmer()
 
+# like nltk.word_tokenize for chat messages: "That's it!" -> That 's it !
+_token = re.compile(r"\w+|'\w+|[^\w\s]")
+
+
 def tokenize(sentence):
     """
     split sentence into array of words/tokens
     a token can be a word or punctuation character, or number
     """
-    return nltk.word_tokenize(sentence)
+    return _token.findall(sentence)
 
 
+@lru_cache(maxsize=100000)
 def stem(word):
     """
     stemming = find the root form of the word
@@ -46,24 +46,23 @@ def bag_of_words(tokenized_sentence, words):
     words = ["hi", "hello", "I", "you", "bye", "thank", "cool"]
     bog   = [  0 ,    1 ,    0 ,   1 ,    0 ,    0 ,      0]
     """
-    # stem each word
-    sentence_words = [stem(word) for word in tokenized_sentence]
-    # initialize bag with 0 for each word
+    index = {w: idx for idx, w in enumerate(words)}
     bag = np.zeros(len(words), dtype=np.float32)
-    for idx, w in enumerate(words):
-        if w in sentence_words: 
+    for word in tokenized_sentence:
+        idx = index.get(stem(word))
+        if idx is not None:
             bag[idx] = 1
-
     return bag
 
+
 class NeuralNet(nn.Module):
     def __init__(self, input_size, hidden_size, num_classes):
         super(NeuralNet, self).__init__()
-        self.l1 = nn.Linear(input_size, hidden_size) 
-        self.l2 = nn.Linear(hidden_size, hidden_size) 
+        self.l1 = nn.Linear(input_size, hidden_size)
+        self.l2 = nn.Linear(hidden_size, hidden_size)
         self.l3 = nn.Linear(hidden_size, num_classes)
         self.relu = nn.ReLU()
-    
+
     def forward(self, x):
         out = self.l1(x)
         out = self.relu(out)
@@ -72,56 +71,111 @@ class NeuralNet(nn.Module):
         out = self.l3(out)
         # no activation and no softmax at the end
         return out
-    
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
-json_file = '../chatbot/intents.json'
-FILE = '../chatbot/data.pth'
-
-with open(json_file , 'r') as json_data:
-    intents = json.load(json_data)
 
-data = torch.load(FILE, weights_only=True)
 
-input_size = data["input_size"]
-hidden_size = data["hidden_size"]
-output_size = data["output_size"]
-all_words = data['all_words']
-tags = data['tags']
-model_state = data["model_state"]
-
-model = NeuralNet(input_size, hidden_size, output_size).to(device)
-model.load_state_dict(model_state)
-model.eval()
+json_file = Path(__file__).resolve().parent / 'intents.json'
+FILE = Path(__file__).resolve().parent / 'data.pth'
+# written by train.py: TorchScript network with the vocabulary embedded
+SCRIPTED_FILE = Path(__file__).resolve().parent / 'intent_model.pt'
 bot_name = "Meng-Chin"
 
 
-def ask_with_completion (message: str) -> str:
+class IntentClassifier:
+    """
+    Bag-of-words intent classifier loaded from intent_model.pt (or the
+    older data.pth checkpoint) and intents.json.
+    classify() takes a list of messages and runs them through the network in
+    one batched forward pass. The bag is never built densely: the first
+    layer is evaluated as a sum of the weight columns of the words present
+    (embedding_bag), so the cost per message depends on its length, not on
+    the vocabulary size. Parameters are read-only after loading, so one
+    instance can serve concurrent requests.
+    """
+
+    def __init__(self, model_file=None, intents_file=json_file):
+        if model_file is None:
+            model_file = SCRIPTED_FILE if SCRIPTED_FILE.exists() else FILE
+        if str(model_file).endswith('.pt'):
+            # single load: compiled network plus vocabulary, nothing to rebuild
+            extra_files = {"vocabulary.json": ""}
+            model = torch.jit.load(str(model_file), map_location='cpu', _extra_files=extra_files)
+            data = json.loads(extra_files["vocabulary.json"])
+        else:
+            data = torch.load(model_file, weights_only=True)
+            model = NeuralNet(data["input_size"], data["hidden_size"], data["output_size"])
+            model.load_state_dict(data["model_state"])
+        model.eval()
+        self.vocabulary = {w: idx for idx, w in enumerate(data['all_words'])}
+        self.tags = data['tags']
+        self.model = model
+        # (vocabulary, hidden) so each word's column of l1 is one row
+        self._l1_weight = model.l1.weight.detach().t().contiguous()
+        with open(intents_file, 'r') as json_data:
+            intents = json.load(json_data)
+        self.responses = {intent['tag']: intent['responses'] for intent in intents['intents']}
+
+    def _indices(self, message):
+        stems = [stem(w) for w in tokenize(message)]
+        indices = {self.vocabulary[s] for s in stems if s in self.vocabulary}
+        # coverage ignores punctuation, which never carries the intent
+        words = [s for s in stems if any(c.isalnum() for c in s)]
+        coverage = sum(1 for s in words if s in self.vocabulary) / len(words) if words else 0.0
+        return sorted(indices), coverage
+
+    @torch.no_grad()
+    def classify(self, messages):
+        """return [(tag, probability, share of the message's words in the vocabulary), ...]"""
+        if not messages:
+            return []
+        flat, offsets, coverages = [], [], []
+        for message in messages:
+            indices, coverage = self._indices(message)
+            offsets.append(len(flat))
+            flat.extend(indices)
+            coverages.append(coverage)
+        hidden = F.embedding_bag(
+            torch.tensor(flat, dtype=torch.long), self._l1_weight,
+            torch.tensor(offsets, dtype=torch.long), mode='sum',
+        ) + self.model.l1.bias
+        out = self.model.l3(self.model.relu(self.model.l2(self.model.relu(hidden))))
+        probs, predicted = torch.max(torch.softmax(out, dim=1), dim=1)
+        return [
+            (self.tags[label], prob, coverage)
+            for label, prob, coverage in zip(predicted.tolist(), probs.tolist(), coverages)
+        ]
+
+    def respond(self, tag):
+        return random.choice(self.responses[tag]) if self.responses.get(tag) else None
+
+
+_classifier = None
+_classifier_lock = threading.Lock()
+
+
+def get_classifier():
+    """return the IntentClassifier shared by this process, loading it on first use"""
+    global _classifier
+    if _classifier is None:
+        with _classifier_lock:
+            if _classifier is None:
+                _classifier = IntentClassifier()
+    return _classifier
+
+
+def classifier_loaded():
+    return _classifier is not None
+
+
+def ask_with_completion(message: str) -> str:
+    [(tag, prob, _)] = get_classifier().classify([message])
+    if prob > 0.75:
+        return get_classifier().respond(tag)
+    return "I do not understand..."
+
+
+if __name__ == "__main__":
     while True:
-        # sentence = "do you use credit cards?"
         sentence = input("You: ")
         if sentence == "quit":
             break
-
-        sentence = tokenize(sentence)
-        X = bag_of_words(sentence, all_words)
-        X = X.reshape(1, X.shape[0])
-        X = torch.from_numpy(X).to(device)
-
-        output = model(X)
-        _, predicted = torch.max(output, dim=1)
-
-        tag = tags[predicted.item()]
-
-        probs = torch.softmax(output, dim=1)
-        prob = probs[0][predicted.item()]
-        response = []
-        if prob.item() > 0.75:
-            for intent in intents['intents']:
-                if tag == intent["tag"]:
-                    response = random.choice(intent['responses'])
-                    #print(f"{bot_name}: {random.choice(intent['responses'])}")
-                    return response
-        else:
-            response = "I do not understand..."
-            #print(f"{bot_name}: I do not understand...")
\ No newline at end of file
+        print(f"{bot_name}: {ask_with_completion(sentence)}")
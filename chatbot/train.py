@@ -1,129 +1,129 @@
-import numpy as np
-import random
+import argparse
 import json
+import time
 
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
 
-from nltk_utils import bag_of_words, tokenize, stem
+from tools import tokenize, stem
 from model import NeuralNet
 
-with open('intents.json', 'r') as f:
-    intents = json.load(f)
-
-all_words = []
-tags = []
-xy = []
-# loop through each sentence in our intents patterns
-for intent in intents['intents']:
-    tag = intent['tag']
-    # add to tag list
-    tags.append(tag)
-    for pattern in intent['patterns']:
-        # tokenize each word in the sentence
-        w = tokenize(pattern)
-        # add to our words list
-        all_words.extend(w)
-        # add to xy pair
-        xy.append((w, tag))
-
-# stem and lower each word
 ignore_words = ['?', '.', '!']
-all_words = [stem(w) for w in all_words if w not in ignore_words]
-# remove duplicates and sort
-all_words = sorted(set(all_words))
-tags = sorted(set(tags))
-
-print(len(xy), "patterns")
-print(len(tags), "tags:", tags)
-print(len(all_words), "unique stemmed words:", all_words)
-
-# create training data
-X_train = []
-y_train = []
-for (pattern_sentence, tag) in xy:
-    # X: bag of words for each pattern_sentence
-    bag = bag_of_words(pattern_sentence, all_words)
-    X_train.append(bag)
+
+
+def load_corpus(intents_file):
+    with open(intents_file, 'r') as f:
+        intents = json.load(f)
+
+    all_words = set()
+    tags = set()
+    xy = []
+    # loop through each sentence in our intents patterns
+    for intent in intents['intents']:
+        tag = intent['tag']
+        tags.add(tag)
+        for pattern in intent['patterns']:
+            # tokenize, stem and lower each word
+            w = [stem(word) for word in tokenize(pattern) if word not in ignore_words]
+            all_words.update(w)
+            xy.append((w, tag))
+    return sorted(all_words), sorted(tags), xy
+
+
+def vectorize(xy, all_words, tags):
+    """
+    build the whole training set as one (patterns, vocabulary) tensor of
+    bag-of-words rows plus a label tensor, without a per-word loop over
+    the vocabulary
+    """
+    index = {w: i for i, w in enumerate(all_words)}
+    tag_index = {tag: i for i, tag in enumerate(tags)}
+    rows, cols = [], []
+    for row, (words, _) in enumerate(xy):
+        for col in {index[w] for w in words}:
+            rows.append(row)
+            cols.append(col)
+    X = torch.zeros(len(xy), len(all_words))
+    X[rows, cols] = 1.0
     # y: PyTorch CrossEntropyLoss needs only class labels, not one-hot
-    label = tags.index(tag)
-    y_train.append(label)
-
-X_train = np.array(X_train)
-y_train = np.array(y_train)
-
-# Hyper-parameters 
-num_epochs = 1000
-batch_size = 8
-learning_rate = 0.001
-input_size = len(X_train[0])
-hidden_size = 8
-output_size = len(tags)
-print(input_size, output_size)
-
-class ChatDataset(Dataset):
-
-    def __init__(self):
-        self.n_samples = len(X_train)
-        self.x_data = X_train
-        self.y_data = y_train
-
-    # support indexing such that dataset[i] can be used to get i-th sample
-    def __getitem__(self, index):
-        return self.x_data[index], self.y_data[index]
-
-    # we can call len(dataset) to return the size
-    def __len__(self):
-        return self.n_samples
-
-dataset = ChatDataset()
-train_loader = DataLoader(dataset=dataset,
-                          batch_size=batch_size,
-                          shuffle=True,
-                          num_workers=0)
-
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
-model = NeuralNet(input_size, hidden_size, output_size).to(device)
-
-# Loss and optimizer
-criterion = nn.CrossEntropyLoss()
-optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
-
-# Train the model
-for epoch in range(num_epochs):
-    for (words, labels) in train_loader:
-        words = words.to(device)
-        labels = labels.to(dtype=torch.long).to(device)
-        
-        # Forward pass
-        outputs = model(words)
-        # if y would be one-hot, we must apply
-        # labels = torch.max(labels, 1)[1]
-        loss = criterion(outputs, labels)
-        
-        # Backward and optimize
+    y = torch.tensor([tag_index[tag] for _, tag in xy], dtype=torch.long)
+    return X, y
+
+
+def train(X, y, hidden_size, output_size, max_epochs, learning_rate, patience, min_delta):
+    """full-batch training; stops once the loss has not improved by min_delta for `patience` epochs"""
+    model = NeuralNet(X.shape[1], hidden_size, output_size)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+
+    best_loss = float('inf')
+    best_state = None
+    stale = 0
+    for epoch in range(max_epochs):
+        outputs = model(X)
+        loss = criterion(outputs, y)
         optimizer.zero_grad()
         loss.backward()
         optimizer.step()
-        
-    if (epoch+1) % 100 == 0:
-        print (f'Epoch [{epoch+1}/{num_epochs}], Loss: {loss.item():.4f}')
-
-
-print(f'final loss: {loss.item():.4f}')
-
-data = {
-"model_state": model.state_dict(),
-"input_size": input_size,
-"hidden_size": hidden_size,
-"output_size": output_size,
-"all_words": all_words,
-"tags": tags
-}
-
-FILE = "data.pth"
-torch.save(data, FILE)
 
-print(f'training complete. file saved to {FILE}')
\ No newline at end of file
+        if loss.item() < best_loss - min_delta:
+            best_loss = loss.item()
+            best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+            stale = 0
+        else:
+            stale += 1
+            if stale >= patience:
+                print(f'early stop at epoch {epoch+1}')
+                break
+        if (epoch+1) % 100 == 0:
+            print(f'Epoch [{epoch+1}/{max_epochs}], Loss: {loss.item():.4f}')
+
+    model.load_state_dict(best_state)
+    model.eval()
+    print(f'final loss: {best_loss:.4f}')
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the intent classifier on intents.json')
+    parser.add_argument('--intents', default='intents.json')
+    parser.add_argument('--output', default='data.pth', help='state_dict checkpoint (legacy format)')
+    parser.add_argument('--export', default='intent_model.pt',
+                        help='TorchScript artifact with the vocabulary embedded, loaded by IntentClassifier')
+    parser.add_argument('--hidden-size', type=int, default=8)
+    parser.add_argument('--max-epochs', type=int, default=1000)
+    parser.add_argument('--learning-rate', type=float, default=0.01)
+    parser.add_argument('--patience', type=int, default=50)
+    parser.add_argument('--min-delta', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    all_words, tags, xy = load_corpus(args.intents)
+    print(len(xy), "patterns")
+    print(len(tags), "tags:", tags)
+    print(len(all_words), "unique stemmed words")
+
+    X, y = vectorize(xy, all_words, tags)
+    model = train(X, y, args.hidden_size, len(tags), args.max_epochs, args.learning_rate,
+                  args.patience, args.min_delta)
+
+    data = {
+    "model_state": model.state_dict(),
+    "input_size": len(all_words),
+    "hidden_size": args.hidden_size,
+    "output_size": len(tags),
+    "all_words": all_words,
+    "tags": tags
+    }
+    torch.save(data, args.output)
+
+    # one file for serving: the compiled network plus its vocabulary and tags
+    vocabulary = json.dumps({"all_words": all_words, "tags": tags})
+    torch.jit.save(torch.jit.script(model), args.export, _extra_files={"vocabulary.json": vocabulary})
+
+    print(f'training complete in {time.perf_counter() - start:.1f}s. '
+          f'files saved to {args.output} and {args.export}')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,18 @@
+from django.conf import settings
 from django.urls import path
-from .views import chatbot_home
+from .views import achatbot_home, achatbot_stream, chatbot_home, chatbot_metrics, chatbot_stream
 
-urlpatterns = [
-    path('', chatbot_home, name='chatbot_home'),
-]
\ No newline at end of file
+# Under ASGI the async views let one process hold many conversations that
+# are waiting on Ollama without tying up a worker thread each.
+if getattr(settings, 'CHATBOT_ASYNC_VIEWS', False):
+    urlpatterns = [
+        path('', achatbot_home, name='chatbot_home'),
+        path('stream/', achatbot_stream, name='chatbot_stream'),
+        path('metrics/', chatbot_metrics, name='chatbot_metrics'),
+    ]
+else:
+    urlpatterns = [
+        path('', chatbot_home, name='chatbot_home'),
+        path('stream/', chatbot_stream, name='chatbot_stream'),
+        path('metrics/', chatbot_metrics, name='chatbot_metrics'),
+    ]
@@ -0,0 +1,345 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+QUANTIZATIONS = ("float32", "float16", "int8")
+# rows converted to float32 at a time when scanning an int8/float16 matrix;
+# small enough that the converted block stays in cache
+SCAN_BLOCK_ROWS = 2048
+
+
+def vector_index_version(path):
+    """like chroma_index_version: changes whenever the index at `path` is rebuilt"""
+    try:
+        stat = os.stat(os.path.join(path, META_FILE))
+    except OSError:
+        return None
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def _pca(vectors, dimensions, sample=20000, seed=0):
+    """(original dims, dimensions) projection onto the top principal components"""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample:
+        vectors = vectors[rng.choice(len(vectors), sample, replace=False)]
+    centered = vectors - vectors.mean(axis=0)
+    _, _, components = np.linalg.svd(centered, full_matrices=False)
+    return np.ascontiguousarray(components[:dimensions].T, dtype=np.float32)
+
+
+def _kmeans(vectors, lists, iterations=15, seed=0):
+    """spherical k-means; returns (unit centroids, assignment of every row)"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), lists, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for index in range(lists):
+            members = vectors[assignment == index]
+            if len(members):
+                centroids[index] = members.sum(axis=0)
+        centroids = _normalize(centroids)
+    return centroids.astype(np.float32), np.argmax(vectors @ centroids.T, axis=1)
+
+
+def _quantize(vectors, quantization):
+    """return (matrix, per-row scales or None)"""
+    if quantization == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    return vectors.astype(quantization), None
+
+
+def build_vector_index(path, ids, texts, metadatas, vectors, metadata=None,
+                       dimensions=None, quantization="int8", lists=0, rescore=True):
+    """
+    write a QuantizedVectorIndex to the directory `path`
+
+    vectors are unit-normalised, optionally projected onto their top
+    `dimensions` principal components, quantized and, with lists > 0,
+    clustered into that many IVF lists stored as contiguous row ranges.
+    Every metadata key set to True (the tags of chatbot.tagging) gets a
+    sorted list of its rows, so filtered searches score only those rows.
+    With rescore a full-dimension float16 copy is kept for exact scoring of
+    the final candidates. The new index replaces the old one in one rename,
+    so running workers keep reading their mapped files until they reload.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"quantization must be one of {QUANTIZATIONS}")
+    start = time.perf_counter()
+    full = _normalize(np.asarray(vectors, dtype=np.float32))
+    projection = None
+    reduced = full
+    if dimensions and dimensions < full.shape[1]:
+        projection = _pca(full, dimensions)
+        reduced = _normalize(full @ projection)
+
+    order = np.arange(len(full))
+    centroids = offsets = None
+    if lists and len(full) > lists:
+        centroids, assignment = _kmeans(reduced, lists)
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.searchsorted(assignment[order], np.arange(lists + 1)).astype(np.int64)
+
+    matrix, scales = _quantize(reduced[order], quantization)
+
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=".vector_index-", dir=parent)
+    np.save(os.path.join(staging, "vectors.npy"), matrix)
+    if scales is not None:
+        np.save(os.path.join(staging, "scales.npy"), scales)
+    if projection is not None:
+        np.save(os.path.join(staging, "projection.npy"), projection)
+    if centroids is not None:
+        np.save(os.path.join(staging, "centroids.npy"), centroids)
+        np.save(os.path.join(staging, "offsets.npy"), offsets)
+    if rescore:
+        np.save(os.path.join(staging, "full.npy"), full[order].astype(np.float16))
+
+    # chunk records as one blob of JSON lines plus row offsets, mapped like the vectors
+    record_offsets = [0]
+    tag_rows = defaultdict(list)
+    with open(os.path.join(staging, "records.jsonl"), "wb") as f:
+        for new_row, row in enumerate(order):
+            record = {"id": ids[row], "text": texts[row], "metadata": metadatas[row] or {}}
+            line = json.dumps(record).encode("utf-8")
+            f.write(line + b"\n")
+            record_offsets.append(record_offsets[-1] + len(line) + 1)
+            for key, value in record["metadata"].items():
+                if value is True:
+                    tag_rows[key].append(new_row)
+    np.save(os.path.join(staging, "record_offsets.npy"), np.asarray(record_offsets, dtype=np.int64))
+    if tag_rows:
+        # tag -> [start, stop) of its rows in tag_rows.npy
+        tags, all_rows = {}, []
+        for key, rows in sorted(tag_rows.items()):
+            tags[key] = [len(all_rows), len(all_rows) + len(rows)]
+            all_rows.extend(rows)
+        np.save(os.path.join(staging, "tag_rows.npy"), np.asarray(all_rows, dtype=np.int64))
+        with open(os.path.join(staging, "tags.json"), "w") as f:
+            json.dump(tags, f)
+
+    meta = dict(metadata or {})
+    meta.update({
+        "count": len(full),
+        "source_dimensions": int(full.shape[1]),
+        "dimensions": int(reduced.shape[1]),
+        "quantization": quantization,
+        "lists": int(len(centroids)) if centroids is not None else 0,
+        "rescore": bool(rescore),
+    })
+    # meta.json last: its stat is the index version workers poll
+    with open(os.path.join(staging, META_FILE), "w") as f:
+        json.dump(meta, f)
+
+    previous = None
+    if os.path.exists(path):
+        previous = tempfile.mkdtemp(prefix=".vector_index-old-", dir=parent)
+        os.rename(path, os.path.join(previous, "index"))
+    os.rename(staging, path)
+    if previous is not None:
+        shutil.rmtree(previous, ignore_errors=True)
+    logger.info(
+        "vector index with %d rows (%d -> %d dims, %s, %d lists) written to %s in %.2fs",
+        meta["count"], meta["source_dimensions"], meta["dimensions"], quantization, meta["lists"],
+        path, time.perf_counter() - start,
+    )
+    return meta
+
+
+def vector_index_options():
+    """build_vector_index parameters from the CHATBOT_VECTOR_INDEX_* settings"""
+    return {
+        "dimensions": getattr(settings, "CHATBOT_VECTOR_INDEX_DIMENSIONS", None),
+        "quantization": getattr(settings, "CHATBOT_VECTOR_INDEX_QUANTIZATION", "int8"),
+        "lists": getattr(settings, "CHATBOT_VECTOR_INDEX_LISTS", 0),
+    }
+
+
+def export_collection(collection, page_size=5000):
+    """(ids, texts, metadatas, vectors) of every chunk in a Chroma collection"""
+    ids, texts, metadatas, vectors = [], [], [], []
+    offset = 0
+    while True:
+        page = collection.get(include=["embeddings", "documents", "metadatas"], limit=page_size, offset=offset)
+        ids.extend(page["ids"])
+        texts.extend(page["documents"])
+        metadatas.extend(page["metadatas"])
+        vectors.extend(page["embeddings"])
+        if len(page["ids"]) < page_size:
+            break
+        offset += page_size
+    if not ids:
+        raise ValueError("the Chroma collection is empty")
+    return ids, texts, metadatas, vectors
+
+
+def build_from_collection(collection, path, page_size=5000, **options):
+    """export a Chroma collection, embeddings included, into a QuantizedVectorIndex"""
+    ids, texts, metadatas, vectors = export_collection(collection, page_size)
+    return build_vector_index(path, ids, texts, metadatas, vectors, metadata=collection.metadata, **options)
+
+
+class _Records:
+    """
+    the Chroma-collection subset the rest of the app reads from a vector
+    store (`metadata`, `get`), served from records.jsonl
+    """
+
+    def __init__(self, blob, offsets, metadata):
+        self._blob = blob
+        self._offsets = offsets
+        self.metadata = metadata
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def record(self, row):
+        return json.loads(bytes(self._blob[self._offsets[row]:self._offsets[row + 1]]))
+
+    def get(self, include=None, limit=None, offset=0):
+        rows = range(offset, len(self) if limit is None else min(len(self), offset + limit))
+        records = [self.record(row) for row in rows]
+        return {
+            "ids": [record["id"] for record in records],
+            "documents": [record["text"] for record in records],
+            "metadatas": [record["metadata"] for record in records],
+        }
+
+
+class QuantizedVectorIndex:
+    """
+    Read-only in-process vector store built by build_vector_index.
+    Every array is opened with np.load(mmap_mode="r"), so worker processes
+    on one machine share a single copy through the page cache. A query is
+    scored against the whole (or, with IVF, the `nprobe` nearest lists of
+    the) quantized matrix in one matrix-vector product per block; the best
+    `rescore_factor * k` rows are then re-scored exactly against the
+    full-dimension vectors. Scores are cosine similarities. A `filter` in
+    the form chatbot.tagging.metadata_filter builds (True tags combined with
+    $and / $or) limits the scan to the tagged rows.
+    """
+
+    def __init__(self, path, embedding_function=None, nprobe=8, rescore_factor=4):
+        self.path = path
+        self.embedding_function = embedding_function
+        self.nprobe = nprobe
+        self.rescore_factor = rescore_factor
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.vectors = self._load("vectors.npy")
+        self.scales = self._load("scales.npy")
+        self.projection = self._load("projection.npy")
+        self.centroids = self._load("centroids.npy")
+        self.offsets = self._load("offsets.npy")
+        self.full = self._load("full.npy")
+        self.tag_rows = self._load("tag_rows.npy")
+        self.tags = {}
+        if self.tag_rows is not None:
+            with open(os.path.join(path, "tags.json")) as f:
+                self.tags = json.load(f)
+        blob = np.memmap(os.path.join(path, "records.jsonl"), dtype=np.uint8, mode="r")
+        self._collection = _Records(blob, self._load("record_offsets.npy"), self.meta)
+
+    def _load(self, name):
+        filename = os.path.join(self.path, name)
+        return np.load(filename, mmap_mode="r") if os.path.exists(filename) else None
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def _scan(self, start, stop, query):
+        """approximate scores of rows [start, stop) for a reduced query"""
+        scores = np.empty(stop - start, dtype=np.float32)
+        for block in range(start, stop, SCAN_BLOCK_ROWS):
+            end = min(stop, block + SCAN_BLOCK_ROWS)
+            scores[block - start:end - start] = self.vectors[block:end].astype(np.float32, copy=False) @ query
+        if self.scales is not None:
+            scores *= self.scales[start:stop]
+        return scores
+
+    def _mask(self, where):
+        """boolean mask of the rows satisfying a filter of True tags"""
+        if "$and" in where:
+            return np.logical_and.reduce([self._mask(condition) for condition in where["$and"]])
+        if "$or" in where:
+            return np.logical_or.reduce([self._mask(condition) for condition in where["$or"]])
+        mask = np.ones(len(self), dtype=bool)
+        for key, value in where.items():
+            if isinstance(value, dict) and set(value) == {"$eq"}:
+                value = value["$eq"]
+            if value is not True:
+                raise ValueError(f"the vector index can only filter on tags set to True, not {key}={value!r}")
+            # a tag no row carries, or an index built without tags, matches
+            # nothing; retrieval then tops up from the unfiltered search
+            tagged = np.zeros(len(self), dtype=bool)
+            start, stop = self.tags.get(key, (0, 0))
+            if stop > start:
+                tagged[self.tag_rows[start:stop]] = True
+            mask &= tagged
+        return mask
+
+    def _candidates(self, query, count, rows=None):
+        """(rows, approximate scores) of the best `count` rows, of `rows` if given"""
+        if rows is not None:
+            # a filtered subset is scored directly, without the IVF lists
+            scores = self.vectors[rows].astype(np.float32) @ query
+            if self.scales is not None:
+                scores *= self.scales[rows]
+        elif self.centroids is None:
+            ranges = [(0, len(self))]
+        else:
+            nearest = np.argsort(-(self.centroids @ query))[:self.nprobe]
+            ranges = [(int(self.offsets[i]), int(self.offsets[i + 1])) for i in nearest]
+        if rows is None:
+            rows = np.concatenate([np.arange(start, stop) for start, stop in ranges])
+            scores = np.concatenate([self._scan(start, stop, query) for start, stop in ranges])
+        if len(rows) > count:
+            best = np.argpartition(-scores, count - 1)[:count]
+            rows, scores = rows[best], scores[best]
+        return rows, scores
+
+    def search(self, vector, k=4, where=None):
+        """[(row, cosine similarity), ...] best first"""
+        rows = None if where is None else np.flatnonzero(self._mask(where))
+        if not len(self) or (rows is not None and not len(rows)):
+            return []
+        query = _normalize(np.asarray(vector, dtype=np.float32))
+        reduced = query if self.projection is None else _normalize(query @ self.projection)
+        rows, scores = self._candidates(reduced, self.rescore_factor * k if self.full is not None else k, rows)
+        if self.full is not None:
+            # sorted rows keep the reads from the mapped file sequential
+            order = np.argsort(rows)
+            rows = rows[order]
+            scores = self.full[rows].astype(np.float32) @ query
+        best = np.argsort(-scores)[:k]
+        return [(int(rows[i]), float(scores[i])) for i in best]
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k=4, filter=None, **kwargs):
+        results = []
+        for row, score in self.search(embedding, k, where=filter):
+            record = self._collection.record(row)
+            results.append((Document(page_content=record["text"], metadata=record["metadata"]), score))
+        return results
+
+    def similarity_search_with_score(self, query, k=4, filter=None):
+        return self.similarity_search_by_vector_with_relevance_scores(
+            self.embedding_function.embed_query(query), k, filter=filter
+        )
@@ -1,11 +1,13 @@
 from django.shortcuts import render,redirect
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 import json
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic.base import TemplateView
 from django.views.generic import View
 from .models import ChatMessage,ChatQueryMessage
-from django.utils import timezone
+from django.db import transaction
+from django.db.models import Q
+from datetime import datetime
 import os
 import random
 import json
@@ -139,79 +141,475 @@ from nltk.stem.porter import PorterStemmer
 
 
 #-------------------------------Huw's Ollama Model-----------------------
-from langchain_community.embeddings.ollama import OllamaEmbeddings
-from langchain_aws.embeddings import BedrockEmbeddings  # Ensure correct import path
 import logging
+import time
 
-def get_embedding_function():
-    embeddings = BedrockEmbeddings(
-        credentials_profile_name="default",
-        region_name="eu-west-2",
-        model_id="amazon.titan-embed-text-v2:0"  # Correct parameter
-    )
-    return embeddings
+from asgiref.sync import sync_to_async
+from colorama import init, Fore, Style
 
+from django.conf import settings
 
-from langchain_chroma import Chroma
-from langchain.prompts import ChatPromptTemplate
-from langchain_community.llms.ollama import Ollama
-from colorama import init, Fore, Style
+from .admission import Overloaded, get_admission_gate
+from .answer_cache import get_answer_cache
+from .chat_log import get_chat_log_writer
+from .context import build_context, count_tokens
+from .conversation import Conversation
+from .embedding_cache import get_embedding_cache
+from .intent_router import aintent_answer, intent_answer, route_stats
+from .keepalive import get_keepalives
+from . import metrics
+from .metrics import note, stage, trace_request
+from .retrieval import aretrieve, retrieve
+from .runtime import get_runtime
 
 
+logger = logging.getLogger(__name__)
 
 # Initialize colorama
 init(autoreset=True)
 
-CHROMA_PATH = "chroma"
-PROMPT_TEMPLATE = """
-Answer the question based only on the following context:
 
-{context}
+def _retrieve(rag, query_text):
+    query_vector, results = retrieve(rag, query_text)
+    sources = [doc.metadata.get("id", None) for doc, _ in results]
+    return query_vector, results, sources
+
+
+def _answer_cache_enabled(query_vector, history=""):
+    # the lexical fast path has no query vector to compare, and a follow-up
+    # question's answer depends on the conversation, not just the question
+    return query_vector is not None and not history and getattr(settings, "CHATBOT_ANSWER_CACHE_ENABLED", True)
+
+
+def _cached_answer(rag, query_vector, sources, history=""):
+    if not _answer_cache_enabled(query_vector, history):
+        return None
+    cached = get_answer_cache().get(query_vector, sources, rag.index_version)
+    metrics.event("answer_cache_hit" if cached is not None else "answer_cache_miss")
+    return cached
+
+
+def _build_prompt(rag, results, query_text, history=""):
+    # de-duplicated, token-budgeted context keeps mistral's prefill short
+    with stage("context"):
+        context = build_context(results)
+    with stage("prompt_format"):
+        prompt = rag.prompt.format(context=context.text, history=history, question=query_text)
+    prompt_tokens = count_tokens(prompt)
+    note("prompt_tokens", prompt_tokens)
+    note("context_tokens", context.tokens)
+    note("context_chunks", len(context.documents))
+    logger.info(
+        "prompt tokens=%d context tokens=%d chunks=%d duplicates dropped=%d truncated=%s",
+        prompt_tokens, context.tokens, len(context.documents), context.duplicates, context.truncated,
+    )
+    return prompt
+
+
+def _queued_seconds():
+    trace = metrics.current_trace()
+    return trace.stages.get("llm_queue", 0.0) if trace is not None else 0.0
+
+
+def _generate(rag, prompt):
+    """
+    stream the answer from the LLM, timing prefill (until the first chunk)
+    apart from generation of the rest
+    """
+    chunks = []
+    started = time.perf_counter()
+    # GatedLLM waits for its admission slot inside stream(); that wait is
+    # recorded as llm_queue and left out of llm_prefill
+    queued = _queued_seconds()
+    for chunk in rag.llm.stream(prompt):
+        if not chunks:
+            metrics.add_stage("llm_prefill", time.perf_counter() - started - (_queued_seconds() - queued))
+            started = time.perf_counter()
+        chunks.append(chunk)
+        yield chunk
+    metrics.add_stage("llm_generate", time.perf_counter() - started)
+    note("response_tokens", count_tokens("".join(chunks)))
+
+
+async def _agenerate(rag, prompt):
+    chunks = []
+    started = time.perf_counter()
+    queued = _queued_seconds()
+    async for chunk in rag.llm.astream(prompt):
+        if not chunks:
+            metrics.add_stage("llm_prefill", time.perf_counter() - started - (_queued_seconds() - queued))
+            started = time.perf_counter()
+        chunks.append(chunk)
+        yield chunk
+    metrics.add_stage("llm_generate", time.perf_counter() - started)
+    note("response_tokens", count_tokens("".join(chunks)))
+
+
+def query_rag(query_text: str, history: str = ""):
+    # Reuse the worker's embedder, Chroma handle, prompt and LLM client.
+    rag = get_runtime().components()
+    query_vector, results, sources = _retrieve(rag, query_text)
+
+    # A close paraphrase of an earlier question over the same sources
+    # gets the earlier answer instead of another mistral generation.
+    cached = _cached_answer(rag, query_vector, sources, history)
+    if cached is not None:
+        return cached
+
+    prompt = _build_prompt(rag, results, query_text, history)
+    # streamed and joined rather than invoked, so prefill can be timed
+    response_text = "".join(_generate(rag, prompt))
+    if _answer_cache_enabled(query_vector, history):
+        get_answer_cache().put(query_vector, sources, response_text, rag.index_version)
 
----
+    formatted_response = f"{Fore.RED}Response: {response_text}\nSources: {sources}{Style.RESET_ALL}"
+    #print(formatted_response)
+    return response_text
 
-Answer the question based on the above context: {question}
-"""
 
-def query_rag(query_text: str):
-    # Prepare the DB.
-    embedding_function = get_embedding_function()
-    db = Chroma(persist_directory=CHROMA_PATH, embedding_function=embedding_function)
+def stream_rag(query_text: str, history: str = ""):
+    """
+    same as query_rag but yields the answer piece by piece as Ollama
+    generates it
+    """
+    rag = get_runtime().components()
+    query_vector, results, sources = _retrieve(rag, query_text)
+
+    cached = _cached_answer(rag, query_vector, sources, history)
+    if cached is not None:
+        yield cached
+        return
+
+    prompt = _build_prompt(rag, results, query_text, history)
+    chunks = []
+    for chunk in _generate(rag, prompt):
+        chunks.append(chunk)
+        yield chunk
+    if _answer_cache_enabled(query_vector, history):
+        get_answer_cache().put(query_vector, sources, "".join(chunks), rag.index_version)
+
+
+def answer_message(message, history=""):
+    """
+    answer small talk from the intent model in microseconds and send
+    everything else through RAG
+    """
+    started = time.perf_counter()
+    with stage("intent"):
+        response = intent_answer(message)
+    if response is not None:
+        metrics.set_route('intent')
+        route_stats.record('intent', time.perf_counter() - started)
+        return response
+    metrics.set_route('rag')
+    response = query_rag(message, history)
+    route_stats.record('rag', time.perf_counter() - started)
+    return response
+
+
+def stream_message(message, history=""):
+    started = time.perf_counter()
+    with stage("intent"):
+        response = intent_answer(message)
+    if response is not None:
+        metrics.set_route('intent')
+        route_stats.record('intent', time.perf_counter() - started)
+        yield response
+        return
+    metrics.set_route('rag')
+    yield from stream_rag(message, history)
+    route_stats.record('rag', time.perf_counter() - started)
+
+
+#----Async variants, served natively under my_project.asgi----
+async def _aretrieve(rag, query_text):
+    query_vector, results = await aretrieve(rag, query_text)
+    sources = [doc.metadata.get("id", None) for doc, _ in results]
+    return query_vector, results, sources
 
-    # Search the DB.
-    results = db.similarity_search_with_score(query_text, k=5)
 
-    context_text = "\n\n---\n\n".join([doc.page_content for doc, _ in results])
-    prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
-    prompt = prompt_template.format(context=context_text, question=query_text)
-    model = Ollama(model="mistral")
-    response_text = model.invoke(prompt)
+async def _acomponents():
+    # the first call builds the runtime, which blocks, so keep it off the loop
+    return await sync_to_async(get_runtime().components, thread_sensitive=False)()
 
-    sources = [doc.metadata.get("id", None) for doc, _ in results]
-    formatted_response = f"{Fore.RED}Response: {response_text}\nSources: {sources}{Style.RESET_ALL}"
-    #print(formatted_response)
+
+async def aquery_rag(query_text: str, history: str = ""):
+    rag = await _acomponents()
+    query_vector, results, sources = await _aretrieve(rag, query_text)
+    cached = _cached_answer(rag, query_vector, sources, history)
+    if cached is not None:
+        return cached
+
+    prompt = _build_prompt(rag, results, query_text, history)
+    response_text = "".join([chunk async for chunk in _agenerate(rag, prompt)])
+    if _answer_cache_enabled(query_vector, history):
+        get_answer_cache().put(query_vector, sources, response_text, rag.index_version)
     return response_text
 
 
+async def astream_rag(query_text: str, history: str = ""):
+    rag = await _acomponents()
+    query_vector, results, sources = await _aretrieve(rag, query_text)
+    cached = _cached_answer(rag, query_vector, sources, history)
+    if cached is not None:
+        yield cached
+        return
+
+    prompt = _build_prompt(rag, results, query_text, history)
+    chunks = []
+    async for chunk in _agenerate(rag, prompt):
+        chunks.append(chunk)
+        yield chunk
+    if _answer_cache_enabled(query_vector, history):
+        get_answer_cache().put(query_vector, sources, "".join(chunks), rag.index_version)
+
+
+async def aanswer_message(message, history=""):
+    started = time.perf_counter()
+    with stage("intent"):
+        response = await aintent_answer(message)
+    if response is not None:
+        metrics.set_route('intent')
+        route_stats.record('intent', time.perf_counter() - started)
+        return response
+    metrics.set_route('rag')
+    response = await aquery_rag(message, history)
+    route_stats.record('rag', time.perf_counter() - started)
+    return response
+
+
+async def astream_message(message, history=""):
+    started = time.perf_counter()
+    with stage("intent"):
+        response = await aintent_answer(message)
+    if response is not None:
+        metrics.set_route('intent')
+        route_stats.record('intent', time.perf_counter() - started)
+        yield response
+        return
+    metrics.set_route('rag')
+    async for chunk in astream_rag(message, history):
+        yield chunk
+    route_stats.record('rag', time.perf_counter() - started)
+
+
+def _sse(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+
 #----Update the model----
+EXIT_RESPONSE = 'Thanks for visiting. See you next time!'
+
+
+def save_chat(message, response, session_id=None):
+    if getattr(settings, 'CHATBOT_CHAT_LOG_ASYNC', True):
+        # queued and bulk-inserted off the request path
+        get_chat_log_writer().write(message, response, session_id)
+        return
+    # both chat logs in one transaction: a single commit per turn
+    with transaction.atomic():
+        ChatQueryMessage.objects.create(message=message, response=response, session_id=session_id)
+        ChatMessage.objects.create(message=message, response=response, session_id=session_id)
+
+
+def _answer_in_conversation(request, message):
+    with trace_request('chat'):
+        conversation = Conversation.for_request(request)
+        with stage("history"):
+            history = conversation.history()
+        try:
+            response = answer_message(message, history)
+        except Overloaded:
+            metrics.event('overloaded')
+            raise
+        with stage("db_write"):
+            save_chat(message, response, conversation.session_id)
+        conversation.after_turn()
+    return response
+
+
+def _encode_cursor(chat):
+    return f'{chat.created_at.isoformat()}|{chat.pk}'
+
+
+def _decode_cursor(cursor):
+    try:
+        created_at, pk = cursor.split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (AttributeError, ValueError):
+        return None
+
+
+def chat_history(session_id, before=None, page_size=None):
+    """
+    one page of a session's chat history, oldest first, plus the cursor of
+    the page before it (None on the first page); empty without a session
+    Keyset pagination on the (session, created_at, id) index, so every page
+    costs the same however large the table grows.
+    """
+    if session_id is None:
+        return [], None
+    page_size = page_size or getattr(settings, 'CHATBOT_HISTORY_PAGE_SIZE', 20)
+    chats = ChatQueryMessage.objects.filter(session_id=session_id).order_by('-created_at', '-id')
+    cursor = _decode_cursor(before)
+    if cursor is not None:
+        created_at, pk = cursor
+        chats = chats.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    page = list(chats[:page_size + 1])
+    older = _encode_cursor(page[page_size - 1]) if len(page) > page_size else None
+    return page[:page_size][::-1], older
+
+
+def _overloaded_response(message, exc):
+    response = JsonResponse(
+        {'message': message, 'response': 'The assistant is busy right now. Please try again shortly.',
+         'retry_after': exc.retry_after},
+        status=503,
+    )
+    response['Retry-After'] = str(exc.retry_after)
+    return response
+
+
+def chatbot_metrics(request):
+    """
+    per-stage latency histograms, cache hit rates and queue depths of this
+    worker; staff only unless CHATBOT_METRICS_PUBLIC is set, as it names the
+    LLM and embedding backends
+    """
+    if not (request.user.is_staff or getattr(settings, 'CHATBOT_METRICS_PUBLIC', False)):
+        return JsonResponse({'error': 'Not found'}, status=404)
+    return JsonResponse({
+        'pipeline': metrics.registry.snapshot(),
+        'routes': route_stats.snapshot(),
+        'embedding_cache': get_embedding_cache().stats(),
+        'answer_cache': get_answer_cache().stats(),
+        'llm_admission': get_admission_gate().stats(),
+        'llm_keepalive': [keepalive.stats() for keepalive in get_keepalives()],
+        'chat_log': (get_chat_log_writer().stats()
+                     if getattr(settings, 'CHATBOT_CHAT_LOG_ASYNC', True) else None),
+        'runtime': get_runtime().stats(),
+    })
+
+
 def chatbot_home(request):
-    chats = ChatQueryMessage.objects.all()
     if request.method == 'POST':
         message = request.POST.get('message')
-        response = query_rag(message)
-        chat = ChatQueryMessage(message=message, response=response, created_at=timezone.now())
-        chat.save()
+        if message == 'exit':
+            response = EXIT_RESPONSE
+        else:
+            try:
+                response = _answer_in_conversation(request, message)
+            except Overloaded as exc:
+                return _overloaded_response(message, exc)
+        return JsonResponse({'message': message, 'response': response})
+    # a visitor who has not chatted yet gets no session
+    conversation = Conversation.for_request(request, create=False)
+    chats, older = chat_history(conversation and conversation.session_id, request.GET.get('before'))
+    return render(request, 'chatbot.html', {'chats': chats, 'older': older})
+
+
+def _stream_events(message, conversation):
+    # Server-sent events: one "token" event per generated chunk, then "done".
+    if message == 'exit':
+        yield _sse({'token': EXIT_RESPONSE})
+        yield _sse({'done': True})
+        return
+    with trace_request('chat'):
+        chunks = []
+        try:
+            with stage("history"):
+                history = conversation.history()
+            for chunk in stream_message(message, history):
+                chunks.append(chunk)
+                yield _sse({'token': chunk})
+        except Overloaded as exc:
+            metrics.event('overloaded')
+            yield _sse({'error': 'The assistant is busy right now. Please try again shortly.',
+                        'retry_after': exc.retry_after})
+            return
+        except Exception:
+            metrics.event('error')
+            logger.exception('chat stream failed')
+            yield _sse({'error': 'Sorry, something went wrong. Please try again.'})
+            return
+        with stage("db_write"):
+            save_chat(message, ''.join(chunks), conversation.session_id)
+        conversation.after_turn()
+    yield _sse({'done': True})
+
+
+def chatbot_stream(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    message = request.POST.get('message', '')
+    conversation = Conversation.for_request(request)
+    response = StreamingHttpResponse(_stream_events(message, conversation), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def achatbot_home(request):
     if request.method == 'POST':
         message = request.POST.get('message')
         if message == 'exit':
-            response = 'Thanks for visiting. See you next time!'
-        else: 
-            response = query_rag(message)
-            chat = ChatMessage(message=message, response=response, created_at=timezone.now())
-            chat.save()
+            response = EXIT_RESPONSE
+        else:
+            with trace_request('chat'):
+                conversation = await sync_to_async(Conversation.for_request)(request)
+                with stage("history"):
+                    history = await sync_to_async(conversation.history)()
+                try:
+                    response = await aanswer_message(message, history)
+                except Overloaded as exc:
+                    metrics.event('overloaded')
+                    return _overloaded_response(message, exc)
+                with stage("db_write"):
+                    await sync_to_async(save_chat)(message, response, conversation.session_id)
+                await sync_to_async(conversation.after_turn)()
         return JsonResponse({'message': message, 'response': response})
-    return render(request, 'chatbot.html',{'chats':chats})
-
-
-
-
+    conversation = await sync_to_async(Conversation.for_request)(request, create=False)
+    chats, older = await sync_to_async(chat_history)(conversation and conversation.session_id,
+                                                     request.GET.get('before'))
+    return render(request, 'chatbot.html', {'chats': chats, 'older': older})
+
+
+async def _astream_events(message, conversation):
+    if message == 'exit':
+        yield _sse({'token': EXIT_RESPONSE})
+        yield _sse({'done': True})
+        return
+    with trace_request('chat'):
+        chunks = []
+        try:
+            with stage("history"):
+                history = await sync_to_async(conversation.history)()
+            async for chunk in astream_message(message, history):
+                chunks.append(chunk)
+                yield _sse({'token': chunk})
+        except Overloaded as exc:
+            metrics.event('overloaded')
+            yield _sse({'error': 'The assistant is busy right now. Please try again shortly.',
+                        'retry_after': exc.retry_after})
+            return
+        except Exception:
+            metrics.event('error')
+            logger.exception('chat stream failed')
+            yield _sse({'error': 'Sorry, something went wrong. Please try again.'})
+            return
+        with stage("db_write"):
+            await sync_to_async(save_chat)(message, ''.join(chunks), conversation.session_id)
+        await sync_to_async(conversation.after_turn)()
+    yield _sse({'done': True})
+
+
+async def achatbot_stream(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    message = request.POST.get('message', '')
+    conversation = await sync_to_async(Conversation.for_request)(request)
+    response = StreamingHttpResponse(_astream_events(message, conversation), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -5,6 +5,9 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+
+Run it with an ASGI server, e.g. `uvicorn my_project.asgi:application`, and
+set CHATBOT_ASYNC_VIEWS = True to serve the chatbot with its async views.
 """
 
 import os
@@ -103,6 +103,136 @@ DATABASES = {
 # ChatBot
 #CHATBOT_TEMPLATE = <ChatBotAI template file path>
 #START_MESSAGE = "Welcome to ChatBotAI"
+CHATBOT_CHROMA_PATH = os.path.join(BASE_DIR, 'chroma')
+CHATBOT_LLM_MODEL = 'mistral'
+CHATBOT_OLLAMA_BASE_URL = 'http://localhost:11434'
+# Source documents for `manage.py ingest_chroma`
+CHATBOT_DATA_PATH = os.path.join(BASE_DIR, 'data')
+# Seconds between checks for a rebuilt Chroma index (0 disables hot reload)
+CHATBOT_RELOAD_CHECK_SECONDS = 5
+CHATBOT_WARMUP_ON_START = False
+# Query embedding cache: in-process LRU size, and a sqlite file shared by
+# workers that keeps the newest CHATBOT_EMBEDDING_CACHE_DISK_SIZE rows
+CHATBOT_EMBEDDING_CACHE_SIZE = 10000
+CHATBOT_EMBEDDING_CACHE_PATH = os.path.join(BASE_DIR, 'chatbot_cache.sqlite3')
+CHATBOT_EMBEDDING_CACHE_DISK_SIZE = 100000
+# Embedding provider: 'bedrock', 'ollama' or 'local' (CPU, sentence-transformers).
+# CHATBOT_EMBEDDING_MODEL overrides the provider's default model. The choice
+# is recorded with the Chroma collection and checked at start-up.
+CHATBOT_EMBEDDING_PROVIDER = 'bedrock'
+CHATBOT_EMBEDDING_MODEL = None
+# Ollama embedding server, when it is not CHATBOT_OLLAMA_BASE_URL
+CHATBOT_EMBEDDING_BASE_URL = None
+# Micro-batch concurrent query embeddings into one embed_documents call. Only
+# used by providers that embed a list in one call ('local'); Bedrock and
+# Ollama send one request per text, so batching them only serialises queries.
+CHATBOT_EMBEDDING_BATCHING = False
+CHATBOT_EMBEDDING_BATCH_WINDOW_MS = 10
+CHATBOT_EMBEDDING_BATCH_MAX_SIZE = 32
+# Vector store queried at runtime: 'chroma', or 'numpy' for an in-process,
+# memory-mapped copy of the Chroma index written by
+# `manage.py build_vector_index` (also refreshed by ingest_chroma). The copy
+# can be reduced to CHATBOT_VECTOR_INDEX_DIMENSIONS by PCA, quantized to
+# 'int8', 'float16' or 'float32' and split into CHATBOT_VECTOR_INDEX_LISTS
+# IVF lists (0 = brute force) of which NPROBE are searched; the best
+# RESCORE_FACTOR * k candidates are re-scored at full precision.
+CHATBOT_VECTOR_STORE = 'chroma'
+CHATBOT_VECTOR_INDEX_PATH = os.path.join(BASE_DIR, 'vector_index')
+CHATBOT_VECTOR_INDEX_DIMENSIONS = None
+CHATBOT_VECTOR_INDEX_QUANTIZATION = 'int8'
+CHATBOT_VECTOR_INDEX_LISTS = 0
+CHATBOT_VECTOR_INDEX_NPROBE = 8
+CHATBOT_VECTOR_INDEX_RESCORE_FACTOR = 4
+# Retrieval: 'vector' (Chroma only) or 'hybrid' (Chroma + in-process BM25,
+# fused by reciprocal rank). Questions of at most
+# CHATBOT_LEXICAL_FAST_PATH_MAX_TERMS words are answered from BM25 alone.
+CHATBOT_RETRIEVAL_MODE = 'hybrid'
+CHATBOT_RETRIEVAL_K = 5
+CHATBOT_HYBRID_CANDIDATES = 20
+CHATBOT_LEXICAL_FAST_PATH_MAX_TERMS = 3
+# ingest_chroma tags chunks with the crops, regions and topics they mention,
+# from the (csv file, column, field) vocabulary below. Questions naming one of
+# CHATBOT_METADATA_FILTER_FIELDS only search chunks tagged with it, topped up
+# from the whole index when fewer than CHATBOT_RETRIEVAL_K chunks match.
+CHATBOT_METADATA_FILTER = True
+CHATBOT_METADATA_FILTER_FIELDS = ('crop', 'region')
+CHATBOT_TAG_VOCABULARY = [
+    (os.path.join(BASE_DIR, 'crop_recommendation', 'Crop_recommendation.csv'), 'label', 'crop'),
+    (os.path.join(BASE_DIR, 'yield_prediction', 'crop_yield.csv'), 'Crop', 'crop'),
+    (os.path.join(BASE_DIR, 'yield_prediction', 'crop_yield.csv'), 'State', 'region'),
+]
+# Optional rerank of CHATBOT_RERANK_CANDIDATES chunks down to CHATBOT_RETRIEVAL_K:
+# None, 'lexical' (term overlap) or 'cross-encoder' (local, sentence-transformers).
+# The scorer's order is fused with the retrieval order by reciprocal rank.
+# Past the budget the retrieval order is kept.
+CHATBOT_RERANK = None
+CHATBOT_RERANK_CANDIDATES = 30
+CHATBOT_RERANK_BUDGET_MS = 150
+CHATBOT_RERANK_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+# Prompt context: approximate token budget and the shingle overlap at which
+# two chunks count as near-duplicates
+CHATBOT_CONTEXT_TOKEN_BUDGET = 1500
+CHATBOT_CONTEXT_DUPLICATE_THRESHOLD = 0.8
+# Intent fast path: the bag-of-words model in chatbot/data.pth answers from
+# intents.json when it is this confident and knows this share of the words.
+# CHATBOT_INTENT_TAGS limits which tags may answer (None = all); the model's
+# other tags (items, payments, delivery, funny) are a shop's FAQ and would
+# answer farming questions with unrelated text.
+CHATBOT_INTENT_ROUTING = True
+CHATBOT_INTENT_THRESHOLD = 0.75
+CHATBOT_INTENT_MIN_COVERAGE = 0.9
+CHATBOT_INTENT_TAGS = ('greeting', 'goodbye', 'thanks')
+# Serve /chatbot/metrics/ to everyone, not only staff
+CHATBOT_METRICS_PUBLIC = False
+# Chat history messages shown per page
+CHATBOT_HISTORY_PAGE_SIZE = 20
+# Chat logs: queue turns and bulk-insert them from a background thread in
+# batches of up to CHATBOT_CHAT_LOG_BATCH_SIZE, at most
+# CHATBOT_CHAT_LOG_FLUSH_SECONDS after the turn; the queue is drained when
+# the worker exits. `manage.py archive_chat_logs` moves rows older than
+# CHATBOT_CHAT_LOG_RETENTION_DAYS into gzipped monthly files under
+# CHATBOT_CHAT_LOG_ARCHIVE_PATH.
+CHATBOT_CHAT_LOG_ASYNC = True
+CHATBOT_CHAT_LOG_BATCH_SIZE = 100
+CHATBOT_CHAT_LOG_FLUSH_SECONDS = 1.0
+CHATBOT_CHAT_LOG_MAX_QUEUE = 10000
+CHATBOT_CHAT_LOG_RETENTION_DAYS = 90
+CHATBOT_CHAT_LOG_ARCHIVE_PATH = os.path.join(BASE_DIR, 'chat_archive')
+# Conversation memory: recent turns kept verbatim in the prompt; older turns
+# are folded into a rolling summary of at most CHATBOT_SUMMARY_MAX_WORDS
+CHATBOT_MEMORY_TURNS = 4
+CHATBOT_SUMMARY_MAX_WORDS = 120
+# Admission control for Ollama: concurrent generations per server, queued
+# requests, seconds a request may wait for a slot, and per-call HTTP timeout
+CHATBOT_LLM_MAX_CONCURRENT = 2
+CHATBOT_LLM_MAX_QUEUE = 16
+CHATBOT_LLM_QUEUE_TIMEOUT = 30
+CHATBOT_LLM_TIMEOUT = 120
+# Several Ollama servers (base URLs) to balance chat generation over, by
+# least outstanding requests; empty uses CHATBOT_OLLAMA_BASE_URL alone. A
+# server is ejected after CHATBOT_LLM_EJECT_AFTER_FAILURES failed calls in a
+# row or a failed health check, and re-admitted once a health check passes
+# (every CHATBOT_LLM_HEALTH_CHECK_SECONDS; 0 disables them).
+CHATBOT_OLLAMA_BACKENDS = []
+CHATBOT_LLM_EJECT_AFTER_FAILURES = 3
+CHATBOT_LLM_HEALTH_CHECK_SECONDS = 10
+# Ollama model residency: keep_alive sent with every call, preload (and prime
+# the static prompt prefix) at start-up, then renew keep_alive every
+# CHATBOT_LLM_HEARTBEAT_SECONDS (0 disables the heartbeat)
+CHATBOT_LLM_KEEP_ALIVE = '30m'
+CHATBOT_LLM_PRELOAD = False
+CHATBOT_LLM_HEARTBEAT_SECONDS = 240
+# Chat requests slower than this many seconds are logged with their
+# per-stage breakdown to the "chatbot.slow_queries" logger; None disables
+CHATBOT_SLOW_QUERY_SECONDS = 10
+# Semantic answer cache: minimum cosine similarity, TTL in seconds, max entries
+CHATBOT_ANSWER_CACHE_ENABLED = True
+CHATBOT_ANSWER_CACHE_THRESHOLD = 0.95
+CHATBOT_ANSWER_CACHE_TTL = 24 * 60 * 60
+CHATBOT_ANSWER_CACHE_SIZE = 1000
+# Route the chatbot to its async views; serve with an ASGI server, e.g.
+# `uvicorn my_project.asgi:application`
+CHATBOT_ASYNC_VIEWS = False
 
 
 # Password validation
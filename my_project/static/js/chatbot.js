@@ -1,15 +1,72 @@
 const messagesList = document.querySelector('.messages-list');
     const messageForm = document.querySelector('.message-form');
     const messageInput = document.querySelector('.message-input');
-  
+
+    function addReceivedMessage() {
+      const messageItem = document.createElement('li');
+      messageItem.classList.add('message', 'received');
+      messageItem.innerHTML = `
+          <div class="message-text">
+              <div class="message-sender">
+                <b>AI Chatbot</b>
+              </div>
+              <div class="message-content"></div>
+          </div>
+            `;
+      messagesList.appendChild(messageItem);
+      return messageItem.querySelector('.message-content');
+    }
+
+    // Read the server-sent events from /chatbot/stream/ and append each
+    // token to the reply as soon as it arrives.
+    async function streamReply(body) {
+      const response = await fetch('stream/', { method: 'POST', body: body });
+      if (!response.ok || !response.body) {
+        return fetchReply(body);
+      }
+      const content = addReceivedMessage();
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) {
+          break;
+        }
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const event of events) {
+          if (!event.startsWith('data: ')) {
+            continue;
+          }
+          const data = JSON.parse(event.slice(6));
+          if (data.token) {
+            content.textContent += data.token;
+          } else if (data.error) {
+            content.textContent += data.error;
+          }
+        }
+      }
+    }
+
+    // Non-streaming fallback: wait for the whole answer as JSON.
+    function fetchReply(body) {
+      return fetch('', { method: 'POST', body: body })
+        .then(response => response.json())
+        .then(data => {
+          addReceivedMessage().textContent = data.response;
+        });
+    }
+
     messageForm.addEventListener('submit', (event) => {
       event.preventDefault();
-  
+
       const message = messageInput.value.trim();
       if (message.length === 0) {
         return;
       }
-  
+
       const messageItem = document.createElement('li');
       messageItem.classList.add('message', 'sent');
       messageItem.innerHTML = `
@@ -22,33 +79,12 @@ const messagesList = document.querySelector('.messages-list');
               </div>
           </div>`;
       messagesList.appendChild(messageItem);
-  
+
       messageInput.value = '';
-  
-      fetch('', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
-        body: new URLSearchParams({
-          'csrfmiddlewaretoken': document.querySelector('[name=csrfmiddlewaretoken]').value,
-          'message': message
-        })
-      })
 
-        .then(response => response.json())
-        .then(data => {
-          const response = data.response;
-          const messageItem = document.createElement('li');
-          messageItem.classList.add('message', 'received');
-          messageItem.innerHTML = `
-          <div class="message-text">
-              <div class="message-sender">
-                <b>AI Chatbot</b>
-              </div>
-              <div class="message-content">
-                  ${response}
-              </div>
-          </div>
-            `;
-          messagesList.appendChild(messageItem);
-        });
-    });
\ No newline at end of file
+      const body = new URLSearchParams({
+        'csrfmiddlewaretoken': document.querySelector('[name=csrfmiddlewaretoken]').value,
+        'message': message
+      });
+      streamReply(body).catch(error => console.error(error));
+    });